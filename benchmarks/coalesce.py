@@ -0,0 +1,106 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Following a file written line by line, with and without coalescing"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import util  # noqa (sets up sys.path)
+
+import eventlet
+import eventlet.event
+
+import logshipper.pipeline
+import logshipper.tail
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+# An application logging about 20k lines per second, one write per line
+WRITER = """
+import sys, time
+with open(sys.argv[1], 'a') as f:
+    for i in range(int(sys.argv[2])):
+        f.write("Nov 13 01:22:33 web-01 app[123]: request %i handled\\n" % i)
+        f.flush()
+        if i % 10 == 0:
+            time.sleep(0.0005)
+"""
+
+STEPS = [
+    {"logshipper.filters:prepare_match":
+        r"(?P<program>\w+)\[(?P<pid>\d+)\]: (.*)",
+     "logshipper.filters:prepare_set": {"body": "{3}"}},
+    {"logshipper.filters:prepare_unset": "pid"},
+]
+
+
+def follow(path, count, coalesce):
+    pipeline = logshipper.pipeline.Pipeline(None)
+    pipeline.steps = [logshipper.pipeline.prepare_step(step)
+                      for step in STEPS]
+
+    state = {"received": 0, "batches": 0}
+    done = eventlet.event.Event()
+
+    def handle_batch(messages):
+        pipeline.process_batch(messages)
+        state["received"] += len(messages)
+        state["batches"] += 1
+        if state["received"] >= count:
+            done.send()
+
+    tail = logshipper.tail.Tail(path, coalesce=coalesce)
+    tail.set_handler(None, handle_batch)
+    tail.start()
+    eventlet.sleep(0.01)  # let the input open the file
+
+    try:
+        start_time = time.time()
+        start_cpu = cpu_time()
+        writer = subprocess.Popen([sys.executable, "-c", WRITER, path,
+                                   str(count)])
+        done.wait()
+        took = time.time() - start_time
+        cpu = cpu_time() - start_cpu
+        writer.wait()
+    finally:
+        tail.stop()
+        eventlet.sleep(0.01)
+
+    return count / took, cpu, state["batches"]
+
+
+def main(count=50000):
+    print("%-10s %10s %10s %10s" % ("coalesce", "lines/s", "CPU s",
+                                    "batches"))
+    results = []
+    for coalesce in (None, 0, 0.005, 0.05):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            rate, cpu, batches = follow(path, count, coalesce)
+        finally:
+            os.unlink(path)
+        results.append(count / cpu)
+        print("%-10s %10.0f %10.2f %10i" % (coalesce, rate, cpu, batches))
+
+    util.report("coalesce 5ms", results[0], results[2], "lines/CPU s")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,68 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""CPU cost versus bytes saved when compressing bulk request bodies"""
+
+import datetime
+import json
+import time
+
+import util  # noqa (sets up sys.path)
+
+import logshipper.compression
+import logshipper.elasticsearch
+
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+def bulk_body(documents=500):
+    lines = []
+    for i in range(documents):
+        lines.append(json.dumps({"index": {
+            "_index": "logshipper-2014.11.13", "_type": "log",
+            "_id": "%032x" % i}}))
+        lines.append(json.dumps({
+            "@timestamp": datetime.datetime(2014, 11, 13, 1, 22, i % 60),
+            "hostname": "web-%02i" % (i % 7),
+            "program": "nginx",
+            "message": "10.0.%i.%i - - \"GET /api/v1/items/%i HTTP/1.1\" 200 "
+                       "%i \"-\" \"Mozilla/5.0\"" % (i % 255, i % 13, i,
+                                                     i * 37 % 5000),
+        }, default=logshipper.elasticsearch.json_default))
+    return ("\n".join(lines) + "\n").encode('utf8')
+
+
+def main(rounds=20):
+    body = bulk_body()
+    print("%-10s %5s %10s %8s %12s" % ("encoding", "level", "bytes", "ratio",
+                                       "CPU ms/MiB"))
+    print("%-10s %5s %10i %8.2f %12.2f" % ("none", "-", len(body), 1, 0))
+
+    for encoding in logshipper.compression.ENCODINGS:
+        for level in (1, 6, 9):
+            start_time = cpu_time()
+            for _ in range(rounds):
+                compressed = logshipper.compression.compress(body, encoding,
+                                                             level)
+            took = (cpu_time() - start_time) / rounds
+            print("%-10s %5i %10i %8.2f %12.2f" % (
+                encoding, level, len(compressed),
+                len(body) / float(len(compressed)),
+                took * 1000 * 1024 * 1024 / len(body)))
+
+
+if __name__ == '__main__':
+    main()
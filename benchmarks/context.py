@@ -0,0 +1,148 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Context allocation and backreferences, versus how they used to work"""
+
+import re
+import sys
+
+import util
+
+import logshipper.context
+from logshipper import filters
+
+MESSAGE = {"message": u"Nov 13 01:22:33 web-01 sshd[1234]: Accepted publickey"}
+REGEX = r"(\w+)\[(?P<pid>\d+)\]: (\w+)"
+
+
+class LegacyContext(object):
+    """The context as it was: eagerly built lists, and no reuse"""
+
+    __slots__ = ['pipeline_manager', 'message', 'match', 'match_field',
+                 'backreferences', 'matches', 'serialized']
+
+    def __init__(self, message, pipeline_manager):
+        self.pipeline_manager = pipeline_manager
+        self.message = message
+        self.match = None
+        self.match_field = None
+        self.matches = None
+        self.backreferences = []
+        self.serialized = None
+
+    def next_step(self):
+        self.match = None
+        self.match_field = None
+        self.matches = None
+        self.backreferences = []
+        self.serialized = None
+
+
+def prepare_legacy_match(regex):
+    """The match action as it was, building backreferences eagerly"""
+    regexes = [("message", [re.compile(regex)])]
+
+    def handle_match(message, context):
+        matches = {}
+        last_match = None
+        last_match_key = None
+        for field_name, regex_list in regexes:
+            field_data = message.get(field_name)
+            for regex in regex_list:
+                match = regex.search(field_data)
+                if match:
+                    matches[field_name] = last_match = match
+                    last_match_key = field_name
+                    break
+            else:
+                return filters.SKIP_STEP
+
+        for match in matches.values():
+            message.update(match.groupdict())
+
+        context.matches = matches
+
+        if len(matches) == 1:
+
+            context.match_field = last_match_key
+            context.match = last_match
+            context.backreferences = [context.match.group(0)]
+            context.backreferences.extend(context.match.groups())
+    return handle_match
+
+
+def legacy_process(steps):
+    """The compiled process as it was, allocating a context per message"""
+    def process(message):
+        context = LegacyContext(message, None)
+        for step_idx, step in enumerate(steps):
+            if step_idx:
+                context.next_step()
+            for action in step:
+                action(message, context)
+        return message
+    return process
+
+
+def pooled_process(steps):
+    """The same loop, with a free list of contexts"""
+    free = []
+
+    def process(message):
+        if free:
+            context = free.pop()
+            context.message = message
+        else:
+            context = logshipper.context.Context(message, None)
+        for step_idx, step in enumerate(steps):
+            if step_idx:
+                context.next_step()
+            for action in step:
+                action(message, context)
+        context.reset()
+        free.append(context)
+        return message
+    return process
+
+
+def main(count=100000):
+    set_named = filters.prepare_set({"program": "{pid}"})
+    set_numbered = filters.prepare_set({"program": "{1}"})
+    steps = [[]] * 4
+
+    legacy = legacy_process(steps)
+    pooled = pooled_process(steps)
+    before = util.rate(legacy, count, MESSAGE)
+    after = util.rate(pooled, count, MESSAGE)
+    util.report("context, 4 empty steps", before, after)
+
+    for name, set_action in (("named", set_named),
+                             ("numbered", set_numbered)):
+        legacy = legacy_process([[prepare_legacy_match(REGEX), set_action]])
+        pooled = pooled_process([[filters.prepare_match(REGEX), set_action]])
+        before = util.rate(legacy, count, dict(MESSAGE))
+        after = util.rate(pooled, count, dict(MESSAGE))
+        util.report("match, set %s field" % name, before, after)
+
+    legacy = legacy_process([[prepare_legacy_match(REGEX), set_named],
+                             [filters.prepare_unset("pid")]])
+    pooled = pooled_process([[filters.prepare_match(REGEX), set_named],
+                             [filters.prepare_unset("pid")]])
+    before = util.rate(lambda: legacy(dict(MESSAGE)), count)
+    after = util.rate(lambda: pooled(dict(MESSAGE)), count)
+    util.report("match, set, unset", before, after)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,82 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Bulk throughput against stand-in nodes with a fixed response latency"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import datetime  # noqa
+import json  # noqa
+import time  # noqa
+
+import eventlet.wsgi  # noqa
+
+import util  # noqa
+
+import logshipper.context  # noqa
+import logshipper.elasticsearch  # noqa
+
+LATENCY = 0.02
+
+
+def stand_in_node():
+    def app(environ, start_response):
+        body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH']))
+        count = body.count(b"\n") // 2
+        eventlet.sleep(LATENCY)
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({"errors": False, "items": [
+            {"index": {"status": 201}}] * count}).encode('utf8')]
+
+    sock = eventlet.listen(('127.0.0.1', 0))
+    eventlet.spawn_n(eventlet.wsgi.server, sock, app,
+                     log=open("/dev/null", "w"))
+    return "http://127.0.0.1:%i/" % sock.getsockname()[1]
+
+
+def throughput(urls, selection='round_robin', count=20000, **bulk):
+    handler = logshipper.elasticsearch.prepare_elasticsearch_http({
+        'url': urls,
+        'selection': selection,
+        'bulk': bulk,
+    })
+    message = {
+        "message": "This is a test.",
+        "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+    }
+
+    start_time = time.time()
+    for i in range(count):
+        message = dict(message, sequence=i)
+        handler(message, logshipper.context.Context(message, None))
+    handler.flush()
+    return count / (time.time() - start_time)
+
+
+def main():
+    urls = [stand_in_node() for _ in range(4)]
+
+    before = throughput(urls[:1], documents=200, concurrency=1)
+    after = throughput(urls[:1], documents=200, concurrency=4)
+    util.report("1 node, 4 in flight", before, after, "docs/s")
+
+    after = throughput(urls, documents=200, concurrency=8,
+                       selection='least_outstanding')
+    util.report("4 nodes, 8 in flight", before, after, "docs/s")
+
+
+if __name__ == '__main__':
+    main()
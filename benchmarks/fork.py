@@ -0,0 +1,122 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Forking messages to several pipelines, with dict copies and copy-on-write
+
+Every message is forked to ``FORKS`` pipelines, each of which adds a field
+and serializes the result.
+"""
+
+import datetime
+import sys
+import tracemalloc
+
+import util
+
+import logshipper.context
+import logshipper.filters
+import logshipper.outputs
+import logshipper.pipeline
+import logshipper.serialize
+
+FORKS = 8
+
+
+def make_message(fields):
+    message = dict(("field%i" % i, u"value %i" % i) for i in range(fields))
+    message.update({
+        "message": u"2014-11-13 01:22:22 sshd[1234]: Accepted publickey",
+        "hostname": u"localhost",
+        "timestamp": datetime.datetime(2014, 11, 13, 1, 22, 22),
+    })
+    return message
+
+
+def prepare_legacy_fork(pipeline_name):
+    """The fork action as it was, copying the message"""
+    def handle_fork(message, context):
+        context.pipeline_manager.process_in_eventlet(dict(message),
+                                                     pipeline_name)
+    return handle_fork
+
+
+class Manager(object):
+    """Holds on to forked messages, instead of queueing them"""
+
+    def __init__(self):
+        self.forked = []
+
+    def process_in_eventlet(self, message, pipeline_name):
+        self.forked.append(message)
+
+
+def prepare(prepare_fork):
+    manager = Manager()
+    steps = [[prepare_fork("fork%i" % i) for i in range(FORKS)]]
+    process = logshipper.pipeline.prepare_pipeline(steps, manager)
+
+    child_steps = [[logshipper.filters.prepare_set({"forked": True})]]
+    child = logshipper.pipeline.prepare_pipeline(child_steps, manager)
+    return manager, process, child
+
+
+def fan_out(manager, process, child, message):
+    process(dict(message))
+    for message in manager.forked:
+        context = logshipper.context.Context(child(message), None)
+        logshipper.serialize.serialize_message(context)
+    del manager.forked[:]
+
+
+def fork_only(manager, process, child, message):
+    process(dict(message))
+    del manager.forked[:]
+
+
+def retained(manager, process, message, count):
+    """Bytes allocated for the forks of count messages"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(count):
+            process(dict(message))
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+        del manager.forked[:]
+
+
+def main(count=5000):
+    legacy = prepare(prepare_legacy_fork)
+    cow = prepare(logshipper.outputs.prepare_fork)
+
+    for fields in (10, 30, 100):
+        message = make_message(fields)
+        print("%i fields" % len(message))
+
+        before = util.rate(fan_out, count, *(legacy + (message,)))
+        after = util.rate(fan_out, count, *(cow + (message,)))
+        util.report("  fork, set and serialize", before, after)
+
+        before = util.rate(fork_only, count, *(legacy + (message,)))
+        after = util.rate(fork_only, count, *(cow + (message,)))
+        util.report("  fork only", before, after)
+
+        before = retained(legacy[0], legacy[1], message, count) / count
+        after = retained(cow[0], cow[1], message, count) / count
+        util.report("  memory per message", before, after, "bytes")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,142 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Idle CPU and event latency of the inotify hub versus a notifier per input
+
+Every legacy input used an inotify instance of its own, which counts against
+fs.inotify.max_user_instances (128 by default).
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import util  # noqa (sets up sys.path)
+
+import eventlet
+import eventlet.event
+import eventlet.green.select
+import pyinotify
+
+import logshipper.inotify
+import logshipper.pyinotify_eventlet_notifier
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+MASK = pyinotify.IN_MODIFY
+
+
+class LegacyNotifier(logshipper.pyinotify_eventlet_notifier.Notifier):
+    def check_events(self, timeout=None):
+        ret = eventlet.green.select.select([self._fd], [self._fd], [self._fd])
+        return bool(ret[0])
+
+
+class Legacy(object):
+    """A watch manager and notifier per input, as before the hub"""
+
+    def __init__(self, paths, callback):
+        self.watch_manager = pyinotify.WatchManager()
+        for path in paths:
+            self.watch_manager.add_watch(path, MASK, proc_fun=callback)
+        self.notifier = LegacyNotifier(self.watch_manager)
+        self.thread = eventlet.spawn(self.notifier.loop)
+
+    def close(self):
+        self.thread.kill()
+        self.notifier.stop()
+
+
+class Shared(object):
+    def __init__(self, paths, callback):
+        self.watcher = logshipper.inotify.Watcher()
+        for path in paths:
+            self.watcher.add_watch(path, MASK, callback)
+        self.thread = eventlet.spawn(self.watcher.loop)
+
+    def close(self):
+        self.thread.kill()
+        self.watcher.close()
+
+
+def idle_cpu(klass, paths, inputs, duration=1.0):
+    """CPU seconds used per second while nothing happens"""
+    watchers = [klass(paths, lambda event: None) for _ in range(inputs)]
+    try:
+        eventlet.sleep(0.1)
+        start_cpu = cpu_time()
+        eventlet.sleep(duration)
+        return (cpu_time() - start_cpu) / duration
+    finally:
+        for watcher in watchers:
+            watcher.close()
+
+
+def latency(klass, paths, inputs, samples=500):
+    """Returns the median and 99th percentile latency in microseconds"""
+    state = {"event": None}
+
+    def callback(event):
+        if state["event"] is not None and not state["event"].ready():
+            state["event"].send(time.time())
+
+    watchers = [klass(paths, callback) for _ in range(inputs)]
+    results = []
+    try:
+        eventlet.sleep(0.1)
+        with open(paths[0], 'a') as f:
+            for _ in range(samples):
+                state["event"] = eventlet.event.Event()
+                start_time = time.time()
+                f.write("x\n")
+                f.flush()
+                received = state["event"].wait()
+                state["event"] = None
+                results.append((received - start_time) * 1e6)
+                eventlet.sleep(0.001)  # let the other inputs catch up
+    finally:
+        for watcher in watchers:
+            watcher.close()
+
+    results.sort()
+    return results[len(results) // 2], results[len(results) * 99 // 100]
+
+
+def main(inputs=20):
+    path = tempfile.mkdtemp()
+    paths = [os.path.join(path, "test.log")]
+    open(paths[0], 'w').close()
+
+    try:
+        print("%-10s %12s %12s %12s %12s" % ("", "instances", "idle CPU %",
+                                             "median us", "p99 us"))
+        results = {}
+        for name, klass in (("legacy", Legacy), ("hub", Shared)):
+            cpu = idle_cpu(klass, paths, inputs)
+            median, p99 = latency(klass, paths, inputs)
+            results[name] = (cpu, median, p99)
+            instances = inputs if klass is Legacy else 1
+            print("%-10s %12i %12.1f %12.0f %12.0f" % (
+                name, instances, cpu * 100, median, p99))
+    finally:
+        shutil.rmtree(path)
+
+    util.report("median event latency", results["legacy"][1],
+                results["hub"][1], "us")
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
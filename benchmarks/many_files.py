@@ -0,0 +1,98 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tailing many files, with and without a limit on open files"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import util  # noqa (sets up sys.path)
+
+import eventlet
+
+import logshipper.tail
+
+
+def open_fds(tail):
+    return sum(1 for t in tail.tails.values()
+               if t.file_descriptor is not None)
+
+
+def follow(path, count, updates, max_open_files):
+    received = []
+    tail = logshipper.tail.Tail(path + "/*.log",
+                                max_open_files=max_open_files)
+    tail.set_handler(None, received.extend)
+
+    start_time = time.time()
+    tail.start()
+    eventlet.sleep(0)  # let the input open the files
+    startup = time.time() - start_time
+
+    try:
+        if len(tail.tails) < count:
+            print("%-20s failed to open all files" % (
+                max_open_files or "unlimited"))
+            return
+
+        fds = open_fds(tail)
+        watches = len(tail.watcher.subscriptions)
+
+        start_time = time.time()
+        for i in range(updates):
+            with open("%s/%05i.log" % (path, i * count // updates), 'a') as f:
+                f.write("update %i\n" % i)
+            if i % 100 == 0:
+                eventlet.sleep(0)
+
+        deadline = time.time() + 60
+        while len(received) < updates and time.time() < deadline:
+            eventlet.sleep(0.001)
+        took = time.time() - start_time
+
+        print("%-20s %8.2fs %8i %8i %8i %10.0f" % (
+            max_open_files or "unlimited", startup, fds, watches,
+            len(received), len(received) / took))
+    finally:
+        tail.stop()
+        eventlet.sleep(0.1)
+
+
+def main(count=20000, updates=2000):
+    # Failing to open files is expected, and not interesting here
+    logging.getLogger('logshipper').setLevel(logging.CRITICAL)
+
+    # tmpfs, so we measure tail and not the disk
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    path = tempfile.mkdtemp(dir=base)
+    try:
+        for i in range(count):
+            with open("%s/%05i.log" % (path, i), 'w') as f:
+                f.write("existing line\n")
+
+        print("%-20s %9s %8s %8s %8s %10s" % (
+            "max_open_files", "startup", "fds", "watches", "lines",
+            "lines/s"))
+        for max_open_files in (100, 1000, None):
+            follow(path, count, updates, max_open_files)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
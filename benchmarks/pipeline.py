@@ -0,0 +1,80 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Compares the compiled pipeline with the interpreted step loop"""
+
+import datetime
+
+import util
+
+import logshipper.context
+from logshipper import filters
+import logshipper.pipeline
+
+PIPELINES = {
+    "syslog-like": [
+        {"logshipper.filters:prepare_match":
+            r"(?P<program>\w+)\[(?P<pid>\d+)\]: (.*)",
+         "logshipper.filters:prepare_set": {"body": "{3}"}},
+        {"logshipper.filters:prepare_match": r"^DEBUG",
+         "logshipper.filters:prepare_drop": None},
+        {"logshipper.filters:prepare_unset": "pid"},
+    ],
+    "many-steps": [
+        {"logshipper.filters:prepare_match": "nomatch%i" % i,
+         "logshipper.filters:prepare_set": {"flag%i" % i: True}}
+        for i in range(10)
+    ],
+    "strptime": [
+        {"logshipper.filters:prepare_match": r"^(?P<date>\S+ \S+)",
+         "logshipper.filters:prepare_strptime": {
+             "field": "date", "format": "%Y-%m-%d %H:%M:%S"}},
+    ],
+}
+
+MESSAGE = {
+    "message": u"2014-11-13 01:22:22 sshd[1234]: Accepted publickey",
+    "hostname": u"localhost",
+    "timestamp": datetime.datetime(2014, 11, 13, 1, 22, 22),
+}
+
+
+def process_interpreted(steps, message):
+    context = logshipper.context.Context(message, None)
+    for step in steps:
+        context.next_step()
+        for action in step:
+            result = action(message, context)
+            if result == filters.DROP_MESSAGE:
+                return
+            elif result == filters.SKIP_STEP:
+                break
+
+    return message
+
+
+def main(count=20000):
+    for name, config in sorted(PIPELINES.items()):
+        steps = [logshipper.pipeline.prepare_step(step) for step in config]
+        compiled = logshipper.pipeline.prepare_pipeline(steps, None)
+
+        before = util.rate(lambda: process_interpreted(steps, dict(MESSAGE)),
+                           count)
+        after = util.rate(lambda: compiled(dict(MESSAGE)), count)
+        util.report(name, before, after)
+
+
+if __name__ == '__main__':
+    main()
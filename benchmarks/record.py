@@ -0,0 +1,90 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Memory and speed of compact records, compared to plain dicts"""
+
+import datetime
+import socket
+import sys
+import tracemalloc
+
+import util
+
+import logshipper.context
+import logshipper.input
+import logshipper.message
+import logshipper.serialize
+
+
+def make_dict(i, extracted, get_hostname=socket.gethostname):
+    """A message as emitted by an input, before hostnames were cached"""
+    message = {
+        "message": u"Nov 13 01:22:33 web-01 app[123]: request %i handled" % i,
+        "hostname": get_hostname(),
+        "timestamp": datetime.datetime.utcnow(),
+    }
+    if extracted:
+        message.update({"facility": "daemon", "severity": "info",
+                        "program": u"app", "pid": u"%i" % i})
+    return message
+
+
+def make_cached_dict(i, extracted):
+    return make_dict(i, extracted, logshipper.input.get_hostname)
+
+
+def make_record(i, extracted):
+    return logshipper.message.Record(make_dict(i, extracted))
+
+
+def retained(make, count, extracted):
+    """Bytes allocated per message, while count messages are in flight"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        messages = [make(i, extracted) for i in range(count)]
+        result = (tracemalloc.get_traced_memory()[0] - before) / count
+        del messages
+        return result
+    finally:
+        tracemalloc.stop()
+
+
+def serialize(message):
+    context = logshipper.context.Context(message, None)
+    return logshipper.serialize.serialize_message(context)
+
+
+def main(count=100000):
+    for extracted in (False, True):
+        name = "extracted" if extracted else "core fields"
+        before = retained(make_dict, count, extracted)
+        cached = retained(make_cached_dict, count, extracted)
+        after = retained(make_record, count, extracted)
+        util.report("memory %s, dict" % name, before, cached, "bytes")
+        util.report("memory %s, record" % name, before, after, "bytes")
+
+    message = make_dict(0, True)
+    record = make_record(0, True)
+    before = util.rate(lambda: message["timestamp"], count)
+    after = util.rate(lambda: record["timestamp"], count)
+    util.report("timestamp lookup", before, after, "lookups/s")
+
+    before = util.rate(serialize, count // 10, message)
+    after = util.rate(serialize, count // 10, record)
+    util.report("serialize", before, after)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,84 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Spool append and replay throughput, and memory use during an outage"""
+
+import datetime
+import resource
+import shutil
+import tempfile
+import time
+
+import util  # noqa (sets up sys.path)
+
+import logshipper.context
+import logshipper.spool
+
+
+def message(i):
+    return {
+        "timestamp": datetime.datetime(2014, 11, 13, 1, 22, i % 60),
+        "hostname": "web-%02i" % (i % 7),
+        "program": "nginx",
+        "message": "10.0.%i.%i - - \"GET /api/v1/items/%i HTTP/1.1\" 200 "
+                   "%i \"-\" \"Mozilla/5.0\"" % (i % 255, i % 13, i,
+                                                 i * 37 % 5000),
+    }
+
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main(count=200000):
+    path = tempfile.mkdtemp()
+    try:
+        delivered = []
+        outage = [True]
+
+        def handle_output(message, context):
+            delivered.append(1)
+        handle_output.phase = 30
+        handle_output.saturated = lambda: outage[0]
+
+        output = logshipper.spool.SpooledOutput(handle_output, path,
+                                                max_size=2 ** 40)
+
+        # Spool everything, as during an outage
+        rss_before = max_rss()
+        start_time = time.time()
+        for i in range(count):
+            msg = message(i)
+            output.spill(logshipper.context.Context(msg, None))
+        output.spool.sync()
+        took = time.time() - start_time
+        print("%-30s %12.0f msgs/s, %.1f MiB on disk, max RSS +%.1f MiB" % (
+            "spool", count / took, len(output.spool) / 2.0 ** 20,
+            max_rss() - rss_before))
+
+        # Replay in this greenthread, rather than the one spill() started
+        output.replaying.kill()
+        outage[0] = False
+        start_time = time.time()
+        output._replay()
+        took = time.time() - start_time
+        assert len(delivered) == count
+        print("%-30s %12.0f msgs/s" % ("replay", count / took))
+        output.flush()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
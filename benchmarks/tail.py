@@ -0,0 +1,109 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Catching up on a large backlog file with Tail.read_tail"""
+
+import os
+import sys
+import tempfile
+import time
+
+import util  # noqa (sets up sys.path)
+
+import logshipper.tail
+
+
+def legacy_read_tail(self, tail):
+    """The read loop as it was, reading and decoding 1KiB at a time"""
+    while True:
+        buff = os.read(tail.file_descriptor, 1024)
+        if not buff:
+            return
+
+        buff = buff.decode('utf8')
+
+        if tail.buffer:
+            buff = tail.buffer + buff
+            tail.buffer = ""
+
+        lines = buff.splitlines(True)
+        if lines[-1][-1] != "\n":
+            tail.buffer = lines[-1][-1]
+            lines = lines[:-1]
+
+        self.emit_many([{'message': line[:-1]} for line in lines])
+
+
+def drain_tail(self, tail):
+    logshipper.tail.Tail.read_tail(self, tail, drain=True)
+
+
+def write_backlog(path, size):
+    # ASCII only, the legacy loop fails when a read splits a character
+    line = (u"Nov 13 01:22:33 web-01 nginx: 10.0.0.1 - - \"GET /api/v1/items"
+            u"/12345 HTTP/1.1\" 200 4123 \"-\" \"Mozilla/5.0\"\n"
+            ).encode('utf8')
+    block = line * (1024 * 1024 // len(line))
+    with open(path, 'wb') as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+
+
+def catch_up(path, read_tail, emit=True):
+    counter = [0]
+
+    def handle_batch(messages, source=None):
+        counter[0] += len(messages)
+
+    tail_input = logshipper.tail.Tail([])
+    tail_input.set_handler(None, handle_batch)
+    if not emit:
+        # Measure reading and splitting only, not building the messages
+        tail_input.emit_many = handle_batch
+
+    tail = logshipper.tail.Tail.FileTail()
+    tail.file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        start_time = time.time()
+        read_tail(tail_input, tail)
+        took = time.time() - start_time
+    finally:
+        os.close(tail.file_descriptor)
+    return counter[0], took
+
+
+def main(size=256 * 1024 * 1024):
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_backlog(path, size)
+        size = os.path.getsize(path)
+
+        for emit in (False, True):
+            results = []
+            for name, read_tail in (("legacy_read_tail", legacy_read_tail),
+                                    ("read_tail", drain_tail)):
+                lines, took = catch_up(path, read_tail, emit)
+                results.append(size / took / 1024 / 1024)
+                print("%-30s %9i lines %9.1f MiB/s" % (name, lines,
+                                                       results[-1]))
+
+            util.report("catch up" if emit else "read and split",
+                        results[0], results[1], "MiB/s")
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) * 1024 * 1024 for arg in sys.argv[1:]])
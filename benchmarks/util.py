@@ -0,0 +1,41 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import sys
+import time
+
+# Allow running the benchmarks from a source checkout
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def rate(func, count, *args, **kwargs):
+    """Calls func count times, and returns the number of calls per second
+
+    The best of ``repeat`` runs is reported, to reduce the effect of noise.
+    """
+    best = None
+    for _ in range(kwargs.get('repeat', 5)):
+        start_time = time.time()
+        for _ in range(count):
+            func(*args)
+        took = time.time() - start_time
+        best = took if best is None else min(best, took)
+    return count / best
+
+
+def report(name, before, after, unit="msgs/s"):
+    print("%-30s %12.0f %s -> %12.0f %s (%.2fx)" % (
+        name, before, unit, after, unit, after / before))
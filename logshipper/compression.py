@@ -0,0 +1,60 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import zlib
+
+import eventlet.tpool
+
+ENCODINGS = ('gzip', 'deflate')
+
+# Bodies at least this large are compressed in a native thread, so the hub
+# keeps running in the meantime. zlib releases the GIL while compressing.
+THREAD_THRESHOLD = 64 * 1024
+
+
+def compress(data, encoding, level=6):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        compressor = zlib.compressobj(level)
+    else:
+        raise ValueError("Unsupported encoding %r" % encoding)
+
+    return compressor.compress(data) + compressor.flush()
+
+
+def prepare_compressor(encoding, level=6, threshold=THREAD_THRESHOLD):
+    """Returns a function that compresses request bodies.
+
+    The function has an ``encoding`` attribute with the value for the
+    ``Content-Encoding`` header. Returns None when encoding is empty.
+    """
+    if not encoding:
+        return None
+
+    if encoding not in ENCODINGS:
+        raise ValueError("compression should be one of %s" %
+                         ", ".join(ENCODINGS))
+
+    level = int(level)
+
+    def compress_body(data):
+        if len(data) >= threshold:
+            return eventlet.tpool.execute(compress, data, encoding, level)
+        return compress(data, encoding, level)
+
+    compress_body.encoding = encoding
+    return compress_body
@@ -14,10 +14,13 @@
 #    under the License.
 
 
+import re
 import string
 
 import six
 
+import logshipper.message
+
 
 def _template_code(template):
     if (template in (True, False, None) or
@@ -112,26 +115,97 @@ def prepare_template(template):
     six.exec_(result, namespace)
 
     func = namespace["template"]
-    func.interpolate = lambda context: func(context.backreferences,
-                                            context.message)
+    if re.search(r"\bargs\b", code):
+        func.interpolate = lambda context: func(context.backreferences,
+                                                context.message)
+    else:
+        # Don't make the context build backreferences nobody uses
+        func.interpolate = lambda context: func((), context.message)
 
     return func
 
 
 class Context(object):
+    """The state of a message while it's being processed.
+
+    ``backreferences`` and ``matches`` are derived from ``match`` when they're
+    first used, as most steps never use them. Assigning None to either makes
+    it derived again.
+    """
+
     __slots__ = ['pipeline_manager', 'message', 'match', 'match_field',
-                 'backreferences', 'matches']
+                 '_backreferences', '_matches', 'serialized']
 
     def __init__(self, message, pipeline_manager):
         self.pipeline_manager = pipeline_manager
         self.message = message
         self.match = None
         self.match_field = None
-        self.matches = None
-        self.backreferences = []
+        self._matches = None
+        self._backreferences = None
+        self.serialized = None
+
+    @property
+    def backreferences(self):
+        backreferences = self._backreferences
+        if backreferences is None:
+            match = self.match
+            if match is None:
+                backreferences = []
+            else:
+                backreferences = [match.group(0)]
+                backreferences.extend(match.groups())
+            self._backreferences = backreferences
+        return backreferences
+
+    @backreferences.setter
+    def backreferences(self, value):
+        self._backreferences = value
+
+    @property
+    def matches(self):
+        matches = self._matches
+        if matches is None and self.match is not None:
+            matches = self._matches = {self.match_field: self.match}
+        return matches
+
+    @matches.setter
+    def matches(self, value):
+        self._matches = value
+
+    def set_match(self, match_field, match, matches=None):
+        """Registers the result of a match, for use in the rest of the step"""
+        self.match_field = match_field
+        self.match = match
+        self._matches = matches
+        self._backreferences = None
+
+    def snapshot(self):
+        """Returns a copy that is unaffected by further processing.
+
+        The message is copied shallowly, the match state by reference.
+        """
+        result = Context(logshipper.message.fork(self.message),
+                         self.pipeline_manager)
+        result.match = self.match
+        result.match_field = self.match_field
+        result._matches = self._matches
+        result._backreferences = self._backreferences
+        result.serialized = self.serialized
+        return result
 
     def next_step(self):
         self.match = None
         self.match_field = None
-        self.matches = None
-        self.backreferences = []
+        self._matches = None
+        self._backreferences = None
+        self.serialized = None
+
+    def reset(self):
+        """Clears the context, so it can be reused for another message"""
+        self.message = None
+        self.match = None
+        self.match_field = None
+        self._matches = None
+        self._backreferences = None
+        self.serialized = None
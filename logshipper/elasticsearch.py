@@ -13,21 +13,40 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import datetime
 import hashlib
-import json
+import logging
+import time
 
+import eventlet
+import eventlet.greenpool
 import requests
+import requests.adapters
+import six
 
+import logshipper.compression
 import logshipper.context
 import logshipper.filters
+import logshipper.serialize
 
+LOG = logging.getLogger(__name__)
 
-def json_default(value):
-    if isinstance(value, datetime.datetime):
-        return value.isoformat()
-    else:
-        return str(value)
+BULK_DEFAULTS = {
+    "documents": 500,
+    "bytes": 5 * 1024 * 1024,
+    "linger": 1.0,
+    "retries": 3,
+    "concurrency": 1,
+    "timeout": 30,
+    "adaptive": False,
+    "min_documents": 50,
+    "max_documents": 5000,
+    "max_concurrency": 8,
+    "target_latency": 1.0,
+}
+
+MAX_BACKOFF = 30
+
+json_default = logshipper.serialize.json_default
 
 TRUE_VALUES = set([True, 1, "yes", "true", "on"])
 
@@ -62,7 +81,54 @@ def prepare_elasticsearch_http(parameters):
         The document to send. When not provided, the entire logmessage is sent.
     ```url```
         The URL of the elasticsearch instance. Defaults to
-        ```http://localhost:9200/```.
+        ```http://localhost:9200/```. A list of URLs spreads the requests
+        over multiple nodes. Nodes that fail are skipped for ```eviction```
+        seconds (default 30).
+    ```compression```
+        Compress request bodies, either ```gzip``` or ```deflate```. Large
+        bodies are compressed in a native thread.
+    ```compression_level```
+        The zlib compression level, from 1 (fastest) to 9 (smallest).
+        Defaults to 6.
+    ```selection```
+        How to pick a node, either ```round_robin``` (the default) or
+        ```least_outstanding```, which picks the node with the fewest
+        requests in flight.
+    ```bulk```
+        Use the bulk API. Documents are buffered, and sent when either
+        ```documents``` documents (default 500) or ```bytes``` bytes
+        (default 5MiB) are buffered, or when the oldest buffered document is
+        ```linger``` seconds old (default 1). Documents that fail are retried
+        up to ```retries``` times (default 3), unless elasticsearch rejected
+        them outright. Up to ```concurrency``` bulk requests (default 1) are
+        in flight at the same time, each with a ```timeout``` (default 30
+        seconds). Set to ```true``` to use the defaults.
+
+        With ```adaptive``` enabled, the number of documents per request and
+        the number of requests in flight follow what the cluster can take.
+        They grow while requests finish within ```target_latency``` seconds
+        (default 1), up to ```max_documents``` (default 5000) and
+        ```max_concurrency``` (default 8). They're cut back when requests
+        are slower than that, and halved when elasticsearch rejects
+        documents because it's overloaded, down to ```min_documents```
+        (default 50). Sending backs off after rejections, with or without
+        ```adaptive```.
+
+        With a ```spool```, documents are spooled to disk while backing off,
+        and when they've run out of retries.
+
+    Example:
+
+    .. code:: yaml
+
+        elasticsearch:
+            url:
+            - http://es1:9200/
+            - http://es2:9200/
+            bulk:
+                documents: 1000
+                linger: 0.5
+                concurrency: 4
     """
 
     index = parameters.get('index', 'logshipper-{timestamp:%Y.%m.%d}')
@@ -76,35 +142,377 @@ def prepare_elasticsearch_http(parameters):
     doctype = parameters.get('doctype', 'log')
     timestamp_field = parameters.get('timestamp', '@timestamp')
 
+    sort_keys = to_bool(parameters.get('sort_keys', False))
+
     if 'document' in parameters:
         document_template = logshipper.context.prepare_template(
             parameters['document']).interpolate
-    elif timestamp_field != 'timestamp':
-        def document_template(context):
-            result = dict(context.message)
-            result[timestamp_field] = result.pop("timestamp")
-            return result
+
+        def serialize(context, encode=None):
+            encode = encode or logshipper.serialize.dumps
+            return encode(document_template(context), sort_keys)
     else:
-        document_template = lambda context: dict(context.message)
+        def serialize(context, encode=None):
+            return logshipper.serialize.serialize_message(
+                context, sort_keys, timestamp_field, encode)
 
-    sort_keys = to_bool(parameters.get('sort_keys', False))
+    def document_id(context, document):
+        if id_:
+            return id_(context)
+
+        # Hash the same JSON on every host, whichever encoder is installed
+        canonical = logshipper.serialize.dumps_canonical
+        if logshipper.serialize.dumps is not canonical:
+            document = serialize(context, canonical)
+        return md5_hash(document)
+
+    urls = parameters.get('url', "http://localhost:9200/")
+    if isinstance(urls, six.string_types):
+        urls = [urls]
+    nodes = NodePool(urls, parameters.get('selection', 'round_robin'),
+                     float(parameters.get('eviction', 30)))
 
-    base_url = parameters.get('url', "http://localhost:9200/")
-    if not base_url.endswith("/"):
-        base_url += "/"
+    bulk = parameters.get('bulk')
+    bulk_parameters = dict(BULK_DEFAULTS)
+    if isinstance(bulk, dict):
+        bulk_parameters.update(bulk)
 
+    if to_bool(bulk_parameters.pop('adaptive')):
+        limits = AdaptiveLimits(
+            documents=int(bulk_parameters.pop('documents')),
+            concurrency=int(bulk_parameters.pop('concurrency')),
+            min_documents=int(bulk_parameters.pop('min_documents')),
+            max_documents=int(bulk_parameters.pop('max_documents')),
+            max_concurrency=int(bulk_parameters.pop('max_concurrency')),
+            target_latency=float(bulk_parameters.pop('target_latency')))
+    else:
+        documents = int(bulk_parameters.pop('documents'))
+        concurrency = int(bulk_parameters.pop('concurrency'))
+        limits = AdaptiveLimits(documents, concurrency,
+                                documents, documents,
+                                concurrency, None)
+        for key in ('min_documents', 'max_documents', 'max_concurrency',
+                    'target_latency'):
+            bulk_parameters.pop(key)
+
+    # In bulk mode, keep a connection alive for every request that can be in
+    # flight. Otherwise requests come from the pipeline's greenthreads, so
+    # keep the requests default.
     session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=len(urls),
+        pool_maxsize=(limits.max_concurrency if bulk
+                      else requests.adapters.DEFAULT_POOLSIZE))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    compress = logshipper.compression.prepare_compressor(
+        parameters.get('compression'),
+        parameters.get('compression_level', 6))
+
+    if compress:
+        session.headers['Content-Encoding'] = compress.encoding
+
+    if bulk:
+        sender = BulkSender(session, nodes, limits, compress,
+                            **bulk_parameters)
+
+        def handle_elasticsearch_bulk(message, context):
+            document = serialize(context)
+
+            action = logshipper.serialize.dumps({"index": {
+                "_index": index.interpolate(context),
+                "_type": doctype,
+                "_id": document_id(context, document),
+            }}, sort_keys=True)
+
+            sender.add(action, document)
+
+        def handle_elasticsearch_bulk_batch(contexts):
+            for context in contexts:
+                handle_elasticsearch_bulk(context.message, context)
+
+        handle_elasticsearch_bulk.handle_batch = \
+            handle_elasticsearch_bulk_batch
+        handle_elasticsearch_bulk.flush = sender.flush
+        handle_elasticsearch_bulk.set_overflow = sender.set_overflow
+        handle_elasticsearch_bulk.saturated = sender.saturated
+        handle_elasticsearch_bulk.replay = sender.replay
+        return handle_elasticsearch_bulk
 
     def handle_elasticsearch_http(message, context):
-        document = document_template(context)
+        document = serialize(context)
 
-        document = json.dumps(document, default=json_default,
-                              sort_keys=sort_keys).encode('utf8')
+        node = nodes.acquire()
+        url = "%s%s/%s/%s" % (node.url, index.interpolate(context), doctype,
+                              document_id(context, document))
 
-        url = "%s%s/%s/%s" % (base_url, index.interpolate(context), doctype,
-                              id_(context) if id_ else md5_hash(document))
+        try:
+            result = session.put(url, data=compress(document) if compress
+                                 else document)
+        except requests.RequestException:
+            nodes.release(node, failed=True)
+            raise
 
-        result = session.put(url, data=document)
+        nodes.release(node, failed=result.status_code >= 500)
         result.raise_for_status()
 
     return handle_elasticsearch_http
+
+
+class Node(object):
+    __slots__ = ['url', 'outstanding', 'evicted_until']
+
+    def __init__(self, url):
+        self.url = url if url.endswith("/") else url + "/"
+        self.outstanding = 0
+        self.evicted_until = 0
+
+
+class NodePool(object):
+    """Spreads requests over elasticsearch nodes, skipping failed ones."""
+
+    def __init__(self, urls, selection='round_robin', eviction=30):
+        if selection not in ('round_robin', 'least_outstanding'):
+            raise ValueError("selection should be either round_robin or "
+                             "least_outstanding")
+
+        self.nodes = [Node(url) for url in urls]
+        self.selection = selection
+        self.eviction = eviction
+        self.position = 0
+
+    def acquire(self):
+        now = time.time()
+        available = [node for node in self.nodes if node.evicted_until <= now]
+
+        if not available:
+            # Everything failed recently, try whichever was evicted first
+            node = min(self.nodes, key=lambda node: node.evicted_until)
+        elif self.selection == 'least_outstanding':
+            node = min(available, key=lambda node: node.outstanding)
+        else:
+            self.position += 1
+            node = available[self.position % len(available)]
+
+        node.outstanding += 1
+        return node
+
+    def release(self, node, failed=False):
+        node.outstanding -= 1
+        if failed:
+            LOG.warning("Elasticsearch node %s failed, evicting it for %is",
+                        node.url, self.eviction)
+            node.evicted_until = time.time() + self.eviction
+
+
+class AdaptiveLimits(object):
+    """Adjusts the batch size and concurrency of bulk requests (AIMD).
+
+    Both grow additively while requests finish within the target latency,
+    and shrink multiplicatively when requests are slow, or when the cluster
+    rejects documents. Without a target latency, only rejections count.
+    """
+
+    def __init__(self, documents, concurrency, min_documents, max_documents,
+                 max_concurrency, target_latency):
+        self.min_documents = min_documents
+        self.max_documents = max(max_documents, min_documents)
+        self.documents = min(max(documents, min_documents),
+                             self.max_documents)
+        self.max_concurrency = max(max_concurrency, concurrency)
+        self.concurrency = concurrency
+        self.target_latency = target_latency
+        self.step = max(1, min_documents)
+
+    def success(self, latency):
+        if self.target_latency is None:
+            return
+
+        if latency > self.target_latency:
+            self.documents = max(self.min_documents,
+                                 int(self.documents * 0.8))
+        elif self.documents < self.max_documents:
+            self.documents = min(self.max_documents,
+                                 self.documents + self.step)
+        elif self.concurrency < self.max_concurrency:
+            # Only add requests once the batches are as large as allowed
+            self.concurrency += 1
+
+    def rejected(self):
+        if self.target_latency is None:
+            return
+
+        self.documents = max(self.min_documents, self.documents // 2)
+        self.concurrency = max(1, self.concurrency // 2)
+
+
+class BulkSender(object):
+    """Buffers documents, and sends them using the bulk API."""
+
+    def __init__(self, session, nodes, limits, compress, bytes, linger,
+                 retries, timeout):
+        self.session = session
+        self.nodes = nodes
+        self.limits = limits
+        self.compress = compress
+        self.max_bytes = int(bytes)
+        self.linger = float(linger)
+        self.retries = int(retries)
+        self.timeout = float(timeout)
+        self.pool = eventlet.greenpool.GreenPool(limits.concurrency)
+
+        self.items = []
+        self.size = 0
+        self.timer = None
+        self.backoff = 0
+        self.backoff_until = 0
+        self.overflow = None
+
+    def set_overflow(self, overflow):
+        """Hands documents that can't be sent to ``overflow`` (e.g. a spool)
+
+        Rather than buffering them in memory, documents are handed over while
+        backing off, and instead of dropping them after ``retries``.
+        """
+        self.overflow = overflow
+
+    def saturated(self):
+        return self.backoff_until > time.time()
+
+    def replay(self, item):
+        self.add(*item)
+
+    def add(self, action, document):
+        if self.overflow is not None and self.saturated():
+            self.overflow((action, document))
+            return
+
+        self.buffer((action, document, 0))
+
+        if (len(self.items) >= self.limits.documents or
+                self.size >= self.max_bytes):
+            self.send_buffer()
+
+    def buffer(self, item):
+        self.items.append(item)
+        self.size += len(item[0]) + len(item[1]) + 2
+
+        if self.timer is None:
+            self.timer = eventlet.spawn_after(self.linger, self.send_buffer)
+
+    def send_buffer(self):
+        """Sends the buffered documents in the background.
+
+        Blocks while ``concurrency`` requests are already in flight.
+        """
+        timer, self.timer = self.timer, None
+        if timer is not None:
+            # Doesn't affect the timer when it's the one calling us
+            timer.cancel()
+
+        items, self.items, self.size = self.items, [], 0
+        if items:
+            self.pool.spawn_n(self.send, items)
+
+    def flush(self):
+        """Sends all buffered documents, including the ones to retry."""
+        while self.items or self.pool.running():
+            self.send_buffer()
+            self.pool.waitall()
+
+    def send(self, items):
+        delay = self.backoff_until - time.time()
+        if delay > 0 and self.overflow is not None:
+            # Still backing off, the documents go to the spool instead
+            self.retry(items)
+            return
+
+        body = []
+        for (action, document, _) in items:
+            body.extend((action, b"\n", document, b"\n"))
+        body = b"".join(body)
+        if self.compress:
+            body = self.compress(body)
+
+        if delay > 0:
+            eventlet.sleep(delay)
+
+        node = self.nodes.acquire()
+        failed = True
+        start_time = time.time()
+        try:
+            response = self.session.post(
+                node.url + "_bulk", data=body, timeout=self.timeout,
+                headers={"Content-Type": "application/x-ndjson"})
+            failed = response.status_code >= 500
+            if response.status_code == 429:
+                LOG.warning("Elasticsearch rejected a bulk request with %i "
+                            "documents, backing off", len(items))
+                self.rejected(items)
+                return
+            response.raise_for_status()
+            result = response.json()
+        except Exception:
+            LOG.exception("Bulk request with %i documents to %s failed",
+                          len(items), node.url)
+            if self.overflow is not None:
+                # Don't hammer a failing cluster, the spool holds the rest
+                self.back_off()
+            self.retry(items)
+            return
+        finally:
+            self.nodes.release(node, failed)
+
+        failed = []
+        rejected = []
+        if result.get('errors'):
+            for item, response_item in zip(items, result['items']):
+                status, error = self.item_status(response_item)
+                if status < 300:
+                    continue
+                elif (status == 429 or
+                        'es_rejected_execution_exception' in str(error)):
+                    rejected.append(item)
+                elif status >= 500:
+                    failed.append(item)
+                else:
+                    LOG.error("Elasticsearch rejected document: %s", error)
+
+        if rejected:
+            self.rejected(rejected)
+        else:
+            self.backoff = 0
+            self.limits.success(time.time() - start_time)
+            self.pool.resize(self.limits.concurrency)
+
+        self.retry(failed)
+
+    @staticmethod
+    def item_status(response_item):
+        # Each item is keyed by its operation type, e.g. {"index": {...}}
+        details = list(response_item.values())[0]
+        return details.get('status', 500), details.get('error')
+
+    def rejected(self, items):
+        """Handles documents the cluster had no capacity for."""
+        self.limits.rejected()
+        self.pool.resize(self.limits.concurrency)
+        self.back_off()
+        self.retry(items)
+
+    def back_off(self):
+        self.backoff = min(MAX_BACKOFF, max(0.1, self.backoff * 2))
+        self.backoff_until = time.time() + self.backoff
+
+    def retry(self, items):
+        # Retried documents go out with the next flush
+        for (action, document, attempt) in items:
+            if self.overflow is not None and (attempt >= self.retries or
+                                              self.saturated()):
+                self.overflow((action, document))
+            elif attempt < self.retries:
+                self.buffer((action, document, attempt + 1))
+            else:
+                LOG.error("Dropping document after %i attempts: %r",
+                          attempt + 1, document[:200])
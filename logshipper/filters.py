@@ -84,34 +84,62 @@ def prepare_match(parameters):
                      [re.compile(regex1) for regex1 in regex]))
         for (fieldname, regex) in parameters.items()]
 
-    def handle_match(message, context):
-        matches = {}
-        last_match = None
-        last_match_key = None
-        for field_name, regex_list in regexes:
-            field_data = message.get(field_name)
-            for regex in regex_list:
-                match = regex.search(field_data)
-                if match:
-                    matches[field_name] = last_match = match
-                    last_match_key = field_name
-                    break
-            else:
+    if len(regexes) == 1 and len(regexes[0][1]) == 1:
+        # The common case of a single regex against a single field
+        ((single_field, (single_regex,)),) = regexes
+        search = single_regex.search
+
+        def handle_match(message, context):
+            match = search(message.get(single_field))
+            if not match:
                 return SKIP_STEP
 
-        for match in matches.values():
             message.update(match.groupdict())
+            context.set_match(single_field, match)
+
+        def handle_match_batch(contexts):
+            results = []
+            for context in contexts:
+                message = context.message
+                match = search(message.get(single_field))
+                if not match:
+                    results.append(SKIP_STEP)
+                    continue
+
+                message.update(match.groupdict())
+                context.set_match(single_field, match)
+                results.append(None)
+            return results
+    else:
+        def handle_match(message, context):
+            matches = {}
+            last_match = None
+            last_match_key = None
+            for field_name, regex_list in regexes:
+                field_data = message.get(field_name)
+                for regex in regex_list:
+                    match = regex.search(field_data)
+                    if match:
+                        matches[field_name] = last_match = match
+                        last_match_key = field_name
+                        break
+                else:
+                    return SKIP_STEP
+
+            for match in matches.values():
+                message.update(match.groupdict())
+
+            if len(matches) == 1:
+                context.set_match(last_match_key, last_match, matches)
+            else:
+                context.matches = matches
 
-        context.matches = matches
-
-        if len(matches) == 1:
-
-            context.match_field = last_match_key
-            context.match = last_match
-            context.backreferences = [context.match.group(0)]
-            context.backreferences.extend(context.match.groups())
+        def handle_match_batch(contexts):
+            return [handle_match(context.message, context)
+                    for context in contexts]
 
     handle_match.phase = PHASE_MATCH
+    handle_match.handle_batch = handle_match_batch
     return handle_match
 
 
@@ -223,6 +251,13 @@ def prepare_set(parameters):
         for fieldname, template in parameters:
             message[fieldname] = template.interpolate(context)
 
+    def handle_set_batch(contexts):
+        for fieldname, template in parameters:
+            interpolate = template.interpolate
+            for context in contexts:
+                context.message[fieldname] = interpolate(context)
+
+    handle_set.handle_batch = handle_set_batch
     return handle_set
 
 
@@ -336,14 +371,32 @@ def prepare_strptime(parameters):
         parse = lambda value: dateutil.parser.parse(
             value, default=datetime.datetime.now())
 
-    def handle_strptime(message, context):
-        value = message[fieldname]
+    def convert(value):
         value = parse(value)
 
         if value.tzinfo:
             value = value.astimezone(pytz.utc).replace(tzinfo=None)
-        message[fieldname] = value
+        return value
 
+    def handle_strptime(message, context):
+        message[fieldname] = convert(message[fieldname])
+
+    def handle_strptime_batch(contexts):
+        # Messages in a burst tend to share their timestamps, so each
+        # distinct value is parsed only once. Nothing is stored until all
+        # values parsed, so that a failing batch can be retried per message.
+        parsed = {}
+        values = []
+        for context in contexts:
+            value = context.message[fieldname]
+            if value not in parsed:
+                parsed[value] = convert(value)
+            values.append(parsed[value])
+
+        for context, value in zip(contexts, values):
+            context.message[fieldname] = value
+
+    handle_strptime.handle_batch = handle_strptime_batch
     return handle_strptime
 
 
@@ -0,0 +1,223 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""A process-wide inotify hub.
+
+All inputs share a single inotify instance. The kernel keys watches by
+inode, so several subscribers watching the same file share a single inotify
+watch, which is reference counted by its watch descriptor. A path that was
+rotated refers to a new inode, and gets a watch of its own. The hub waits for
+the inotify descriptor to become readable through the eventlet hub, so it
+doesn't consume CPU while idle.
+
+Events are not handled by the hub itself. Each subscriber owns a
+:class:`Watcher`, which handles its events in its own greenthread. That way a
+subscriber which blocks (e.g. on backpressure) doesn't delay the others.
+While a subscriber is blocked, repeated events (e.g. a file being modified
+over and over) are coalesced, so its backlog doesn't grow with the write rate.
+"""
+
+import collections
+import logging
+
+import eventlet
+import eventlet.event
+import pyinotify
+
+import logshipper.pyinotify_eventlet_notifier
+
+LOG = logging.getLogger(__name__)
+
+_HUB = None
+
+
+def get_hub():
+    """Returns the process-wide hub, creating it when needed"""
+    global _HUB
+    if _HUB is None:
+        _HUB = Hub()
+    return _HUB
+
+
+class Subscription(object):
+    __slots__ = ('path', 'mask', 'callback', 'queue', 'wd')
+
+    def __init__(self, path, mask, callback, queue, wd):
+        self.path = path
+        self.mask = mask
+        self.callback = callback
+        self.queue = queue
+        self.wd = wd
+
+
+class Hub(object):
+    def __init__(self):
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = logshipper.pyinotify_eventlet_notifier.Notifier(
+            self.watch_manager, default_proc_fun=self._unknown_event)
+        self.subscriptions = {}  # watch descriptor -> [Subscription]
+        self.thread = None
+
+    def add_watch(self, path, mask, callback, queue):
+        """Subscribes to events on path.
+
+        Events matching mask are put on queue (see :class:`EventQueue`) as
+        (callback, event) tuples.
+        Returns the subscription, or None when the watch couldn't be added
+        (e.g. because the inotify watch limit was reached).
+        """
+
+        # Always ask the kernel, the path may refer to another inode than
+        # when it was watched before. IN_MASK_ADD extends the mask of a
+        # watch other subscribers already have on the inode.
+        wd = self.watch_manager.add_watch(
+            path, mask | pyinotify.IN_MASK_ADD,
+            proc_fun=self._dispatch).get(path, -1)
+        if wd < 0:
+            return None
+
+        subscription = Subscription(path, mask, callback, queue, wd)
+        self.subscriptions.setdefault(wd, []).append(subscription)
+
+        if self.thread is None:
+            self.thread = eventlet.spawn(self._run)
+
+        return subscription
+
+    def rm_watch(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.wd)
+        if not subscriptions or subscription not in subscriptions:
+            return  # The watch was already removed by the kernel
+
+        # The kernel mask isn't narrowed, _dispatch filters by subscription
+        subscriptions.remove(subscription)
+        if not subscriptions:
+            del self.subscriptions[subscription.wd]
+            self.watch_manager.rm_watch(subscription.wd)
+
+    def _dispatch(self, event):
+        subscriptions = self.subscriptions.get(event.wd)
+        if not subscriptions:
+            return
+
+        if event.mask & pyinotify.IN_IGNORED:
+            # The kernel removed the watch, e.g. because the path was deleted
+            del self.subscriptions[event.wd]
+            return
+
+        for subscription in subscriptions:
+            if event.mask & subscription.mask:
+                subscription.queue.put((subscription.callback, event))
+
+    def _unknown_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            LOG.warning("Inotify queue overflowed, events were lost")
+
+    def _run(self):
+        notifier = self.notifier
+        while True:
+            try:
+                notifier.check_events()
+                notifier.read_events()
+                notifier.process_events()
+            except Exception:  # pragma: nocover
+                LOG.exception("Unable to process inotify events")
+                eventlet.sleep(1)
+
+
+class EventQueue(object):
+    """Queues (callback, event) tuples, coalescing repeated events.
+
+    An event is dropped when the last queued event for the same callback and
+    path has the same mask, as handling it again wouldn't tell anything new.
+    Events of other types still queue up, to keep e.g. a delete and a
+    re-create in order.
+    """
+
+    def __init__(self):
+        self.items = collections.deque()
+        self.last = {}  # (callback, pathname) -> last queued item
+        self.waiter = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        callback, event = item
+        key = (callback, event.pathname)
+        last = self.last.get(key)
+        if last is not None and last[1].mask == event.mask:
+            return
+
+        self.last[key] = item
+        self.items.append(item)
+
+        if self.waiter is not None:
+            waiter, self.waiter = self.waiter, None
+            waiter.send()
+
+    def get(self):
+        while not self.items:
+            if self.waiter is None:
+                self.waiter = eventlet.event.Event()
+            self.waiter.wait()
+
+        item = self.items.popleft()
+        key = (item[0], item[1].pathname)
+        if self.last.get(key) is item:
+            del self.last[key]
+        return item
+
+    def clear(self):
+        self.items.clear()
+        self.last.clear()
+
+
+class Watcher(object):
+    """The watches of a single subscriber.
+
+    Events are handled when :meth:`loop` runs, in the caller's greenthread.
+    """
+
+    def __init__(self, hub=None):
+        self.hub = hub or get_hub()
+        self.events = EventQueue()
+        self.subscriptions = set()
+
+    def add_watch(self, path, mask, callback):
+        """Returns a handle for rm_watch, or None if the watch failed"""
+        subscription = self.hub.add_watch(path, mask, callback, self.events)
+        if subscription is not None:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def rm_watch(self, subscription):
+        self.subscriptions.discard(subscription)
+        self.hub.rm_watch(subscription)
+
+    def close(self):
+        for subscription in list(self.subscriptions):
+            self.rm_watch(subscription)
+
+        # Drop events which arrived before the watches were removed
+        self.events.clear()
+
+    def loop(self):
+        while True:
+            callback, event = self.events.get()
+            try:
+                callback(event)
+            except Exception:
+                LOG.exception("Unable to handle inotify event %r", event)
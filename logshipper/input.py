@@ -26,28 +26,104 @@ from eventlet.green import time
 import eventlet.tpool
 import six
 
+import logshipper.message
+import logshipper.multiline
+
 
 LOG = logging.getLogger(__name__)
 
+HOSTNAME_TTL = 60
+_hostname = (None, 0)
+
+
+def get_hostname():
+    """Returns the hostname, looking it up at most once a minute"""
+    global _hostname
+    hostname, expires = _hostname
+    now = time.time()
+    if now >= expires:
+        hostname = six.moves.intern(socket.gethostname())
+        _hostname = (hostname, now + HOSTNAME_TTL)
+    return hostname
+
 
 class BaseInput(object):
     handler = None
+    batch_handler = None
+    multiline = None
+    compact = False
     should_run = False
     thread = None
 
-    def set_handler(self, handler):
+    def set_handler(self, handler, batch_handler=None):
         self.handler = handler
+        self.batch_handler = batch_handler
+
+    def set_multiline(self, parameters):
+        """Joins lines into multiline messages, see ``multiline.Assembler``"""
+        self.multiline = logshipper.multiline.prepare_multiline(
+            self._emit_many, parameters)
+
+    def set_compact(self, compact):
+        """Emits ``message.Record`` objects rather than dicts"""
+        self.compact = bool(compact)
+
+    def flush_multiline(self, source=None):
+        if self.multiline:
+            self.multiline.flush(source)
+
+    def emit(self, message, source=None):
+        """Emits a message.
+
+        ``source`` identifies where the message was read (e.g. a file), so
+        multiline messages are only assembled from lines of the same source.
+        """
+        if self.multiline:
+            self.multiline.feed([message], source)
+            return
 
-    def emit(self, message):
         message.setdefault('timestamp', datetime.datetime.utcnow())
-        message.setdefault('hostname', socket.gethostname())
+        message.setdefault('hostname', get_hostname())
 
         assert six.PY3 or isinstance(message['message'], six.text_type)
         assert isinstance(message['timestamp'], datetime.datetime)
         assert message['timestamp'].tzinfo is None
 
+        if self.compact:
+            message = logshipper.message.Record(message)
         self.handler(message)
 
+    def emit_many(self, messages, source=None):
+        """Emits a list of messages at once.
+
+        When a batch handler was set, the whole list is passed in a single
+        call. Messages without a timestamp share the time of emission.
+        """
+        if self.multiline:
+            self.multiline.feed(messages, source)
+        else:
+            self._emit_many(messages)
+
+    def _emit_many(self, messages):
+        if not messages:
+            return
+
+        timestamp = datetime.datetime.utcnow()
+        hostname = get_hostname()
+        for message in messages:
+            message.setdefault('timestamp', timestamp)
+            message.setdefault('hostname', hostname)
+
+        if self.compact:
+            messages = [logshipper.message.Record(message)
+                        for message in messages]
+
+        if self.batch_handler:
+            self.batch_handler(messages)
+        else:
+            for message in messages:
+                self.handler(message)
+
     def start(self):
         self.should_run = True
         if self.thread is None:
@@ -60,6 +136,9 @@ class BaseInput(object):
             thread.kill()
         self.thread = None
 
+        if self.multiline:
+            self.multiline.flush_all()
+
     def _run(self):
         try:
             self.run()
@@ -132,16 +211,16 @@ class Command(BaseInput):
             self.process.stdin.close()
 
             if self.separator == '\n':
-                def process_pipe(pipe):
+                def process_pipe(pipe, source):
                     while not pipe.closed:
                         line = pipe.readline()
                         if not line:
                             break
 
                         line = line.decode('utf8')
-                        self.emit({"message": line.rstrip('\n')})
+                        self.emit({"message": line.rstrip('\n')}, source)
             else:
-                def process_pipe(pipe):
+                def process_pipe(pipe, source):
                     buf = u""
                     for chunk in codecs.iterdecode(pipe, 'utf8'):
                         buf += chunk
@@ -149,18 +228,22 @@ class Command(BaseInput):
                         buf = messages[-1]
                         messages = messages[:-1]
                         for message in messages:
-                            self.emit({"message": message})
+                            self.emit({"message": message}, source)
                     if buf:
-                        self.emit({"message": buf})
+                        self.emit({"message": buf}, source)
 
-            stdout_thread = eventlet.spawn(process_pipe, self.process.stdout)
-            stderr_thread = eventlet.spawn(process_pipe, self.process.stderr)
+            stdout_thread = eventlet.spawn(process_pipe, self.process.stdout,
+                                           'stdout')
+            stderr_thread = eventlet.spawn(process_pipe, self.process.stderr,
+                                           'stderr')
 
             self.process.wait()
             self.process = None
 
             stdout_thread.wait()
             stderr_thread.wait()
+            self.flush_multiline('stdout')
+            self.flush_multiline('stderr')
 
             took = time.time() - start_time
             time.sleep(self.interval - took)
@@ -262,15 +345,38 @@ class Syslog(BaseInput):
         eventlet.serve(self.server, self.handle)
 
     def handle(self, sock, address):
-        LOG.info("Accepted syslog connection from %r", address[0])
-        fileobj = sock.makefile('r')
+        peer = address[0]
+        LOG.info("Accepted syslog connection from %r", peer)
+
+        # Multiline messages are assembled per connection
+        source = address
 
-        for line in fileobj:
-            self.process_message(line.decode('utf8'), address[0])
+        buff = b""
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
 
-        LOG.info("%r closed connection to syslog", address[0])
+            lines = (buff + data).split(b"\n")
+            buff = lines.pop()
 
-    def process_message(self, line, peer):
+            messages = [self.parse_message(line.decode('utf8'), peer)
+                        for line in lines]
+            self.emit_many([message for message in messages if message],
+                           source)
+
+        if buff:
+            self.process_message(buff.decode('utf8'), peer, source)
+        self.flush_multiline(source)
+
+        LOG.info("%r closed connection to syslog", peer)
+
+    def process_message(self, line, peer, source=None):
+        message = self.parse_message(line, peer)
+        if message:
+            self.emit(message, source)
+
+    def parse_message(self, line, peer):
         line = line.rstrip('\r\n')
 
         for regex in self.regexes:
@@ -317,8 +423,6 @@ class Syslog(BaseInput):
                 message['timestamp'] = timestamp
 
             message['message'] = line[match.end():]
-
-            self.emit(message)
-            return
+            return message
 
         LOG.warning("dropping message, not RFC compliant")
@@ -0,0 +1,338 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Message types which behave like a dict, but are cheaper in some way.
+
+A :class:`Message` can be forked in constant time. Forks share the message as
+it was at the time of the fork, and keep their own changes in a small
+overlay. The full dict is only assembled when it's needed, typically when an
+output serializes the message.
+
+A :class:`Record` is a compact representation of a message, for when many
+messages are in flight.
+"""
+
+import datetime
+
+import six
+
+try:
+    import collections.abc as collections_abc
+except ImportError:  # pragma: nocover
+    import collections as collections_abc
+
+_DELETED = object()
+_MISSING = object()
+
+# Forks nested deeper than this are flattened, to keep lookups cheap
+MAX_DEPTH = 8
+
+EPOCH = datetime.datetime(1970, 1, 1)
+CORE_FIELDS = ('message', 'hostname', 'timestamp')
+INTERNED_FIELDS = frozenset(['hostname', 'facility', 'severity'])
+
+
+class Message(collections_abc.MutableMapping):
+    """A mutable mapping with O(1) forks.
+
+    Changes are written to ``_changes``, on top of ``_layers``: a tuple of
+    dicts shared with other forks, which are never modified. ``data`` is used
+    as is, so the caller shouldn't modify it afterwards.
+    """
+
+    __slots__ = ('_layers', '_changes')
+
+    def __init__(self, data=None):
+        self._layers = ()
+        self._changes = {} if data is None else data
+
+    def _lookup(self, key):
+        value = self._changes.get(key, _MISSING)
+        if value is _MISSING:
+            for layer in self._layers:
+                value = layer.get(key, _MISSING)
+                if value is not _MISSING:
+                    break
+        return value
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING or value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING or value is _DELETED:
+            return default
+        return value
+
+    def __contains__(self, key):
+        value = self._lookup(key)
+        return value is not _MISSING and value is not _DELETED
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self._layers:
+            self._changes[key] = _DELETED
+        else:
+            del self._changes[key]
+
+    def __iter__(self):
+        return iter(self.as_dict())
+
+    def __len__(self):
+        return len(self.as_dict())
+
+    def __repr__(self):
+        return "Message(%r)" % (self.as_dict(),)
+
+    def __reduce__(self):
+        return (Message, (dict(self.as_dict()),))
+
+    def as_dict(self):
+        """Returns the message as a plain dict.
+
+        The result is only valid until the message is modified again, and
+        should not be modified itself.
+        """
+        layers = self._layers
+        if not layers:
+            return self._changes
+        if len(layers) == 1 and not self._changes:
+            return layers[0]  # Unmodified fork, no need to copy
+
+        # Only the bottom layer is complete, the layers on top of it are
+        # small sets of changes, which may include deletions.
+        merged = dict(layers[-1])
+        for changes in reversed((self._changes,) + layers[:-1]):
+            for key, value in changes.items():
+                if value is _DELETED:
+                    merged.pop(key, None)
+                else:
+                    merged[key] = value
+
+        self._layers = ()
+        self._changes = merged
+        return merged
+
+    def fork(self):
+        """Returns a copy, unaffected by further changes to either message"""
+        changes = self._changes
+        if changes:
+            if len(self._layers) >= MAX_DEPTH:
+                changes = self.as_dict()
+            # The current changes become a shared layer
+            self._layers = (changes,) + self._layers
+            self._changes = {}
+
+        result = Message.__new__(Message)
+        result._layers = self._layers
+        result._changes = {}
+        return result
+
+    copy = fork
+
+
+def timestamp_to_micros(timestamp):
+    """Returns a naive (UTC) datetime as microseconds since the epoch"""
+    delta = timestamp - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000 +
+            delta.microseconds)
+
+
+def micros_to_timestamp(micros):
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+class Record(collections_abc.MutableMapping):
+    """A compact message.
+
+    The core fields are stored in slots, any other fields in ``_extra``,
+    which is only allocated when needed. The timestamp is kept as an integer
+    number of microseconds since the epoch, until something reads it as a
+    datetime. Strings that tend to repeat between messages (such as
+    the hostname) are interned.
+
+    Inputs emit records rather than dicts when configured with ``compact``:
+
+    .. code:: yaml
+
+        inputs:
+        - syslog:
+            compact: true
+
+    ``data`` is used as is, so the caller shouldn't modify it afterwards.
+    """
+
+    __slots__ = ('_message', '_hostname', '_timestamp', '_extra')
+
+    def __init__(self, data=None):
+        self._message = self._hostname = self._timestamp = _MISSING
+        self._extra = None
+
+        if data:
+            for key in CORE_FIELDS:
+                value = data.pop(key, _MISSING)
+                if value is not _MISSING:
+                    self[key] = value
+            if data:
+                # A new dict, as dicts don't shrink when items are removed.
+                # Copying a dict as a whole would copy its size as well.
+                self._extra = dict(data.items())
+                for key in INTERNED_FIELDS:
+                    value = self._extra.get(key)
+                    if type(value) is str:
+                        self._extra[key] = six.moves.intern(value)
+
+    def __getitem__(self, key):
+        if key == 'message':
+            value = self._message
+        elif key == 'timestamp' and self._timestamp is not _MISSING:
+            value = self._timestamp
+            if isinstance(value, six.integer_types):
+                # Something needs the datetime, keep it from now on
+                value = self._timestamp = micros_to_timestamp(value)
+        elif key == 'hostname':
+            value = self._hostname
+        elif self._extra is not None:
+            value = self._extra.get(key, _MISSING)
+        else:
+            value = _MISSING
+
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in INTERNED_FIELDS and type(value) is str:
+            value = six.moves.intern(value)
+
+        if key == 'message':
+            self._message = value
+        elif key == 'hostname':
+            self._hostname = value
+        elif key == 'timestamp':
+            if (isinstance(value, datetime.datetime) and
+                    value.tzinfo is None):
+                value = timestamp_to_micros(value)
+            elif isinstance(value, six.integer_types):
+                # Keep ints apart from the ones representing datetimes
+                self._timestamp = _MISSING
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
+                return
+            self._timestamp = value
+            if self._extra:
+                self._extra.pop(key, None)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        if key == 'message':
+            self._message = _MISSING
+        elif key == 'hostname':
+            self._hostname = _MISSING
+        elif key == 'timestamp' and self._timestamp is not _MISSING:
+            self._timestamp = _MISSING
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        # Checks the slots directly, so the timestamp isn't converted
+        if key == 'message':
+            return self._message is not _MISSING
+        elif key == 'timestamp' and self._timestamp is not _MISSING:
+            return True
+        elif key == 'hostname':
+            return self._hostname is not _MISSING
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        if self._message is not _MISSING:
+            yield 'message'
+        if self._hostname is not _MISSING:
+            yield 'hostname'
+        if self._timestamp is not _MISSING:
+            yield 'timestamp'
+        if self._extra:
+            for key in list(self._extra):
+                yield key
+
+    def __len__(self):
+        return ((self._message is not _MISSING) +
+                (self._hostname is not _MISSING) +
+                (self._timestamp is not _MISSING) +
+                len(self._extra or ()))
+
+    def __repr__(self):
+        return "Record(%r)" % (self.as_dict(),)
+
+    def __reduce__(self):
+        return (Record, (self.as_dict(),))
+
+    def as_dict(self):
+        """Returns a new dict with the fields of the record"""
+        result = {}
+        if self._message is not _MISSING:
+            result['message'] = self._message
+        if self._hostname is not _MISSING:
+            result['hostname'] = self._hostname
+        if self._timestamp is not _MISSING:
+            result['timestamp'] = self['timestamp']
+        if self._extra:
+            result.update(self._extra)
+        return result
+
+    def fork(self):
+        result = Record.__new__(Record)
+        result._message = self._message
+        result._hostname = self._hostname
+        result._timestamp = self._timestamp
+        result._extra = dict(self._extra) if self._extra else None
+        return result
+
+    copy = fork
+
+
+def fork(message):
+    """Returns a copy of message, which is unaffected by further changes"""
+    if type(message) is dict:
+        return dict(message)
+    return message.fork()
+
+
+def shareable(message):
+    """Returns message in a form that can be forked cheaply"""
+    if type(message) is dict:
+        return Message(message)
+    return message
+
+
+def as_dict(message):
+    """Returns message as a dict, see ``Message.as_dict``"""
+    if type(message) is dict:
+        return message
+    return message.as_dict()
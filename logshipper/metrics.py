@@ -0,0 +1,194 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import math
+import random
+
+import eventlet
+from eventlet.green import socket
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MTU = 1432
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+# Percentiles are estimated from a uniform sample of at most this many timings
+RESERVOIR_SIZE = 1024
+
+AGGREGATORS = {}
+
+
+def format_value(value):
+    return "%.10g" % value
+
+
+def gauge_lines(name, value):
+    """Lines which set a gauge to value.
+
+    statsd takes a signed value as a delta, so a negative gauge is set to
+    zero first.
+    """
+    if value < 0:
+        yield "%s:0|g" % name
+    yield "%s:%s|g" % (name, format_value(value))
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an ordered list"""
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+class TimerStats(object):
+    """Streaming aggregates of a timer, in constant memory.
+
+    Count, sum, min and max are exact. Percentiles come from a reservoir
+    sample of the values, so they're exact up to ``RESERVOIR_SIZE`` values,
+    and estimates beyond that.
+    """
+
+    __slots__ = ('count', 'total', 'min', 'max', 'reservoir')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.reservoir = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if len(self.reservoir) < RESERVOIR_SIZE:
+            self.reservoir.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < RESERVOIR_SIZE:
+                self.reservoir[index] = value
+
+
+class Aggregator(object):
+    """Aggregates statsd metrics in-process, and sends them periodically.
+
+    Counters are summed, gauges keep their last value (or the sum of their
+    deltas), and timers are reduced to their count, min, max, mean and
+    percentiles (see ``TimerStats``). Every ``interval`` seconds, the
+    aggregates are sent in as few packets as possible, each at most ``mtu``
+    bytes.
+    """
+
+    def __init__(self, host, port, interval, mtu=DEFAULT_MTU,
+                 percentiles=DEFAULT_PERCENTILES):
+        self.address = (host, port)
+        self.interval = interval
+        self.mtu = mtu
+        self.percentiles = percentiles
+
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_deltas = {}
+        self.timers = {}
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.thread = None
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.ensure_thread()
+
+    def gauge(self, name, value, delta=False):
+        if delta:
+            self.gauge_deltas[name] = self.gauge_deltas.get(name, 0) + value
+        else:
+            self.gauges[name] = value
+        self.ensure_thread()
+
+    def timing(self, name, value):
+        stats = self.timers.get(name)
+        if stats is None:
+            stats = self.timers[name] = TimerStats()
+        stats.add(value)
+        self.ensure_thread()
+
+    def ensure_thread(self):
+        if self.thread is None:
+            self.thread = eventlet.spawn_after(self.interval, self._run)
+
+    def _run(self):
+        self.thread = None
+        try:
+            self.flush()
+        except Exception:
+            LOG.exception("Unable to send statsd metrics")
+
+    def lines(self):
+        counters, self.counters = self.counters, {}
+        gauges, self.gauges = self.gauges, {}
+        gauge_deltas, self.gauge_deltas = self.gauge_deltas, {}
+        timers, self.timers = self.timers, {}
+
+        for name, value in counters.items():
+            yield "%s:%s|c" % (name, format_value(value))
+
+        for name, value in gauges.items():
+            for line in gauge_lines(name, value):
+                yield line
+
+        for name, value in gauge_deltas.items():
+            yield "%s:%s%s|g" % (name, "+" if value >= 0 else "",
+                                 format_value(value))
+
+        for name, stats in timers.items():
+            values = sorted(stats.reservoir)
+            yield "%s.count:%i|c" % (name, stats.count)
+
+            aggregates = [("min", stats.min), ("max", stats.max),
+                          ("mean", stats.total / stats.count)]
+            aggregates.extend(("p%s" % pct, percentile(values, pct))
+                              for pct in self.percentiles)
+            for suffix, value in aggregates:
+                for line in gauge_lines("%s.%s" % (name, suffix), value):
+                    yield line
+
+    def flush(self):
+        packet = []
+        size = 0
+        for line in self.lines():
+            line = line.encode('utf8')
+            if packet and size + len(line) + 1 > self.mtu:
+                self.socket.sendto(b"\n".join(packet), self.address)
+                packet = []
+                size = 0
+
+            packet.append(line)
+            size += len(line) + 1
+
+        if packet:
+            self.socket.sendto(b"\n".join(packet), self.address)
+
+
+def get_aggregator(host, port, interval, mtu=DEFAULT_MTU):
+    """Returns an aggregator shared by all outputs with the same settings"""
+    key = (host, port, interval, mtu)
+    aggregator = AGGREGATORS.get(key)
+    if aggregator is None:
+        aggregator = AGGREGATORS[key] = Aggregator(host, port, interval, mtu)
+    return aggregator
@@ -0,0 +1,142 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import re
+
+import eventlet
+
+
+class Assembler(object):
+    """Joins lines which belong to the same event into a single message.
+
+    Any input can assemble multiline messages by adding a ``multiline``
+    parameter. Exactly one of these rules decides which lines continue the
+    previous message:
+
+    ``start``
+        A regex matching the first line of every message. Lines which don't
+        match continue the previous message.
+    ``continuation``
+        A regex matching lines which continue the previous message.
+    ``indent``
+        When true, indented lines continue the previous message.
+
+    The limits on message size are:
+
+    ``max_lines``
+        The maximum number of lines in a message. Defaults to ``500``.
+    ``max_length``
+        The maximum length of a message in characters. Defaults to
+        ``65536``.
+    ``timeout``
+        The number of seconds to wait for more lines, before the last
+        message is emitted. Defaults to ``1``.
+
+    The other fields of a message are taken from its first line.
+
+    Example for ``input.yml``:
+
+    .. code:: yaml
+
+        - tail:
+            filenames: /var/log/my_app/*.log
+            multiline:
+                start: ^\\d{4}-\\d{2}-\\d{2}
+    """
+
+    def __init__(self, emit, start=None, continuation=None, indent=False,
+                 max_lines=500, max_length=65536, timeout=1.0):
+        if len([rule for rule in (start, continuation, indent) if rule]) != 1:
+            raise ValueError("multiline needs exactly one of start, "
+                             "continuation or indent")
+
+        if start:
+            start = re.compile(start)
+            self.is_continuation = lambda line: not start.search(line)
+        elif continuation:
+            continuation = re.compile(continuation)
+            self.is_continuation = lambda line: bool(
+                continuation.search(line))
+        else:
+            self.is_continuation = lambda line: line[:1] in (" ", "\t")
+
+        self.emit = emit
+        self.max_lines = int(max_lines)
+        self.max_length = int(max_length)
+        self.timeout = float(timeout)
+        self.pending = {}
+        self.timers = {}
+
+    def feed(self, messages, source=None):
+        """Adds messages from source, emitting every completed message.
+
+        Lines from different sources (e.g. files) are never joined.
+        """
+        result = []
+        event = self.pending.pop(source, None)
+
+        for message in messages:
+            line = message['message']
+            if (event is not None and self.is_continuation(line) and
+                    len(event[1]) < self.max_lines and
+                    event[2] + len(line) < self.max_length):
+                event[1].append(line)
+                event[2] += len(line) + 1
+                continue
+
+            if event is not None:
+                result.append(self.join(event))
+            event = [message, [line], len(line)]
+
+        timer = self.timers.pop(source, None)
+        if timer is not None:
+            timer.cancel()
+
+        if event is not None:
+            self.pending[source] = event
+            self.timers[source] = eventlet.spawn_after(self.timeout,
+                                                       self.flush, source)
+
+        if result:
+            self.emit(result)
+
+    @staticmethod
+    def join(event):
+        message, lines, _length = event
+        if len(lines) > 1:
+            message = dict(message)
+            message['message'] = u"\n".join(lines)
+        return message
+
+    def flush(self, source=None):
+        """Emits the incomplete message from source, if any"""
+        timer = self.timers.pop(source, None)
+        if timer is not None:
+            timer.cancel()
+
+        event = self.pending.pop(source, None)
+        if event is not None:
+            self.emit([self.join(event)])
+
+    def flush_all(self):
+        for source in list(self.pending):
+            self.flush(source)
+
+
+def prepare_multiline(emit, parameters):
+    if not isinstance(parameters, dict):
+        raise ValueError("multiline parameter should be a mapping")
+
+    return Assembler(emit, **parameters)
@@ -0,0 +1,137 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+
+import eventlet
+import eventlet.event
+import eventlet.queue
+
+LOG = logging.getLogger(__name__)
+
+POLICIES = ('block', 'drop')
+
+
+class QueuedOutput(object):
+    """Runs an output in its own worker greenthreads.
+
+    Any action can be queued by adding a ``queue`` parameter. The pipeline
+    continues as soon as the message is queued, so a slow output no longer
+    adds latency to the rest of the pipeline. As the message and context are
+    copied when queued, later steps can't affect what the output sees.
+
+    ``size``
+        The maximum number of queued messages. Defaults to ``1000``.
+    ``workers``
+        The number of worker greenthreads. Defaults to ``1``.
+    ``policy``
+        What to do when the queue is full. ``block`` (the default) makes the
+        pipeline wait for room in the queue, ``drop`` discards the message.
+        When the output is also spooled, messages that don't fit in the queue
+        are spooled to disk instead.
+
+    Pending messages are delivered when the pipeline stops.
+
+    Example:
+
+    .. code:: yaml
+
+        elasticsearch:
+            url: http://localhost:9200/
+            queue:
+                size: 10000
+                workers: 4
+                policy: drop
+    """
+
+    def __init__(self, handler, size=1000, workers=1, policy='block'):
+        if policy not in POLICIES:
+            raise ValueError("queue policy should be one of %s" %
+                             ", ".join(POLICIES))
+
+        self.handler = handler
+        self.phase = handler.phase
+        self.queue = eventlet.queue.LightQueue(int(size))
+        self.max_workers = int(workers)
+        self.policy = policy
+        self.workers = 0
+        self.unfinished = 0
+        self.dropped = 0
+        self.idle = None
+        self.spill = getattr(handler, 'spill', None)
+
+    def __call__(self, message, context):
+        if self.spill is not None and self.queue.full():
+            self.spill(context)
+            return
+
+        if self.policy == 'drop' and self.queue.full():
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                LOG.warning("Output queue full, %i messages dropped so far",
+                            self.dropped)
+            return
+
+        self.unfinished += 1
+        self.queue.put(context.snapshot())
+
+        if self.workers < self.max_workers:
+            self.workers += 1
+            eventlet.spawn_n(self._work)
+
+    def handle_batch(self, contexts):
+        for context in contexts:
+            self(context.message, context)
+
+    def _work(self):
+        try:
+            while True:
+                try:
+                    context = self.queue.get_nowait()
+                except eventlet.queue.Empty:
+                    return
+
+                try:
+                    self.handler(context.message, context)
+                except Exception:
+                    LOG.exception("Queued output failed")
+                finally:
+                    self.unfinished -= 1
+
+                if not self.unfinished and self.idle:
+                    idle, self.idle = self.idle, None
+                    idle.send()
+        finally:
+            self.workers -= 1
+
+    def flush(self):
+        """Waits until all queued messages have been handled."""
+        while self.unfinished:
+            if self.idle is None:
+                self.idle = eventlet.event.Event()
+            self.idle.wait()
+
+        flush = getattr(self.handler, 'flush', None)
+        if flush:
+            flush()
+
+
+def prepare_queue(handler, parameters):
+    if parameters is True:
+        parameters = {}
+    elif not isinstance(parameters, dict):
+        raise ValueError("queue parameter should be true, or a mapping")
+
+    return QueuedOutput(handler, **parameters)
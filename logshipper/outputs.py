@@ -17,6 +17,10 @@ import six
 
 import logshipper.context
 from logshipper import filters
+import logshipper.message
+import logshipper.metrics
+import logshipper.rabbitmq
+import logshipper.serialize
 
 
 def prepare_rabbitmq(parameters):
@@ -36,8 +40,20 @@ def prepare_rabbitmq(parameters):
         Defaults to ``logshipper``
     key
         The routing key. Defaults to ``logshipper``
+    buffer_size
+        The number of messages buffered while waiting for the broker, after
+        which the pipeline is blocked. Defaults to ``10000``
+    batch_size
+        The maximum number of messages published at once. Defaults to ``100``
+    window
+        The maximum number of messages awaiting a publisher confirm.
+        Defaults to ``1000``
+
+    Messages are published from a separate greenthread, which reconnects when
+    the connection fails. Messages which weren't confirmed are published
+    again, so they may be delivered more than once. With a ``spool``, they're
+    spooled to disk while the connection is down or the buffer is full.
     """
-    import json  # noqa
     import pika  # noqa
 
     conn_parameters = pika.connection.ConnectionParameters(
@@ -48,26 +64,28 @@ def prepare_rabbitmq(parameters):
         port=int(parameters.get('port', 5672))
     )
 
-    connection = pika.adapters.BlockingConnection(conn_parameters)
-    channel = connection.channel()
-
-    exchange = parameters.get('exchange', "logshipper")
-    queue = parameters.get('queue', "logshipper")
-    key = parameters.get('key', "logshipper")
-
-    channel.queue_declare(queue=queue, durable=False,
-                          arguments={'x-ha-policy': 'all'})
-
-    channel.exchange_declare(exchange=exchange, durable=False)
-    channel.queue_bind(exchange=exchange, queue=queue, routing_key=key)
+    transport = logshipper.rabbitmq.PikaTransport(
+        conn_parameters,
+        exchange=parameters.get('exchange', "logshipper"),
+        queue=parameters.get('queue', "logshipper"),
+        key=parameters.get('key', "logshipper"))
+
+    publisher = logshipper.rabbitmq.RabbitPublisher(
+        transport,
+        buffer_size=int(parameters.get(
+            'buffer_size', logshipper.rabbitmq.DEFAULT_BUFFER_SIZE)),
+        batch_size=int(parameters.get(
+            'batch_size', logshipper.rabbitmq.DEFAULT_BATCH_SIZE)),
+        window=int(parameters.get(
+            'window', logshipper.rabbitmq.DEFAULT_WINDOW)))
 
     def handle_rabbitmq(message, context):
-        channel.basic_publish(exchange=exchange, routing_key=key,
-                              body=json.dumps(message),
-                              properties=pika.BasicProperties(
-                                  content_type='text/json',
-                                  delivery_mode=1
-                              ))
+        publisher.publish(logshipper.serialize.serialize_message(context))
+
+    handle_rabbitmq.flush = publisher.flush
+    handle_rabbitmq.set_overflow = publisher.set_overflow
+    handle_rabbitmq.saturated = publisher.saturated
+    handle_rabbitmq.replay = publisher.replay
     return handle_rabbitmq
 
 
@@ -96,6 +114,13 @@ def prepare_statsd(parameters):
         the prefix for the stat name backreferences not allowed
     name
         the name for the stat, backreferences allowed (required)
+    flush_interval
+        When set, metrics are aggregated in-process, and sent every
+        ``flush_interval`` seconds, packing as many as fit in a packet of
+        ``mtu`` bytes (defaults to ``1432``). Counters are summed, gauges send
+        their last value (or the sum of deltas), and timers are sent as
+        ``.count``, ``.min``, ``.max``, ``.mean``, ``.p50``, ``.p90`` and
+        ``.p99``. ``sample_rate`` is ignored, as every value is counted.
 
 
     Example:
@@ -113,6 +138,17 @@ def prepare_statsd(parameters):
             name: count
     """
 
+    meter_type = parameters.get('type', 'counter')
+    name_template = logshipper.context.prepare_template(parameters['name'])
+    val_template = logshipper.context.prepare_template(
+        parameters.get('value', 1))
+    multiplier = float(parameters.get('multiplier', 1.0))
+
+    if 'flush_interval' in parameters:
+        return prepare_statsd_aggregated(parameters, meter_type,
+                                         name_template, val_template,
+                                         multiplier)
+
     import statsd  # noqa
 
     statsd_connection = statsd.Connection(
@@ -121,12 +157,6 @@ def prepare_statsd(parameters):
         sample_rate=float(parameters.get('sample_rate', 1.0)),
     )
 
-    meter_type = parameters.get('type', 'counter')
-    name_template = logshipper.context.prepare_template(parameters['name'])
-    val_template = logshipper.context.prepare_template(
-        parameters.get('value', 1))
-    multiplier = float(parameters.get('multiplier', 1.0))
-
     if meter_type == 'counter':
         statsd_client = statsd.Counter(parameters.get('prefix'),
                                        statsd_connection)
@@ -156,6 +186,41 @@ def prepare_statsd(parameters):
     return handle_statsd
 
 
+def prepare_statsd_aggregated(parameters, meter_type, name_template,
+                              val_template, multiplier):
+    aggregator = logshipper.metrics.get_aggregator(
+        parameters.get('host', '127.0.0.1'),
+        int(parameters.get('port', 8125)),
+        float(parameters['flush_interval']),
+        int(parameters.get('mtu', logshipper.metrics.DEFAULT_MTU)))
+
+    prefix = parameters.get('prefix')
+    prefix = prefix + "." if prefix else ""
+
+    if meter_type == 'counter':
+        record = aggregator.count
+    elif meter_type == 'gauge':
+        delta_str = str(parameters.get("delta", False)).lower()
+        if delta_str in filters.TRUTH_VALUES:
+            def record(name, value):
+                aggregator.gauge(name, value, True)
+        else:
+            record = aggregator.gauge
+    elif meter_type == 'timer':
+        record = aggregator.timing
+    else:
+        raise ValueError("Unknown meter type, should be one of counter, "
+                         "gauge or timer")  # pragma: nocover
+
+    def handle_statsd(message, context):
+        name = name_template.interpolate(context)
+        value = val_template.interpolate(context)
+        record(prefix + name, float(value) * multiplier)
+
+    handle_statsd.flush = aggregator.flush
+    return handle_statsd
+
+
 def prepare_stdout(parameters):
     """Sends messages to stdout
 
@@ -175,6 +240,11 @@ def prepare_stdout(parameters):
         message = format_template.interpolate(context)
         sys.stdout.write(message)
 
+    def handle_stdout_batch(contexts):
+        sys.stdout.write("".join([format_template.interpolate(context)
+                                  for context in contexts]))
+
+    handle_stdout.handle_batch = handle_stdout_batch
     return handle_stdout
 
 
@@ -194,6 +264,11 @@ def prepare_debug(parameters):  # pragma : nocover
         sys.stdout.write(repr(message))
         sys.stdout.write("\n")
 
+    def handle_debug_batch(contexts):
+        sys.stdout.write("".join(["%r\n" % (context.message,)
+                                  for context in contexts]))
+
+    handle_debug.handle_batch = handle_debug_batch
     return handle_debug
 
 
@@ -241,9 +316,11 @@ def prepare_fork(parameters):
         raise ValueError("parameter pipeline required")
 
     def handle_fork(message, context):
-        context.pipeline_manager.process_in_eventlet(dict(message),
-                                                     pipeline_name)
+        context.pipeline_manager.process_in_eventlet(
+            logshipper.message.fork(message), pipeline_name)
 
+    # Forking is cheap when the pipeline uses copy-on-write messages
+    handle_fork.copy_on_write = True
     return handle_fork
 
 
@@ -268,5 +345,6 @@ def prepare_call(parameters):
 
     def handle_call(message, context):
         context.pipeline_manager.process(message, pipeline_name)
+        context.serialized = None
 
     return handle_call
@@ -14,19 +14,26 @@
 #    under the License.
 
 
+import collections
 import fnmatch
 import glob
+import json
 import logging
 import os
 
 import eventlet
+import eventlet.event
 import pkg_resources
 import pyinotify
+import six
 import yaml
 
 import logshipper.context
 from logshipper import filters
-import logshipper.pyinotify_eventlet_notifier
+import logshipper.inotify
+import logshipper.message
+import logshipper.outputqueue
+import logshipper.spool
 
 LOG = logging.getLogger(__name__)
 
@@ -43,21 +50,150 @@ INPUT_FACTORIES = dict(
     pkg_resources.iter_entry_points("logshipper.inputs")
 )
 
-PIPELINE_POOL = eventlet.greenpool.GreenPool()
+DEFAULT_CONCURRENCY = 1000
+DEFAULT_HIGH_WATERMARK = 10000
 
+# Running shared inputs, by class and parameters
+SHARED_INPUTS = {}
 
-def prepare_input(klass, params, processfn):
+
+def prepare_input(klass, params, processfn, batchfn=None):
     entrypoint = INPUT_FACTORIES.get(klass)
     if not entrypoint:
         entrypoint = pkg_resources.EntryPoint.parse('X=' + klass)
     filter_factory = entrypoint.load(require=False)
-    input_ = filter_factory(**(params or {}))
-    input_.set_handler(processfn)
+
+    params = dict(params or {})
+    multiline = params.pop('multiline', None)
+    compact = params.pop('compact', False)
+
+    input_ = filter_factory(**params)
+    input_.set_handler(processfn, batchfn)
+    if multiline:
+        input_.set_multiline(multiline)
+    if compact:
+        input_.set_compact(compact)
     return input_
 
 
-def prepare_step(step_config):
-    sequence = [prepare_action(stepname, parameters)
+def prepare_shared_input(klass, params, processfn, batchfn=None):
+    """Like prepare_input, but shares inputs between pipelines.
+
+    Pipelines declaring an input with the same class and parameters share a
+    single instance of it, which fans out its messages to all of them. The
+    returned subscription can be started and stopped like an input.
+    """
+    try:
+        key = (klass, json.dumps(params, sort_keys=True))
+    except (TypeError, ValueError):
+        key = None  # Can't tell whether it's identical, so don't share
+
+    shared = SHARED_INPUTS.get(key) if key else None
+    if shared is None:
+        shared = SharedInput(key, klass, params)
+    return InputSubscription(shared, processfn, batchfn)
+
+
+class SharedInput(object):
+    """An input fanning out its messages to all subscribed pipelines.
+
+    The input runs while at least one subscription is started. Subscribers
+    get their own copy-on-write copy of each message (see
+    ``logshipper.message``), except for the last one, which gets the
+    original.
+    """
+
+    def __init__(self, key, klass, params):
+        self.key = key
+        self.subscriptions = []
+        self.input = prepare_input(klass, params, self.emit, self.emit_many)
+
+    def subscribe(self, subscription):
+        self.subscriptions.append(subscription)
+        if len(self.subscriptions) == 1:
+            if self.key:
+                SHARED_INPUTS[self.key] = self
+            self.input.start()
+
+    def unsubscribe(self, subscription):
+        if self.subscriptions == [subscription]:
+            # Stopping may flush messages, the last subscriber still wants
+            # those.
+            if SHARED_INPUTS.get(self.key) is self:
+                del SHARED_INPUTS[self.key]
+            self.input.stop()
+        self.subscriptions.remove(subscription)
+
+    def emit(self, message):
+        # Handlers may block, during which pipelines can (un)subscribe, so
+        # work from a snapshot. Pipelines which unsubscribed in the mean time
+        # are skipped.
+        subscriptions = list(self.subscriptions)
+        if len(subscriptions) > 1:
+            message = logshipper.message.shareable(message)
+            for subscription in subscriptions[:-1]:
+                if subscription in self.subscriptions:
+                    subscription.processfn(message.fork())
+        if subscriptions and subscriptions[-1] in self.subscriptions:
+            subscriptions[-1].processfn(message)
+
+    def emit_many(self, messages):
+        subscriptions = list(self.subscriptions)  # see emit
+        if len(subscriptions) > 1:
+            messages = [logshipper.message.shareable(message)
+                        for message in messages]
+
+        last = len(subscriptions) - 1
+        for idx, subscription in enumerate(subscriptions):
+            if subscription not in self.subscriptions:
+                continue
+
+            if idx < last:
+                batch = [message.fork() for message in messages]
+            else:
+                batch = messages
+
+            if subscription.batchfn:
+                subscription.batchfn(batch)
+            else:
+                for message in batch:
+                    subscription.processfn(message)
+
+
+class InputSubscription(object):
+    """A pipeline's handle on a shared input"""
+
+    def __init__(self, shared, processfn, batchfn=None):
+        self.shared = shared
+        self.processfn = processfn
+        self.batchfn = batchfn
+        self.started = False
+
+    @property
+    def input(self):
+        return self.shared.input
+
+    def start(self):
+        if self.started:
+            return
+
+        # Another pipeline may have started an identical input in the mean
+        # time, if so, join that one.
+        running = SHARED_INPUTS.get(self.shared.key)
+        if running is not None:
+            self.shared = running
+
+        self.started = True
+        self.shared.subscribe(self)
+
+    def stop(self):
+        if self.started:
+            self.started = False
+            self.shared.unsubscribe(self)
+
+
+def prepare_step(step_config, pipeline_manager=None):
+    sequence = [prepare_action(stepname, parameters, pipeline_manager)
                 for (stepname, parameters) in step_config.items()]
 
     sequence.sort(key=lambda action: action.phase)
@@ -65,18 +201,34 @@ def prepare_step(step_config):
     return sequence
 
 
-def prepare_action(name, parameters):
+def prepare_action(name, parameters, pipeline_manager=None):
     entrypoint = FILTER_FACTORIES.get(name)
     default_phase = filters.PHASE_MANIPULATE
+    is_output = False
 
     if not entrypoint:
         entrypoint = OUTPUT_FACTORIES.get(name)
         default_phase = filters.PHASE_FORWARD
+        is_output = entrypoint is not None
 
     if not entrypoint:
         entrypoint = pkg_resources.EntryPoint.parse('X=' + name)
         default_phase = filters.PHASE_FORWARD - 1
 
+    # Only outputs can be queued or spooled, for filters ``queue`` and
+    # ``spool`` are just fields. Some outputs (e.g. rabbitmq) use ``queue``
+    # for a name, only booleans and dicts configure an output queue.
+    queue = None
+    if (is_output and isinstance(parameters, dict) and
+            isinstance(parameters.get('queue'), (bool, dict))):
+        parameters = dict(parameters)
+        queue = parameters.pop('queue')
+
+    spool = None
+    if is_output and isinstance(parameters, dict) and 'spool' in parameters:
+        parameters = dict(parameters)
+        spool = parameters.pop('spool')
+
     filter_factory = entrypoint.load(require=False)
     handler = filter_factory(parameters)
     assert handler, "Did you forget to actually return the handler?"
@@ -84,15 +236,144 @@ def prepare_action(name, parameters):
     if not hasattr(handler, 'phase'):
         handler.phase = default_phase
 
+    if spool:
+        handler = logshipper.spool.prepare_spool(handler, spool,
+                                                 pipeline_manager)
+
+    if queue:
+        handler = logshipper.outputqueue.prepare_queue(handler, queue)
+
     return handler
 
 
+def uses_copy_on_write(steps):
+    return any(getattr(action, 'copy_on_write', False)
+               for step in steps for action in step)
+
+
+def _call_each(action, contexts):
+    """Calls action for each context, dropping the messages that fail."""
+    results = []
+    for context in contexts:
+        try:
+            results.append(action(context.message, context))
+        except Exception:
+            LOG.exception("Error while processing message")
+            results.append(filters.DROP_MESSAGE)
+    return results
+
+
+def prepare_pipeline(steps, pipeline_manager, free=None):
+    """Compiles prepared steps into a single function.
+
+    The generated function is equivalent to walking the steps and actions in
+    order, but without the dispatch loop: every action is called directly,
+    and only the result checks that can change the outcome are emitted. The
+    last action of a step doesn't need to check for ``SKIP_STEP``, as the
+    step ends anyway. When an action forks messages, messages are converted
+    to copy-on-write messages first.
+
+    Contexts are recycled through a free list once the message is done, so
+    actions mustn't hold on to a context after returning (see
+    ``Context.snapshot``). The free list never grows beyond the number of
+    messages that were processed concurrently. Pass ``free`` to share the
+    list, e.g. with ``Pipeline.process_batch``.
+    """
+    if free is None:
+        free = []
+    namespace = {
+        "Context": logshipper.context.Context,
+        "Message": logshipper.message.Message,
+        "pipeline_manager": pipeline_manager,
+        "free": free,
+        "free_pop": free.pop,
+        "free_append": free.append,
+    }
+
+    code = ["def process(message):"]
+    if uses_copy_on_write(steps):
+        code.append("  if type(message) is dict:")
+        code.append("    message = Message(message)")
+    code.extend(["  if free:",
+                 "    context = free_pop()",
+                 "    context.message = message",
+                 "  else:",
+                 "    context = Context(message, pipeline_manager)"])
+
+    def release(indent):
+        code.append("%scontext.reset()" % indent)
+        code.append("%sfree_append(context)" % indent)
+
+    for step_idx, step in enumerate(steps):
+        indent = "  "
+        if step_idx:
+            code.append("%scontext.next_step()" % indent)
+
+        for action_idx, action in enumerate(step):
+            name = "action_%i_%i" % (step_idx, action_idx)
+            namespace[name] = action
+
+            if action_idx == len(step) - 1:
+                code.append("%sif %s(message, context) == %r:" %
+                            (indent, name, filters.DROP_MESSAGE))
+                release(indent + "  ")
+                code.append("%s  return None" % indent)
+            else:
+                code.append("%sresult = %s(message, context)" %
+                            (indent, name))
+                code.append("%sif result == %r:" %
+                            (indent, filters.DROP_MESSAGE))
+                release(indent + "  ")
+                code.append("%s  return None" % indent)
+                code.append("%sif result != %r:" %
+                            (indent, filters.SKIP_STEP))
+                indent += "  "
+
+    release("  ")
+    code.append("  return message")
+
+    six.exec_("\n".join(code), namespace)
+    return namespace["process"]
+
+
 class Pipeline(object):
+    """A list of steps, and the inputs feeding them.
+
+    Messages from the inputs are queued, and processed by at most
+    ``concurrency`` greenthreads. When the number of queued and in-flight
+    messages reaches ``high_watermark``, inputs block while emitting until it
+    drops to ``low_watermark`` again. As inputs stop reading while blocked,
+    the pressure ends up in kernel socket and pipe buffers, or simply in the
+    files being tailed.
+
+    .. code:: yaml
+
+        concurrency: 100
+        high_watermark: 10000
+        low_watermark: 5000
+        inputs:
+        - syslog: {}
+        steps:
+        - elasticsearch: {}
+    """
+
     def __init__(self, manager):
         self.manager = manager
         self.steps = []
         self.inputs = []
         self.started = False
+        self.copy_on_write = False
+        self.free_contexts = []
+        self._process = prepare_pipeline(self.steps, manager,
+                                         self.free_contexts)
+
+        self.concurrency = DEFAULT_CONCURRENCY
+        self.high_watermark = DEFAULT_HIGH_WATERMARK
+        self.low_watermark = DEFAULT_HIGH_WATERMARK // 2
+        self.queue = collections.deque()
+        self.pending = 0
+        self.workers = 0
+        self.resume = None
 
     def update(self, pipeline_yaml):
         pipeline = yaml.load(pipeline_yaml)
@@ -100,14 +381,27 @@ class Pipeline(object):
         if started:
             self.stop()
 
-        self.steps = [prepare_step(step) for step in pipeline.get('steps', [])]
+        self.concurrency = int(pipeline.get('concurrency',
+                                            DEFAULT_CONCURRENCY))
+        self.high_watermark = int(pipeline.get('high_watermark',
+                                               DEFAULT_HIGH_WATERMARK))
+        self.low_watermark = int(pipeline.get('low_watermark',
+                                              self.high_watermark // 2))
+
+        self.steps = [prepare_step(step, self.manager)
+                      for step in pipeline.get('steps', [])]
+        self._process = prepare_pipeline(self.steps, self.manager,
+                                         self.free_contexts)
+        self.copy_on_write = uses_copy_on_write(self.steps)
 
         input_config = pipeline.get('inputs', [])
         if isinstance(input_config, dict):
             input_config = input_config.items()
         else:
             input_config = sum((config.items() for config in input_config), [])
-        self.inputs = [prepare_input(klass, params, self.process_in_eventlet)
+        self.inputs = [prepare_shared_input(klass, params,
+                                            self.process_in_eventlet,
+                                            self.process_batch_in_eventlet)
                        for klass, params in input_config]
         if started:
             self.start()
@@ -122,24 +416,145 @@ class Pipeline(object):
         for input_ in self.inputs:
             input_.stop()
 
+        self.flush()
+
+    def flush(self):
+        """Makes actions deliver anything they've been holding on to."""
+        for step in self.steps:
+            for action in step:
+                flush = getattr(action, 'flush', None)
+                if flush:
+                    try:
+                        flush()
+                    except Exception:
+                        LOG.exception("Unable to flush %r", action)
+
     def process_in_eventlet(self, message):
         assert 'timestamp' in message
         assert 'hostname' in message
         assert 'message' in message
-        PIPELINE_POOL.spawn_n(self.process, message)
+        self.wait_for_capacity()
+        self.enqueue(1, self.process, message)
+
+    def process_batch_in_eventlet(self, messages):
+        self.wait_for_capacity()
+        self.enqueue(len(messages), self.process_batch, messages)
+
+    def wait_for_capacity(self):
+        """Blocks the calling greenthread while the pipeline is saturated."""
+        while self.pending >= self.high_watermark:
+            if self.resume is None:
+                LOG.warning("Pipeline saturated, %i messages pending",
+                            self.pending)
+                self.resume = eventlet.event.Event()
+            self.resume.wait()
+
+    def enqueue(self, weight, function, *args):
+        """Queues function(*args) for execution in a worker greenthread.
+
+        ``weight`` is the number of messages involved, which counts towards
+        the watermarks. Unlike ``process_in_eventlet``, this never blocks,
+        which makes it suitable for use from within a pipeline.
+        """
+        self.queue.append((weight, function, args))
+        self.pending += weight
+
+        if self.workers < self.concurrency:
+            self.workers += 1
+            eventlet.spawn_n(self._work)
+
+    def _work(self):
+        try:
+            while self.queue:
+                weight, function, args = self.queue.popleft()
+                try:
+                    function(*args)
+                except Exception:
+                    LOG.exception("Error while processing message")
+                finally:
+                    self.pending -= weight
+
+                if self.resume and self.pending <= self.low_watermark:
+                    resume, self.resume = self.resume, None
+                    resume.send()
+        finally:
+            self.workers -= 1
 
     def process(self, message):
-        context = logshipper.context.Context(message, self.manager)
-        for step in self.steps:
-            context.next_step()
-            for action in step:
-                result = action(message, context)
-                if result == filters.DROP_MESSAGE:
-                    return
-                elif result == filters.SKIP_STEP:
-                    break
+        return self._process(message)
+
+    def process_batch(self, messages):
+        """Processes a list of messages, one action at a time.
+
+        Actions that have a ``handle_batch`` attribute get called once with
+        the contexts of all messages still active in the step, and return a
+        list of results (or None when all messages may continue). Other
+        actions get called for each message in turn. A message for which an
+        action raises is logged and dropped; when ``handle_batch`` raises,
+        the action is repeated for each message, so it should leave the
+        messages untouched when it fails.
+
+        Returns the messages that weren't dropped. Contexts are recycled
+        along with those of ``process``, see ``prepare_pipeline``.
+        """
+        if self.copy_on_write:
+            messages = [logshipper.message.Message(message)
+                        if type(message) is dict else message
+                        for message in messages]
+
+        free = self.free_contexts
+        contexts = []
+        for message in messages:
+            if free:
+                context = free.pop()
+                context.message = message
+            else:
+                context = logshipper.context.Context(message, self.manager)
+            contexts.append(context)
+        batch = contexts
 
-        return message
+        try:
+            for step_idx, step in enumerate(self.steps):
+                if step_idx:
+                    for context in contexts:
+                        context.next_step()
+
+                active = contexts
+                for action in step:
+                    if not active:
+                        break
+
+                    handle_batch = getattr(action, 'handle_batch', None)
+                    if handle_batch:
+                        try:
+                            results = handle_batch(active)
+                        except Exception:
+                            LOG.warning("Error while processing batch, "
+                                        "retrying per message", exc_info=True)
+                            results = _call_each(action, active)
+                    else:
+                        results = _call_each(action, active)
+
+                    if not results or not any(results):
+                        continue
+
+                    if filters.DROP_MESSAGE in results:
+                        dropped = set(id(context) for (context, result)
+                                      in zip(active, results)
+                                      if result == filters.DROP_MESSAGE)
+                        contexts = [context for context in contexts
+                                    if id(context) not in dropped]
+
+                    active = [context for (context, result)
+                              in zip(active, results)
+                              if result != filters.SKIP_STEP and
+                              result != filters.DROP_MESSAGE]
+
+            return [context.message for context in contexts]
+        finally:
+            for context in batch:
+                context.reset()
+            free.extend(batch)
 
 
 class PipelineManager(object):
@@ -148,18 +563,15 @@ class PipelineManager(object):
         self.pipelines = {}
         self.recursion_depth = 0
 
-        self.watch_manager = pyinotify.WatchManager()
+        self.watcher = logshipper.inotify.Watcher()
         flags = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE |
                  pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVED_TO |
                  pyinotify.IN_MOVED_FROM)
 
         for path in set(os.path.dirname(pathglob) for pathglob in self.globs):
             LOG.debug("Adding path for FS monitoring: %r ", path)
-            self.watch_manager.add_watch(path, flags,
-                                         proc_fun=self._inotified)
+            self.watcher.add_watch(path, flags, self._inotified)
 
-        self.notifier = logshipper.pyinotify_eventlet_notifier.Notifier(
-            self.watch_manager)
         self.thread = None
         self.should_run = False
 
@@ -185,9 +597,7 @@ class PipelineManager(object):
     def _run(self):
         try:
             self.load_pipelines()
-            while self.should_run:
-                LOG.debug("starting notifier")
-                self.notifier.loop(lambda _: not self.should_run)
+            self.watcher.loop()
         except Exception:  # pragma: nocover
             LOG.exception("Pipeline manager main loop crashed")
         finally:
@@ -236,7 +646,11 @@ class PipelineManager(object):
         return pipeline
 
     def process_in_eventlet(self, message, pipeline_name):
-        PIPELINE_POOL.spawn_n(self.process, message, pipeline_name)
+        pipeline = self.pipelines.get(pipeline_name)
+        if pipeline is None:
+            LOG.warning("Unknown pipeline %s, dropping message", pipeline_name)
+            return
+        pipeline.enqueue(1, self.process, message, pipeline_name)
 
     def process(self, message, pipeline_name):
         if self.recursion_depth > 10:
@@ -19,9 +19,8 @@ import errno
 import logging
 import os
 
-import eventlet.green.select as select
+import eventlet.hubs
 import pyinotify
-import six
 
 LOG = logging.getLogger(__name__)
 
@@ -30,32 +29,33 @@ class Notifier(pyinotify.Notifier):
 
     def __init__(self, watch_manager, default_proc_fun=None, read_freq=0,
                  threshold=0, timeout=None):
-        pyinotify.Notifier.__init__(self, watch_manager, default_proc_fun=None,
-                                    read_freq=0, threshold=0, timeout=None)
+        pyinotify.Notifier.__init__(self, watch_manager,
+                                    default_proc_fun=default_proc_fun,
+                                    read_freq=0, threshold=0, timeout=timeout)
 
         # We won't be using the pollobj
         self._pollobj.unregister(self._fd)
         self._pollobj = None
 
     def check_events(self, timeout=None):
-        while True:
-            try:
-                # blocks up to 'timeout' milliseconds
-                if timeout is None:
-                    timeout = self._timeout
-                ret = select.select([self._fd], [self._fd], [self._fd])
-            except select.error as err:
-                if six.PY2 and err[0] == errno.EINTR:
-                    break
-                elif six.PY3 and err.errno == errno.EINTR:
-                    break  # interrupted, retry
-                else:
-                    raise
-            else:
-                break
-
-        # only one fd is polled
-        return bool(ret[0])
+        # Only wait for the descriptor to become readable. An inotify
+        # descriptor is always writable, so also waiting for that would
+        # turn this into a busy loop.
+        if timeout is None:
+            timeout = self._timeout
+
+        try:
+            eventlet.hubs.trampoline(
+                self._fd, read=True,
+                timeout=timeout / 1000.0 if timeout is not None else None,
+                timeout_exc=eventlet.Timeout)
+        except eventlet.Timeout:
+            return False
+        except (IOError, OSError) as err:
+            if err.errno == errno.EINTR:
+                return False
+            raise
+        return True
 
     def stop(self):
         # The original stop method unregistered the pollobj, but we've already
@@ -129,6 +129,7 @@ def prepare_logging(parameters):
             func=func)
 
         record.created = time.mktime(message.pop('timestamp').timetuple())
+        context.serialized = None
 
         for key, value in message.items():
             if not hasattr(record, key):
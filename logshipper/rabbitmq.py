@@ -0,0 +1,297 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import logging
+
+import eventlet
+import eventlet.queue
+import eventlet.tpool
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 10000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_WINDOW = 1000
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+IDLE_POLL = 1.0
+
+
+class PikaTransport(object):
+    """Publishes through a pika BlockingConnection with publisher confirms.
+
+    Confirms are collected asynchronously rather than waited for on every
+    publish, so many messages can be in flight. All methods block, and are
+    meant to be called through ``eventlet.tpool`` from a single greenthread.
+
+    The public ``BlockingChannel.confirm_delivery`` makes every publish wait
+    for its confirm, so confirms are enabled on the channel it wraps
+    (``BlockingChannel._impl``) instead. That's not a public API, which is
+    why requirements.txt pins pika to 1.x, the version this was written
+    against. The tests check that the wrapped channel is still there.
+    """
+
+    def __init__(self, conn_parameters, exchange, queue, key):
+        self.conn_parameters = conn_parameters
+        self.exchange = exchange
+        self.queue = queue
+        self.key = key
+        self.connection = None
+        self.channel = None
+        self.confirms = []
+
+    def connect(self):
+        import pika  # noqa
+
+        self.confirms = []
+        self.connection = pika.adapters.BlockingConnection(
+            self.conn_parameters)
+        self.channel = self.connection.channel()
+
+        self.channel.queue_declare(queue=self.queue, durable=False,
+                                   arguments={'x-ha-policy': 'all'})
+        self.channel.exchange_declare(exchange=self.exchange, durable=False)
+        self.channel.queue_bind(exchange=self.exchange, queue=self.queue,
+                                routing_key=self.key)
+
+        # Enable confirms on the underlying channel, the blocking channel
+        # would wait for the confirmation of every single publish.
+        self.channel._impl.confirm_delivery(ack_nack_callback=self.on_confirm)
+        self.connection.process_data_events(0)
+
+        self.properties = pika.BasicProperties(content_type='text/json',
+                                               delivery_mode=1)
+        self.ack_method = pika.spec.Basic.Ack
+
+    def on_confirm(self, method_frame):
+        method = method_frame.method
+        self.confirms.append((method.delivery_tag, method.multiple,
+                              isinstance(method, self.ack_method)))
+
+    def publish(self, bodies):
+        for body in bodies:
+            self.channel.basic_publish(exchange=self.exchange,
+                                       routing_key=self.key, body=body,
+                                       properties=self.properties)
+
+    def poll(self, timeout):
+        self.connection.process_data_events(timeout)
+        confirms, self.confirms = self.confirms, []
+        return confirms
+
+    def close(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            connection.close()
+
+
+class RabbitPublisher(object):
+    """Publishes messages from a greenthread, pipelining confirms.
+
+    Messages are buffered (up to ``buffer_size``, after which ``publish``
+    blocks), and published in batches of up to ``batch_size``. At most
+    ``window`` messages may be awaiting a confirm. When the connection fails,
+    or a message is nacked, unconfirmed messages are published again after
+    reconnecting, so messages may be delivered more than once.
+
+    With an overflow (see ``set_overflow``), messages are handed over instead
+    of being held in memory while the connection is down, or when the buffer
+    is full.
+
+    ``flush`` stops the greenthread and closes the connection, both are
+    started again by the next ``publish``.
+    """
+
+    def __init__(self, transport, buffer_size=DEFAULT_BUFFER_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, window=DEFAULT_WINDOW,
+                 retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY):
+        self.transport = transport
+        self.buffer = eventlet.queue.LightQueue(buffer_size)
+        self.batch_size = batch_size
+        self.window = window
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.retries = collections.deque()
+        self.unacked = collections.OrderedDict()
+        self.next_tag = 1
+        self.connected = False
+        self.failing = False
+        self.thread = None
+        self.waiting = False
+        self.overflow = None
+
+    def set_overflow(self, overflow):
+        self.overflow = overflow
+
+    def saturated(self):
+        return self.failing or self.buffer.full()
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = eventlet.spawn(self._run)
+
+    def publish(self, body):
+        self._start()
+
+        if self.overflow is not None and self.saturated():
+            self.overflow(body)
+            return
+
+        self.buffer.put(body)
+
+    replay = publish
+
+    def _spill(self):
+        """Hands all messages that weren't confirmed to the overflow"""
+        bodies = list(self.unacked.values()) + list(self.retries)
+        self.unacked.clear()
+        self.retries.clear()
+        while True:
+            try:
+                bodies.append(self.buffer.get_nowait())
+            except eventlet.queue.Empty:
+                break
+
+        for body in bodies:
+            self.overflow(body)
+
+    def pending(self):
+        return len(self.retries) + self.buffer.qsize() + len(self.unacked)
+
+    def flush(self, timeout=30):
+        if self.pending():
+            self._start()
+
+        with eventlet.Timeout(timeout, False):
+            while self.pending():
+                eventlet.sleep(0.01)
+
+        if self.pending() and self.overflow is not None:
+            self._spill()
+        elif self.pending():
+            LOG.warning("%d messages were not confirmed by RabbitMQ",
+                        self.pending())
+
+        self.close()
+
+    def close(self):
+        """Stops the greenthread and closes the connection.
+
+        Messages that weren't published yet are kept for the next start.
+        """
+        thread, self.thread = self.thread, None
+        if thread is None:
+            return
+
+        if self.waiting:
+            thread.kill()
+        else:
+            # The greenthread is using the transport in a tpool thread, let
+            # it finish its step instead.
+            thread.wait()
+        self._disconnect()
+
+    def _run(self):
+        delay = self.retry_delay
+        while self.thread is eventlet.getcurrent():
+            try:
+                if not self.connected:
+                    eventlet.tpool.execute(self.transport.connect)
+                    self.connected = True
+                    self.failing = False
+                    self.next_tag = 1
+
+                self._step()
+                delay = self.retry_delay
+            except Exception:
+                LOG.exception("Unable to publish to RabbitMQ, retrying in "
+                              "%.1f seconds", delay)
+                self._disconnect()
+                self.failing = True
+                if self.overflow is not None:
+                    self._spill()
+                if self.thread is not eventlet.getcurrent():
+                    break
+
+                self.waiting = True
+                try:
+                    eventlet.sleep(delay)
+                finally:
+                    self.waiting = False
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def _disconnect(self):
+        self.connected = False
+        self.retries.extendleft(reversed(list(self.unacked.values())))
+        self.unacked.clear()
+        try:
+            eventlet.tpool.execute(self.transport.close)
+        except Exception:
+            pass
+
+    def _take_batch(self):
+        room = min(self.batch_size, self.window - len(self.unacked))
+        batch = []
+        while self.retries and len(batch) < room:
+            batch.append(self.retries.popleft())
+        while len(batch) < room:
+            try:
+                batch.append(self.buffer.get_nowait())
+            except eventlet.queue.Empty:
+                break
+        return batch
+
+    def _step(self):
+        batch = self._take_batch()
+        if batch:
+            # Register the messages first, so they're retried if publishing
+            # fails halfway through the batch.
+            for body in batch:
+                self.unacked[self.next_tag] = body
+                self.next_tag += 1
+            eventlet.tpool.execute(self.transport.publish, batch)
+
+        if self.unacked:
+            # Only wait for confirms when there's nothing else to do
+            idle = not batch or len(self.unacked) >= self.window
+            confirms = eventlet.tpool.execute(self.transport.poll,
+                                              0.01 if idle else 0)
+            self._confirm(confirms)
+            eventlet.sleep(0)
+        elif not batch:
+            self.waiting = True
+            try:
+                self.retries.append(self.buffer.get(timeout=IDLE_POLL))
+            except eventlet.queue.Empty:
+                self.waiting = False
+                # Keep the connection alive (e.g. heartbeats)
+                self._confirm(eventlet.tpool.execute(self.transport.poll, 0))
+            finally:
+                self.waiting = False
+
+    def _confirm(self, confirms):
+        for tag, multiple, ack in confirms:
+            if multiple:
+                tags = [t for t in self.unacked if t <= tag]
+            else:
+                tags = [tag] if tag in self.unacked else []
+
+            for t in tags:
+                body = self.unacked.pop(t)
+                if not ack:
+                    LOG.warning("RabbitMQ rejected a message, retrying")
+                    self.retries.append(body)
@@ -0,0 +1,124 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import json
+import logging
+import os
+
+LOG = logging.getLogger(__name__)
+
+FINGERPRINT_SIZE = 1024
+
+
+def file_key(file_stat):
+    return "%d:%d" % (file_stat.st_dev, file_stat.st_ino)
+
+
+def fingerprint(data):
+    """Identifies a file by its first bytes, as inodes get reused"""
+    return hashlib.md5(data[:FINGERPRINT_SIZE]).hexdigest()
+
+
+class OffsetRegistry(object):
+    """Remembers how far files have been read, across restarts.
+
+    Files are identified by device and inode, and a fingerprint of their
+    first bytes, so a new file which happens to reuse an inode isn't
+    mistaken for the old one. Updates are kept in memory until ``save`` is
+    called, which atomically replaces the registry file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.saved_at = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+            self.saved_at = os.path.getmtime(self.path)
+        except (IOError, OSError):
+            self.entries = {}
+        except ValueError:
+            LOG.warning("Ignoring corrupt offset registry %s", self.path)
+            self.entries = {}
+
+    def lookup(self, file_stat, head):
+        """Returns the stored offset for a file, or None.
+
+        ``head`` are the first bytes of the file, at least as many as were
+        fingerprinted when the offset was stored.
+        """
+        entry = self.entries.get(file_key(file_stat))
+        if not entry:
+            return None
+
+        size = entry['fingerprint_size']
+        if len(head) < size:
+            return None
+
+        if fingerprint(head[:size]) != entry['fingerprint']:
+            return None
+
+        if entry['offset'] > file_stat.st_size:
+            return None
+
+        return entry['offset']
+
+    def lookup_fingerprint(self, head):
+        """Returns the stored offset for a file with the same first bytes.
+
+        This finds files which were copied or compressed since, and thus
+        have a different inode.
+        """
+        for entry in self.entries.values():
+            size = entry['fingerprint_size']
+            if (size and len(head) >= size and
+                    fingerprint(head[:size]) == entry['fingerprint']):
+                return entry['offset']
+        return None
+
+    def update(self, entries):
+        """Replaces the entries with (file_stat, head, offset, path) tuples"""
+        new_entries = {}
+        for file_stat, head, offset, path in entries:
+            head = head[:FINGERPRINT_SIZE]
+            new_entries[file_key(file_stat)] = {
+                'path': path,
+                'offset': offset,
+                'fingerprint': fingerprint(head),
+                'fingerprint_size': len(head),
+            }
+
+        if new_entries != self.entries:
+            self.entries = new_entries
+            self.dirty = True
+
+    def save(self):
+        """Writes the registry to disk, if it changed"""
+        if not self.dirty:
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.dirty = False
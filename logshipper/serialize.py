@@ -0,0 +1,100 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""JSON serialization of messages.
+
+Uses orjson when it's installed, and the standard library otherwise. Note
+that the two produce different (but equivalent) JSON. Anything that hashes
+the JSON (e.g. generated document ids) should use ``dumps_canonical``, so the
+result doesn't depend on which encoder is installed.
+"""
+
+import datetime
+import json
+
+import logshipper.message
+
+try:
+    import orjson
+except ImportError:  # pragma: nocover
+    orjson = None
+
+
+def json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    else:
+        return str(value)
+
+
+# json.dumps creates a new encoder for every call with non-default options,
+# reusing them saves that setup.
+_ENCODERS = {
+    sort_keys: json.JSONEncoder(default=json_default, sort_keys=sort_keys)
+    for sort_keys in (False, True)
+}
+
+
+def dumps_stdlib(value, sort_keys=False):
+    return _ENCODERS[bool(sort_keys)].encode(value).encode('utf8')
+
+
+# The standard library encoding is what hashes have always been taken of
+dumps_canonical = dumps_stdlib
+
+
+if orjson is not None:  # pragma: nocover
+    _ORJSON_OPTIONS = {
+        False: orjson.OPT_NON_STR_KEYS,
+        True: orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS,
+    }
+
+    def dumps_orjson(value, sort_keys=False):
+        # orjson encodes naive datetimes natively, in isoformat
+        return orjson.dumps(value, default=str,
+                            option=_ORJSON_OPTIONS[bool(sort_keys)])
+
+    dumps = dumps_orjson
+else:
+    dumps = dumps_stdlib
+
+
+def serialize_message(context, sort_keys=False, timestamp_field='timestamp',
+                      encode=None):
+    """Returns the message of the context as JSON encoded bytes.
+
+    The message is encoded with ``encode``, which defaults to ``dumps``. The
+    result is cached on the context, so other outputs in the same step can
+    reuse it. The cache is cleared when moving to the next step; actions
+    that modify the message in the output phase should clear it as well.
+    """
+    encode = encode or dumps
+    key = (timestamp_field, sort_keys, encode)
+    cache = context.serialized
+    if cache is None:
+        cache = context.serialized = {}
+    else:
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+    document = logshipper.message.as_dict(context.message)
+    if timestamp_field != 'timestamp':
+        document = dict(document)
+        document[timestamp_field] = document.pop("timestamp")
+
+    result = cache[key] = encode(document, sort_keys)
+    return result
@@ -0,0 +1,410 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import os
+import struct
+import zlib
+
+import eventlet
+from six.moves import cPickle as pickle
+
+import logshipper.context
+
+LOG = logging.getLogger(__name__)
+
+# Every record is its payload length and crc32, followed by the payload
+HEADER = struct.Struct("!II")
+SEGMENT_SUFFIX = ".spool"
+POSITION_FILE = "position"
+
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+MAX_ATTEMPTS = 10
+
+# Records which can't be delivered are moved to this subdirectory
+REJECTED_DIRECTORY = "rejected"
+
+# The read position is synced after every batch of replayed records
+REPLAY_BATCH = 100
+
+# Spooled records are either messages, or items an output handed over
+MESSAGE = 'message'
+ITEM = 'item'
+
+
+class Spool(object):
+    """An append-only queue of records, stored in segment files on disk.
+
+    Records are appended to the newest segment, and read from the oldest.
+    Segments are removed once all of their records have been read. Writes
+    are synced to disk at most once per ``sync_interval``, along with the
+    read position. Readers can sync more often to save their position, after
+    a crash the records read since the last sync are read again.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024,
+                 max_size=1024 * 1024 * 1024, sync_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX))
+        self.size = sum(os.path.getsize(self.segment_path(segment))
+                        for segment in self.segments)
+
+        self.writer = None
+        self.write_offset = 0
+        self.reader = None
+        self.read_offset = 0
+        self.read_length = 0
+        self.sync_timer = None
+
+        self._restore_position()
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory,
+                            "%012d%s" % (segment, SEGMENT_SUFFIX))
+
+    def _restore_position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE)) as f:
+                segment, offset = [int(part) for part in f.read().split()]
+        except (IOError, OSError, ValueError):
+            return
+
+        if self.segments and self.segments[0] == segment:
+            self.read_offset = offset
+            self.size -= offset
+
+    def __len__(self):
+        """Returns the number of unread bytes"""
+        return self.size
+
+    def append(self, payload):
+        """Appends a record, returns False if the spool is full."""
+        if self.size + len(payload) + HEADER.size > self.max_size:
+            return False
+
+        if (self.writer is None or
+                self.write_offset >= self.segment_size):
+            self._roll()
+
+        self.writer.write(HEADER.pack(len(payload),
+                                      zlib.crc32(payload) & 0xffffffff))
+        self.writer.write(payload)
+        self.write_offset += len(payload) + HEADER.size
+        self.size += len(payload) + HEADER.size
+
+        if self.sync_timer is None:
+            self.sync_timer = eventlet.spawn_after(self.sync_interval,
+                                                   self.sync)
+        return True
+
+    def _roll(self):
+        # A new segment is started for every spool instance, so an existing
+        # segment (possibly with a torn write) is never appended to.
+        if self.writer is not None:
+            self._sync_writer()
+            self.writer.close()
+
+        segment = self.segments[-1] + 1 if self.segments else 1
+        self.segments.append(segment)
+        self.writer = open(self.segment_path(segment), 'ab')
+        self.write_offset = 0
+
+    def _sync_writer(self):
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+
+    def read(self):
+        """Returns the oldest record, without removing it, or None."""
+        while self.segments:
+            segment = self.segments[0]
+            if self.reader is None:
+                self.reader = open(self.segment_path(segment), 'rb')
+
+            writing = self.writer is not None and segment == self.segments[-1]
+            if writing:
+                self.writer.flush()
+
+            self.reader.seek(self.read_offset)
+            header = self.reader.read(HEADER.size)
+            if len(header) == HEADER.size:
+                length, crc = HEADER.unpack(header)
+                payload = self.reader.read(length)
+                if (len(payload) == length and
+                        zlib.crc32(payload) & 0xffffffff == crc):
+                    self.read_length = length + HEADER.size
+                    return payload
+
+                LOG.warning("Corrupt record in %s, skipping the rest of "
+                            "the segment", self.segment_path(segment))
+            elif not header and writing:
+                return None
+            elif header:
+                LOG.warning("Truncated record in %s",
+                            self.segment_path(segment))
+
+            self._remove_segment()
+        return None
+
+    def pop(self):
+        """Removes the record last returned by read()"""
+        self.read_offset += self.read_length
+        self.size -= self.read_length
+
+    def _remove_segment(self):
+        segment = self.segments.pop(0)
+        self.reader.close()
+        self.reader = None
+        self.size -= os.path.getsize(self.segment_path(segment)) - \
+            self.read_offset
+        self.read_offset = 0
+        os.unlink(self.segment_path(segment))
+
+        if self.writer is not None and not self.segments:
+            self.writer.close()
+            self.writer = None
+            self.size = 0
+
+    def sync(self):
+        """Syncs appended records and the read position to disk"""
+        timer, self.sync_timer = self.sync_timer, None
+        if timer is not None:
+            # Doesn't affect the timer when it's the one calling us
+            timer.cancel()
+        if self.writer is not None:
+            self._sync_writer()
+
+        path = os.path.join(self.directory, POSITION_FILE)
+        with open(path + ".tmp", 'w') as f:
+            if self.segments:
+                f.write("%d %d" % (self.segments[0], self.read_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+
+    def close(self):
+        self.sync()
+
+        for f in (self.reader, self.writer):
+            if f is not None:
+                f.close()
+        self.reader = self.writer = None
+
+
+class SpooledOutput(object):
+    """Spools messages to disk while an output is failing.
+
+    Any action can be spooled by adding a ``spool`` parameter. Messages are
+    delivered directly, until the output raises an exception. From then on,
+    messages are appended to the spool, which is replayed in order as soon
+    as the output works again. Memory use doesn't grow with the duration of
+    the outage, only the spool on disk does.
+
+    Outputs which handle their own failures (``elasticsearch`` in bulk mode
+    and ``rabbitmq``) don't raise. Instead, they spool the documents they
+    couldn't deliver, as well as new ones while they're backing off or
+    reconnecting. A queued output spools the messages that don't fit in its
+    queue. Spooled messages may be delivered out of order.
+
+    ``directory``
+        Where to store the spool (required). Every output needs its own
+        directory. Messages in the spool are replayed on startup.
+    ``max_size``
+        The maximum size of the spool in bytes, after which new messages are
+        dropped. Defaults to 1 GiB.
+    ``segment_size``
+        The size of spool files in bytes. Defaults to 16 MiB.
+    ``sync_interval``
+        The maximum number of seconds between syncs to disk. Defaults to
+        ``1``.
+    ``max_attempts``
+        The number of times delivery of a spooled message is attempted, after
+        which it's moved to the ``rejected`` subdirectory, so it doesn't
+        hold up the rest of the spool. Defaults to ``10``, ``0`` retries
+        forever. Rejected messages aren't replayed, but moving the files
+        back into ``directory`` replays them on the next start.
+
+    Example:
+
+    .. code:: yaml
+
+        elasticsearch:
+            url: http://localhost:9200/
+            spool:
+                directory: /var/spool/logshipper/elasticsearch
+                max_size: 10737418240
+    """
+
+    def __init__(self, handler, directory, max_size=1024 * 1024 * 1024,
+                 segment_size=16 * 1024 * 1024, sync_interval=1.0,
+                 retry_delay=RETRY_DELAY, max_attempts=MAX_ATTEMPTS,
+                 pipeline_manager=None):
+        self.handler = handler
+        self.pipeline_manager = pipeline_manager
+        self.phase = handler.phase
+        self.spool = Spool(directory, segment_size=int(segment_size),
+                           max_size=int(max_size),
+                           sync_interval=float(sync_interval))
+        self.retry_delay = float(retry_delay)
+        self.max_attempts = int(max_attempts)
+        self.rejected = None
+        self.dropped = 0
+        self.replaying = None
+
+        # Outputs with their own buffers hand over what they can't deliver
+        # through ``set_overflow``, and take it back through ``replay``.
+        set_overflow = getattr(handler, 'set_overflow', None)
+        if set_overflow:
+            set_overflow(self.overflow)
+        self.saturated = getattr(handler, 'saturated', None)
+
+        if len(self.spool):
+            self._start_replay()
+
+    def __call__(self, message, context):
+        if self.replaying is None:
+            try:
+                return self.handler(message, context)
+            except Exception:
+                LOG.exception("Output failed, spooling messages to disk")
+
+        self.spill(context)
+
+    def handle_batch(self, contexts):
+        for context in contexts:
+            self(context.message, context)
+
+    def spill(self, context):
+        """Spools a message, to be delivered once the output has room"""
+        self._append(MESSAGE, (context.message, context.backreferences))
+
+    def overflow(self, item):
+        """Spools an item the output couldn't deliver, see ``replay``"""
+        self._append(ITEM, item)
+
+    def _append(self, kind, data):
+        payload = pickle.dumps((kind, data), pickle.HIGHEST_PROTOCOL)
+        if not self.spool.append(payload):
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                LOG.warning("Spool full, %i messages dropped so far",
+                            self.dropped)
+
+        if self.replaying is None:
+            self._start_replay()
+
+    def _start_replay(self):
+        self.replaying = eventlet.spawn(self._replay)
+
+    def _deliver(self, kind, data):
+        if kind == ITEM:
+            self.handler.replay(data)
+            return
+
+        message, backreferences = data
+        context = logshipper.context.Context(message, self.pipeline_manager)
+        context.backreferences = backreferences
+        self.handler(message, context)
+
+    def _reject(self, payload):
+        if self.rejected is None:
+            self.rejected = Spool(
+                os.path.join(self.spool.directory, REJECTED_DIRECTORY),
+                segment_size=self.spool.segment_size,
+                max_size=self.spool.max_size,
+                sync_interval=self.spool.sync_interval)
+
+        if not self.rejected.append(payload):
+            self.dropped += 1
+            LOG.warning("Rejected spool full, %i messages dropped so far",
+                        self.dropped)
+
+    def _replay(self):
+        delay = self.retry_delay
+        replayed = 0
+        attempts = 0
+        try:
+            while True:
+                if self.saturated is not None and self.saturated():
+                    eventlet.sleep(delay)
+                    delay = min(delay * 2, MAX_RETRY_DELAY)
+                    continue
+
+                payload = self.spool.read()
+                if payload is None:
+                    if replayed:
+                        self.spool.sync()
+                    return
+
+                try:
+                    self._deliver(*pickle.loads(payload))
+                except Exception:
+                    attempts += 1
+                    if self.max_attempts and attempts >= self.max_attempts:
+                        LOG.error("Unable to deliver a spooled message "
+                                  "after %i attempts, rejecting it",
+                                  attempts, exc_info=True)
+                        self._reject(payload)
+                    else:
+                        LOG.warning("Output still failing, retrying in %.1f "
+                                    "seconds", delay, exc_info=True)
+                        eventlet.sleep(delay)
+                        delay = min(delay * 2, MAX_RETRY_DELAY)
+                        continue
+
+                attempts = 0
+                delay = self.retry_delay
+                self.spool.pop()
+
+                replayed += 1
+                if replayed % REPLAY_BATCH == 0:
+                    self.spool.sync()
+        finally:
+            self.replaying = None
+
+    def flush(self):
+        """Syncs the spool, messages in it are replayed on the next start"""
+        if self.replaying is not None:
+            self.replaying.kill()
+
+        # The output may spool what it couldn't deliver while flushing
+        flush = getattr(self.handler, 'flush', None)
+        if flush:
+            flush()
+
+        if self.replaying is not None:
+            self.replaying.kill()
+        self.spool.close()
+        if self.rejected is not None:
+            self.rejected.close()
+            self.rejected = None
+
+
+def prepare_spool(handler, parameters, pipeline_manager=None):
+    if not isinstance(parameters, dict):
+        raise ValueError("spool parameter should be a mapping")
+
+    return SpooledOutput(handler, pipeline_manager=pipeline_manager,
+                         **parameters)
@@ -14,15 +14,25 @@
 #    under the License.
 
 
+import bz2
+import codecs
+import collections
+import fnmatch
 import glob
+import gzip
 import logging
+import re
+import time
 
+import eventlet
+import eventlet.event
 from eventlet.green import os
 import pyinotify
 import six
 
 import logshipper.input
-import logshipper.pyinotify_eventlet_notifier
+import logshipper.inotify
+import logshipper.registry
 
 LOG = logging.getLogger(__name__)
 
@@ -30,6 +40,95 @@ INOTIFY_FILE_MASK = pyinotify.IN_MODIFY | pyinotify.IN_OPEN
 INOTIFY_DIR_MASK = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
                     pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
 
+MIN_READ_SIZE = 64 * 1024
+MAX_READ_SIZE = 1024 * 1024
+READ_BUDGET = 1024 * 1024
+
+MIN_POLL_INTERVAL = 0.1
+MAX_POLL_INTERVAL = 5.0
+
+MAGIC = re.compile('[*?[]')
+
+# Names of rotated files, relative to the name of the file
+ROTATED_SUFFIXES = ('.*', '-*')
+CATCH_UP_RATE = 10000
+
+
+def split_lines(chunk):
+    """Splits bytes into decoded complete lines, and the incomplete rest"""
+    end = chunk.rfind(b"\n")
+    if end < 0:
+        return [], chunk
+
+    # A newline byte never occurs within a multi-byte UTF-8 sequence, so all
+    # complete lines can be decoded at once.
+    text = codecs.utf_8_decode(memoryview(chunk)[:end], 'replace', True)[0]
+    return text.split("\n"), chunk[end + 1:]
+
+
+def open_rotated(path):
+    """Opens a file which may be compressed with gzip or bzip2.
+
+    Returns the file, and whether it's compressed.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(3)
+
+    if header[0:2] == b"\037\213":
+        return gzip.open(path, 'rb'), True
+    elif header == b"\x42\x5A\x68":
+        return bz2.BZ2File(path, 'rb'), True
+    return open(path, 'rb'), False
+
+
+def compile_component(pattern):
+    """Returns a function matching one path component against a pattern.
+
+    Like ``glob``, wildcards don't match names starting with a dot, unless
+    the pattern starts with a dot too.
+    """
+    if not MAGIC.search(pattern):
+        return lambda name: name == pattern
+
+    regex = re.compile(fnmatch.translate(pattern))
+    if pattern.startswith('.'):
+        return lambda name: regex.match(name) is not None
+    return lambda name: not name.startswith('.') and regex.match(name)
+
+
+class GlobMatcher(object):
+    """Tells whether a path matches any of a list of globs.
+
+    Globs are indexed by their directory, when it has no wildcards, so
+    matching a path usually only looks at the globs for its directory.
+    """
+
+    def __init__(self, globs):
+        self.by_directory = collections.defaultdict(list)
+        self.wildcard = []
+        for pattern in globs:
+            directory, basename = os.path.split(pattern)
+            if MAGIC.search(directory):
+                self.wildcard.append([compile_component(part)
+                                      for part in pattern.split(os.sep)])
+            else:
+                self.by_directory[directory].append(
+                    compile_component(basename))
+
+    def match(self, path):
+        directory, basename = os.path.split(path)
+        for matcher in self.by_directory.get(directory, ()):
+            if matcher(basename):
+                return True
+
+        parts = path.split(os.sep)
+        for matchers in self.wildcard:
+            if len(matchers) == len(parts) and all(
+                    matcher(part) for matcher, part in zip(matchers, parts)):
+                return True
+
+        return False
+
 
 class Tail(logshipper.input.BaseInput):
     """Follows files, and processes new lines in those files as messages.
@@ -39,42 +138,110 @@ class Tail(logshipper.input.BaseInput):
 
     Rotated files are automatically discovered, and reopened.
 
+    Files which exist at startup are followed from their end, unless a
+    ``registry`` file is configured. Tail then remembers how far each file
+    was read, and resumes from there after a restart. The registry is
+    written every ``checkpoint_interval`` seconds, and on shutdown. Files
+    which aren't in the registry, but changed since the last checkpoint (e.g.
+    they were created while logshipper wasn't running), are read from the
+    start.
+
+    By default, every file is kept open and watched. To follow more files
+    than the limits on open files and inotify watches allow, set
+    ``max_open_files``. Tail then watches the directories containing the
+    files instead, and closes the least recently read files, to reopen them
+    at the same offset when they change. When inotify watches run out,
+    files are polled for changes instead, with an interval between
+    0.1 and 5 seconds, depending on how busy the files are.
+
+    A file is read at most ``read_budget`` bytes (1 MiB by default) at a
+    time. Files with more data pending take turns, so a single busy file
+    can't hold up the others, or the rest of logshipper.
+
+    Applications which write many small chunks cause a change notification
+    for every write. With ``coalesce`` set, changed files are read
+    ``coalesce`` seconds after the first notification, so data from many
+    writes is read and emitted at once. ``0`` coalesces the notifications
+    which arrive at the same time.
+
+    After an outage, data may have been written to files that were rotated
+    (e.g. ``app.log.1``, ``app.log.2.gz`` or ``app.log-20141113``) in the
+    mean time. With ``catch_up`` enabled (this requires a ``registry``),
+    rotated files which changed since the last checkpoint are read first,
+    oldest first, at most ``catch_up_rate`` lines per second. gzip and bzip2
+    compressed files are supported.
+
     Example for ``input.yml``:
 
     .. code:: yaml
 
         - tail:
-            filename:
+            filenames:
             - /var/log/syslog
             - /var/log/my_app/*.log
+            registry: /var/lib/logshipper/tail.registry
     """
 
     class FileTail(object):
         __slots__ = ['file_descriptor', 'path', 'buffer', 'stat', 'rescan',
-                     'watch_descriptor']
+                     'watch', 'read_size', 'head', 'offset',
+                     'scheduled', 'reading']
 
         def __init__(self):
+            self.scheduled = False
+            self.reading = None
             self.buffer = b""
+            self.head = b""
+            self.offset = 0
+            self.read_size = MIN_READ_SIZE
             self.file_descriptor = None
             self.path = None
             self.rescan = None
             self.stat = None
-            self.watch_descriptor = None
+            self.watch = None
 
-    def __init__(self, filenames):
+    def __init__(self, filenames, registry=None, checkpoint_interval=5.0,
+                 max_open_files=None, read_budget=READ_BUDGET,
+                 coalesce=None, catch_up=False, catch_up_rate=CATCH_UP_RATE):
         if isinstance(filenames, six.string_types):
             filenames = [filenames]
 
+        if catch_up and not registry:
+            raise ValueError("catch_up requires a registry")
+        self.catch_up = catch_up
+        self.catch_up_rate = float(catch_up_rate)
+
+        self.coalesce = None if coalesce is None else float(coalesce)
+        self.dirty = collections.OrderedDict()
+        self.drainer = None
+
+        self.read_budget = int(read_budget)
+        self.ready = collections.deque()
+        self.scheduler = None
+
+        self.max_open_files = None
+        if max_open_files:
+            self.max_open_files = max(int(max_open_files), 1)
+        self.open_tails = collections.OrderedDict()
+        self.poller = None
+        self.bytes_read = 0
+
+        self.registry = None
+        if registry:
+            self.registry = logshipper.registry.OffsetRegistry(registry)
+        self.checkpoint_interval = float(checkpoint_interval)
+
         self.globs = []
-        self.watch_manager = pyinotify.WatchManager()
+        self.watcher = logshipper.inotify.Watcher()
         self.tails = {}
         self.dir_watches = {}
 
-        self.notifier = logshipper.pyinotify_eventlet_notifier.Notifier(
-            self.watch_manager)
-
+        # Files are opened when the input starts
         for filename in filenames:
-            self.add_file(filename=filename)
+            full_path = os.path.abspath(filename)
+            if full_path not in self.globs:
+                self.globs.append(full_path)
+        self.matcher = GlobMatcher(self.globs)
 
     def add_file(self, filename):
         """Add filename to the list of the monitored files.
@@ -87,6 +254,7 @@ class Tail(logshipper.input.BaseInput):
 
         if full_path not in self.globs:
             self.globs.append(full_path)
+            self.matcher = GlobMatcher(self.globs)
 
         self.update_tails(self.globs, do_read_all=False)
 
@@ -105,6 +273,7 @@ class Tail(logshipper.input.BaseInput):
             # File not monitored
             return
 
+        self.matcher = GlobMatcher(self.globs)
         self.update_tails(self.globs, do_read_all=False)
 
     def _inotify_file(self, event):
@@ -112,50 +281,264 @@ class Tail(logshipper.input.BaseInput):
         tail = self.tails.get(event.path)
         if tail:
             if event.mask & pyinotify.IN_MODIFY:
-                if tail.rescan:
-                    self.process_tail(event.path)
-                else:
-                    self.read_tail(tail)
+                self.modified(tail)
             else:
                 tail.rescan = True
 
     def _inotify_dir(self, event):
         LOG.debug("dir notified %r", event)
-        tail = self.tails.get(event.path)
-        if tail:
-            self.process_tail(event.path)
+        if event.mask & pyinotify.IN_MODIFY:
+            tail = self.tails.get(event.pathname)
+            if tail:
+                self.modified(tail)
+            return
+
+        if event.dir or not self.matcher.match(event.pathname):
+            return
 
-        if not event.dir:
-            self.update_tails(self.globs)
+        # Only the file in the event is affected, no need to glob. Events may
+        # be outdated by the time they're handled, so rather than trusting
+        # the kind of event, look at the file as it is now.
+        path = event.pathname
+        if os.path.exists(path):
+            self.process_tail(path)
+        else:
+            tail = self.tails.pop(path, None)
+            if tail:
+                LOG.info("%s vanished. Stop tailing", path)
+                if tail.file_descriptor is not None:
+                    self.read_tail(tail, drain=True)
+                self.close_tail(tail)
+
+    def modified(self, tail):
+        if self.coalesce is None:
+            self.refresh_tail(tail)
+            return
+
+        self.dirty[tail.path] = tail
+        if self.drainer is None:
+            self.drainer = eventlet.spawn_after(self.coalesce,
+                                                self._drain_dirty)
+
+    def _drain_dirty(self):
+        self.drainer = None
+        dirty, self.dirty = self.dirty, collections.OrderedDict()
+        for path, tail in dirty.items():
+            if self.tails.get(path) is not tail:
+                continue  # Closed in the mean time
+
+            try:
+                self.refresh_tail(tail)
+            except Exception:
+                LOG.exception("Unable to read %s", path)
+
+    def refresh_tail(self, tail):
+        if tail.rescan:
+            self.process_tail(tail.path)
+        else:
+            self.read_tail(tail)
 
     def run(self):
-        self.update_tails(self.globs, do_read_all=False)
+        checkpointer = None
         try:
-            while self.should_run:
-                self.notifier.loop(lambda _: not self.should_run)
+            if self.catch_up:
+                self.catch_up_rotated()
+
+            self.update_tails(self.globs, do_read_all=False)
+            if self.registry:
+                checkpointer = eventlet.spawn(self._checkpoint_loop)
+
+            self.watcher.loop()
         finally:
+            for thread in (self.poller, self.scheduler, self.drainer):
+                if thread:
+                    thread.kill()
+            self.poller = self.scheduler = self.drainer = None
+
+            if checkpointer:
+                checkpointer.kill()
+                self.checkpoint()
+
+                # Incomplete lines are read again after a restart
+                for tail in self.tails.values():
+                    tail.buffer = b""
+
             self.update_tails([])
+            self.watcher.close()
+            self.dir_watches = {}
 
-    def read_tail(self, tail):
+    def _checkpoint_loop(self):
         while True:
-            buff = os.read(tail.file_descriptor, 1024)
-            if not buff:
+            eventlet.sleep(self.checkpoint_interval)
+            try:
+                self.checkpoint()
+            except Exception:
+                LOG.exception("Unable to save the offset registry")
+
+    def checkpoint(self):
+        """Saves the offsets of all tailed files to the registry"""
+        entries = []
+        for path, tail in self.tails.items():
+            if tail.file_descriptor is None:
+                offset = tail.offset
+            else:
+                if len(tail.head) < logshipper.registry.FINGERPRINT_SIZE:
+                    tail.head = self.read_head(tail.file_descriptor)
+                offset = os.lseek(tail.file_descriptor, 0, os.SEEK_CUR)
+
+            # Incomplete lines weren't emitted yet
+            entries.append((tail.stat, tail.head, offset - len(tail.buffer),
+                            path))
+
+        self.registry.update(entries)
+        self.registry.save()
+
+    @staticmethod
+    def read_head(file_descriptor):
+        pos = os.lseek(file_descriptor, 0, os.SEEK_CUR)
+        os.lseek(file_descriptor, 0, os.SEEK_SET)
+        head = os.read(file_descriptor, logshipper.registry.FINGERPRINT_SIZE)
+        os.lseek(file_descriptor, pos, os.SEEK_SET)
+        return head
+
+    def read_tail(self, tail, drain=False):
+        """Reads and emits new lines, up to the read budget.
+
+        When more data is pending, the tail is scheduled to continue after
+        the other scheduled tails had their turn, unless ``drain`` is set.
+
+        Emitting may block, a tail is only read by one greenthread at a time
+        so its lines stay in order.
+        """
+        if tail.scheduled and not drain:
+            return  # It'll get its turn
+
+        while tail.reading is not None:
+            if not drain:
+                return  # The reader continues until there's nothing left
+            tail.reading.wait()
+
+        tail.reading = eventlet.event.Event()
+        try:
+            self._read_tail(tail, drain)
+        finally:
+            reading, tail.reading = tail.reading, None
+            reading.send()
+
+    def _read_tail(self, tail, drain):
+        file_descriptor = self.ensure_open(tail)
+        budget = self.read_budget
+        while True:
+            if budget <= 0 and not drain:
+                self.schedule(tail)
                 return
 
-            buff = buff.decode('utf8')
+            size = tail.read_size if drain else min(tail.read_size, budget)
+            chunk = os.read(file_descriptor, size)
+            if not chunk:
+                return
+
+            self.bytes_read += len(chunk)
+            budget -= len(chunk)
+
+            # Read more at once while catching up, less when following
+            if len(chunk) == size:
+                tail.read_size = min(tail.read_size * 2, MAX_READ_SIZE)
+            elif tail.read_size > MIN_READ_SIZE:
+                tail.read_size = max(tail.read_size // 2, MIN_READ_SIZE)
 
-            # Append to last buffer
+            # Append to the incomplete line from the previous read
             if tail.buffer:
-                buff = tail.buffer + buff
-                tail.buffer = ""
+                chunk = tail.buffer + chunk
+
+            lines, tail.buffer = split_lines(chunk)
+            if lines:
+                self.emit_many([{'message': line} for line in lines],
+                               tail.path)
+
+    def catch_up_rotated(self):
+        """Reads rotated files which changed since the last checkpoint"""
+        if self.registry.saved_at is None:
+            return  # No idea what was read before
+
+        mtimes = {}
+        for fileglob in self.globs:
+            for suffix in ROTATED_SUFFIXES:
+                for path in glob.iglob(fileglob + suffix):
+                    # Files matching the globs are tailed as usual
+                    if path not in mtimes and not self.matcher.match(path):
+                        mtimes[path] = os.stat(path).st_mtime
+
+        for path in sorted(mtimes, key=mtimes.get):
+            try:
+                self.catch_up_file(path, mtimes[path])
+            except Exception:
+                LOG.exception("Unable to catch up on %s", path)
+
+    def catch_up_file(self, path, mtime):
+        rotated, compressed = open_rotated(path)
+        with rotated:
+            head = rotated.read(logshipper.registry.FINGERPRINT_SIZE)
+            offset = None
+            if not compressed:
+                offset = self.registry.lookup(os.fstat(rotated.fileno()),
+                                              head)
+            if offset is None:
+                offset = self.registry.lookup_fingerprint(head)
+            if offset is None:
+                if mtime <= self.registry.saved_at:
+                    return
+                offset = 0
+
+            LOG.info("Catching up on %s from offset %d", path, offset)
+            rotated.seek(offset)
+
+            start_time = time.time()
+            count = 0
+            buff = b""
+            while True:
+                chunk = rotated.read(MIN_READ_SIZE)
+                if not chunk:
+                    break
+
+                lines, buff = split_lines(buff + chunk)
+                if lines:
+                    self.emit_many([{'message': line} for line in lines],
+                                   path)
 
-            lines = buff.splitlines(True)
-            if lines[-1][-1] != "\n":  # incomplete line in buffer
-                tail.buffer = lines[-1][-1]
-                lines = lines[:-1]
+                # Leave room for everything else
+                count += len(lines)
+                eventlet.sleep(max(count / self.catch_up_rate -
+                                   (time.time() - start_time), 0))
 
-            for line in lines:
-                self.handler({'message': line[:-1]})
+            if buff:
+                self.emit({'message': buff.decode('utf8', 'replace')}, path)
+            self.flush_multiline(path)
+
+    def schedule(self, tail):
+        if not tail.scheduled:
+            tail.scheduled = True
+            self.ready.append(tail)
+
+        if self.scheduler is None:
+            self.scheduler = eventlet.spawn(self._schedule_loop)
+
+    def _schedule_loop(self):
+        try:
+            while self.ready:
+                eventlet.sleep(0)  # Let everything else have its turn too
+
+                tail = self.ready.popleft()
+                tail.scheduled = False
+                if self.tails.get(tail.path) is not tail:
+                    continue  # Closed in the mean time
+
+                try:
+                    self.read_tail(tail)
+                except Exception:
+                    LOG.exception("Unable to read %s", tail.path)
+        finally:
+            self.scheduler = None
 
     def process_tail(self, path, should_seek=False):
         file_stat = os.stat(path)
@@ -163,18 +546,24 @@ class Tail(logshipper.input.BaseInput):
         LOG.debug("process_tail for %s", path)
         # Find or create a tail.
         tail = self.tails.get(path)
-        if tail:
+        rotated = tail and (tail.stat.st_size > file_stat.st_size or
+                            tail.stat.st_ino != file_stat.st_ino)
+        if tail and tail.file_descriptor is None:
+            # Closed by the LRU, there's no old file to drain when rotated
+            if not rotated and file_stat.st_size > tail.offset:
+                self.read_tail(tail)
+        elif tail:
             fd_stat = os.fstat(tail.file_descriptor)
             pos = os.lseek(tail.file_descriptor, 0, os.SEEK_CUR)
             if fd_stat.st_size > pos:
                 LOG.debug("Something to read")
-                self.read_tail(tail)
-            if (tail.stat.st_size > file_stat.st_size or
-                    tail.stat.st_ino != file_stat.st_ino):
-                LOG.info("%s looks rotated. reopening", path)
-                self.close_tail(tail)
-                tail = None
-                should_seek = False
+                self.read_tail(tail, drain=rotated)
+
+        if rotated:
+            LOG.info("%s looks rotated. reopening", path)
+            self.close_tail(tail)
+            tail = None
+            should_seek = False
 
         if not tail:
             LOG.info("Tailing %s", path)
@@ -198,15 +587,28 @@ class Tail(logshipper.input.BaseInput):
             LOG.info("%s vanished. Stop tailing", vanished)
             self.close_tail(self.tails.pop(vanished))
 
+        dir_mask = INOTIFY_DIR_MASK
+        if self.max_open_files:
+            dir_mask |= pyinotify.IN_MODIFY
+
         for path in globs:
             while len(path) > 1:
                 path = os.path.dirname(path)
                 if path not in self.dir_watches:
                     LOG.debug("Monitoring dir %s", path)
 
-                    self.dir_watches[path] = self.watch_manager.add_watch(
-                        path, INOTIFY_DIR_MASK, do_glob=True,
-                        proc_fun=self._inotify_dir)
+                    if MAGIC.search(path):
+                        directories = glob.glob(path)
+                    else:
+                        directories = [path]
+
+                    self.dir_watches[path] = [
+                        self.watcher.add_watch(directory, dir_mask,
+                                               self._inotify_dir)
+                        for directory in directories]
+
+                    if None in self.dir_watches[path]:
+                        self.start_polling()
 
                 if '*' not in path and '?' not in path:
                     break
@@ -216,19 +618,103 @@ class Tail(logshipper.input.BaseInput):
         tail.file_descriptor = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
         tail.path = path
 
+        if self.registry:
+            tail.head = self.read_head(tail.file_descriptor)
+
+        if go_to_end and self.registry:
+            offset = self.registry.lookup(os.fstat(tail.file_descriptor),
+                                          tail.head)
+            if offset is not None:
+                LOG.info("Resuming %s at offset %d", path, offset)
+                os.lseek(tail.file_descriptor, offset, os.SEEK_SET)
+                go_to_end = False
+            elif (self.registry.saved_at is not None and
+                    os.fstat(tail.file_descriptor).st_mtime >
+                    self.registry.saved_at):
+                LOG.info("Reading %s from the start, it changed since the "
+                         "last checkpoint", path)
+                go_to_end = False
+
         if go_to_end:
             os.lseek(tail.file_descriptor, 0, os.SEEK_END)
 
-        watch_descriptor = self.watch_manager.add_watch(
-            path, INOTIFY_FILE_MASK,
-            proc_fun=self._inotify_file)
+        if self.max_open_files:
+            # The directory watch reports modifications
+            self.touch(tail)
+            return tail
 
-        tail.watch_descriptor = watch_descriptor.pop(path)
+        tail.watch = self.watcher.add_watch(path, INOTIFY_FILE_MASK,
+                                            self._inotify_file)
+        if tail.watch is None:
+            self.start_polling()
         return tail
 
-    def close_tail(self, tail):
-        self.watch_manager.rm_watch(tail.watch_descriptor)
-        os.close(tail.file_descriptor)
+    def ensure_open(self, tail):
+        """Returns the file descriptor of tail, reopening it if needed"""
+        if tail.file_descriptor is None:
+            file_descriptor = os.open(tail.path, os.O_RDONLY | os.O_NONBLOCK)
+            fd_stat = os.fstat(file_descriptor)
+            if (fd_stat.st_ino != tail.stat.st_ino or
+                    fd_stat.st_size < tail.offset):
+                LOG.info("%s was replaced while closed", tail.path)
+                self.flush_buffer(tail)
+                tail.offset = 0
+                tail.head = b""
+                tail.stat = fd_stat
+
+            os.lseek(file_descriptor, tail.offset, os.SEEK_SET)
+            tail.file_descriptor = file_descriptor
+
+        if self.max_open_files:
+            self.touch(tail)
+        return tail.file_descriptor
+
+    def touch(self, tail):
+        """Marks tail as recently used, closing the least recently used"""
+        self.open_tails.pop(tail.path, None)
+        self.open_tails[tail.path] = tail
+
+        while len(self.open_tails) > self.max_open_files:
+            _path, idle = self.open_tails.popitem(last=False)
+            idle.offset = os.lseek(idle.file_descriptor, 0, os.SEEK_CUR)
+            os.close(idle.file_descriptor)
+            idle.file_descriptor = None
+
+    def start_polling(self):
+        if self.poller is None:
+            LOG.warning("Unable to add inotify watches, polling for "
+                        "changes instead")
+            self.poller = eventlet.spawn(self._poll_loop)
+
+    def _poll_loop(self):
+        interval = MIN_POLL_INTERVAL
+        while True:
+            eventlet.sleep(interval)
+            bytes_read = self.bytes_read
+            try:
+                self.update_tails(self.globs)
+            except Exception:
+                LOG.exception("Unable to poll files")
+
+            if self.bytes_read != bytes_read:
+                interval = MIN_POLL_INTERVAL
+            else:
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    def flush_buffer(self, tail):
         if tail.buffer:
             LOG.debug("Generating message from tail buffer")
-            self.handler({'message': tail.buffer})
+            self.emit({'message': tail.buffer.decode('utf8', 'replace')},
+                      tail.path)
+            tail.buffer = b""
+
+    def close_tail(self, tail):
+        if tail.watch is not None:
+            self.watcher.rm_watch(tail.watch)
+            tail.watch = None
+        if tail.file_descriptor is not None:
+            os.close(tail.file_descriptor)
+            tail.file_descriptor = None
+        self.open_tails.pop(tail.path, None)
+        self.flush_buffer(tail)
+        self.flush_multiline(tail.path)
@@ -0,0 +1,44 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import unittest
+import zlib
+
+import logshipper.compression
+
+
+class Tests(unittest.TestCase):
+    def test_gzip(self):
+        compress = logshipper.compression.prepare_compressor('gzip', 9)
+        self.assertEqual(compress.encoding, 'gzip')
+
+        data = b"log line\n" * 100
+        self.assertEqual(zlib.decompress(compress(data), 16 + zlib.MAX_WBITS),
+                         data)
+
+    def test_deflate_threaded(self):
+        compress = logshipper.compression.prepare_compressor(
+            'deflate', threshold=10)
+
+        data = b"log line\n" * 100
+        self.assertEqual(zlib.decompress(compress(data)), data)
+
+    def test_disabled(self):
+        self.assertIsNone(logshipper.compression.prepare_compressor(None))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            logshipper.compression.prepare_compressor('brotli')
@@ -14,6 +14,7 @@
 #    under the License.
 
 
+import re
 import unittest
 
 import logshipper.context
@@ -61,3 +62,25 @@ class Tests(unittest.TestCase):
 
         with self.assertRaises(TypeError):
             logshipper.context.prepare_template(Foo())
+
+    def test_lazy_backreferences(self):
+        context = logshipper.context.Context({"foo": "bar"}, None)
+        self.assertEqual(context.backreferences, [])
+        self.assertIsNone(context.matches)
+
+        match = re.search("(b)a(r)", "bar")
+        context.set_match("foo", match)
+        self.assertIsNone(context._backreferences)
+        self.assertEqual(context.backreferences, ["bar", "b", "r"])
+        self.assertEqual(context.matches, {"foo": match})
+
+        template = logshipper.context.prepare_template("{foo}")
+        context.next_step()
+        context.set_match("foo", match)
+        self.assertEqual(template.interpolate(context), "bar")
+        self.assertIsNone(context._backreferences)
+
+        context.reset()
+        self.assertIsNone(context.message)
+        self.assertIsNone(context.match)
+        self.assertEqual(context.backreferences, [])
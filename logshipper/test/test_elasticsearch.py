@@ -15,16 +15,79 @@
 
 
 import datetime
+import json
+import threading
 import unittest
+import zlib
 
+import eventlet
 import mock
 import requests
+from six.moves import BaseHTTPServer
 
 import logshipper.context
 import logshipper.elasticsearch
+import logshipper.serialize
+
+
+class StandInServer(object):
+    """Minimal HTTP server standing in for elasticsearch.
+
+    Runs in a native thread, as requests isn't green in the tests. Bulk
+    requests are recorded as lists of documents, and answered by calling
+    ``respond`` with those documents, which should return a status code and
+    a response document.
+    """
+
+    def __init__(self, respond=None):
+        self.requests = []
+        self.encodings = []
+        self.respond = respond or (lambda documents: (200, {
+            "errors": False,
+            "items": [{"index": {"status": 201}} for _ in documents]}))
+
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                server.encodings.append(self.headers['Content-Encoding'])
+                if self.headers['Content-Encoding'] == 'gzip':
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                elif self.headers['Content-Encoding'] == 'deflate':
+                    body = zlib.decompress(body)
+                lines = body.decode('utf8').splitlines()
+                documents = [json.loads(line) for line in lines[1::2]]
+                server.requests.append((self.path, documents))
+
+                status, response = server.respond(documents)
+                response = json.dumps(response).encode('utf8')
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:%i/" % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
 
 class Tests(unittest.TestCase):
+    def setUp(self):
+        # The expected documents are formatted like the standard library does
+        patcher = mock.patch.object(logshipper.serialize, 'dumps',
+                                    logshipper.serialize.dumps_stdlib)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_elasticsearch_http(self):
         class Foo(object):
@@ -39,7 +102,7 @@ class Tests(unittest.TestCase):
         context = logshipper.context.Context(message, None)
 
         with mock.patch.object(requests.Session, 'put') as mock_method:
-            mock_method.return_value = mock.Mock()
+            mock_method.return_value = mock.Mock(status_code=201)
             handler = logshipper.elasticsearch.prepare_elasticsearch_http(
                 {'id': "1", 'sort_keys': 1})
 
@@ -59,7 +122,7 @@ class Tests(unittest.TestCase):
         context = logshipper.context.Context(message, None)
 
         with mock.patch.object(requests.Session, 'put') as mock_method:
-            mock_method.return_value = mock.Mock()
+            mock_method.return_value = mock.Mock(status_code=201)
             handler = logshipper.elasticsearch.prepare_elasticsearch_http({
                 'sort_keys': 1,
                 'timestamp': "timestamp",
@@ -73,6 +136,36 @@ class Tests(unittest.TestCase):
                 data=(b'{"message": "This is a test.", '
                       b'"timestamp": "2008-10-19T14:40:00.000009"}'))
 
+    def test_elasticsearch_autoid_encoders(self):
+        def dumps_compact(value, sort_keys=False):
+            return json.dumps(value, default=str, sort_keys=sort_keys,
+                              separators=(',', ':')).encode('utf8')
+
+        encoders = [logshipper.serialize.dumps_stdlib, dumps_compact]
+        if logshipper.serialize.orjson is not None:
+            encoders.append(logshipper.serialize.dumps_orjson)
+
+        urls = set()
+        for encoder in encoders:
+            message = {
+                "message": "This is a test.",
+                "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+            }
+            context = logshipper.context.Context(message, None)
+
+            with mock.patch.object(logshipper.serialize, 'dumps', encoder), \
+                    mock.patch.object(requests.Session, 'put') as put:
+                put.return_value = mock.Mock(status_code=201)
+                handler = logshipper.elasticsearch.prepare_elasticsearch_http(
+                    {'sort_keys': 1, 'timestamp': "timestamp"})
+                handler(message, context)
+                urls.add(put.call_args[0][0])
+
+        # Ids don't depend on the installed encoder
+        self.assertEqual(urls, set([
+            'http://localhost:9200/logshipper-2008.10.19/log/'
+            '184162c2c5d7e33406fcbb78ef1f968e']))
+
     def test_elasticsearch_doc(self):
         message = {
             "message": "This is a test.",
@@ -82,7 +175,7 @@ class Tests(unittest.TestCase):
         context = logshipper.context.Context(message, None)
 
         with mock.patch.object(requests.Session, 'put') as mock_method:
-            mock_method.return_value = mock.Mock()
+            mock_method.return_value = mock.Mock(status_code=201)
             handler = logshipper.elasticsearch.prepare_elasticsearch_http({
                 'sort_keys': 1,
                 "document": {"ma": "{message}"},
@@ -97,3 +190,233 @@ class Tests(unittest.TestCase):
             mock_method.assert_called_once_with(
                 'http://somehost/foo-2008-10/test/1',
                 data=(b'{"ma": "This is a test."}'))
+
+    def test_elasticsearch_bulk(self):
+        server = StandInServer()
+        self.addCleanup(server.stop)
+
+        handler = logshipper.elasticsearch.prepare_elasticsearch_http({
+            'url': server.url,
+            'id': "{message}",
+            'bulk': {'documents': 2},
+        })
+
+        for i in range(3):
+            message = {
+                "message": "%i" % i,
+                "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+            }
+            handler(message, logshipper.context.Context(message, None))
+
+        eventlet.sleep()  # let the background request run
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(server.requests[0][0], "/_bulk")
+        self.assertEqual([doc['message'] for doc in server.requests[0][1]],
+                         ["0", "1"])
+
+        handler.flush()
+        self.assertEqual([doc['message'] for doc in server.requests[1][1]],
+                         ["2"])
+
+    def test_elasticsearch_bulk_item_errors(self):
+        def respond(documents):
+            status = {"retry": 429, "reject": 400, "ok": 201}
+            return 200, {"errors": True, "items": [
+                {"index": {"status": status[doc['message']]}}
+                for doc in documents]}
+
+        server = StandInServer(respond)
+        self.addCleanup(server.stop)
+
+        handler = logshipper.elasticsearch.prepare_elasticsearch_http({
+            'url': server.url,
+            'bulk': {'retries': 1},
+        })
+
+        for text in ("ok", "retry", "reject"):
+            message = {
+                "message": text,
+                "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+            }
+            handler(message, logshipper.context.Context(message, None))
+
+        handler.flush()
+        handler.flush()
+        handler.flush()
+
+        self.assertEqual([[doc['message'] for doc in documents]
+                          for (_, documents) in server.requests],
+                         [["ok", "retry", "reject"], ["retry"]])
+
+    def test_elasticsearch_failover(self):
+        broken = StandInServer(lambda documents: (503, {}))
+        self.addCleanup(broken.stop)
+        working = StandInServer()
+        self.addCleanup(working.stop)
+
+        handler = logshipper.elasticsearch.prepare_elasticsearch_http({
+            'url': [broken.url, working.url],
+            'bulk': {'documents': 1, 'concurrency': 2},
+        })
+
+        for i in range(4):
+            message = {
+                "message": "%i" % i,
+                "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+            }
+            handler(message, logshipper.context.Context(message, None))
+        handler.flush()
+
+        # The broken node got one request, after which it was evicted
+        self.assertEqual(len(broken.requests), 1)
+        self.assertEqual(sorted(doc['message']
+                                for (_, documents) in working.requests
+                                for doc in documents),
+                         ["0", "1", "2", "3"])
+
+    def test_elasticsearch_http_failover(self):
+        def put(url, data):
+            response = requests.Response()
+            response.status_code = 503 if url.startswith("http://a") else 201
+            response.url = url
+            return response
+
+        handler = logshipper.elasticsearch.prepare_elasticsearch_http({
+            'url': ["http://a:9200/", "http://b:9200/"],
+        })
+
+        with mock.patch.object(requests.Session, 'put',
+                               side_effect=put) as mock_method:
+            for i in range(4):
+                message = {
+                    "message": "%i" % i,
+                    "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0),
+                }
+                context = logshipper.context.Context(message, None)
+                try:
+                    handler(message, context)
+                except requests.HTTPError:
+                    pass
+
+        # The failing node got one request, after which it was evicted
+        urls = [call[0][0] for call in mock_method.call_args_list]
+        self.assertEqual(len([url for url in urls
+                              if url.startswith("http://a")]), 1)
+        self.assertEqual(len(urls), 4)
+
+    def test_elasticsearch_bulk_overflow(self):
+        broken = StandInServer(lambda documents: (503, {}))
+        self.addCleanup(broken.stop)
+
+        handler = logshipper.elasticsearch.prepare_elasticsearch_http({
+            'url': broken.url,
+            'bulk': {'documents': 2},
+        })
+        spooled = []
+        handler.set_overflow(spooled.append)
+
+        for i in range(4):
+            message = {
+                "message": "%i" % i,
+                "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+            }
+            handler(message, logshipper.context.Context(message, None))
+        handler.flush()
+
+        # After the first failure, nothing is kept in memory
+        self.assertEqual(len(broken.requests), 1)
+        self.assertTrue(handler.saturated())
+        self.assertEqual(sorted(json.loads(document)['message']
+                                for (_, document) in spooled),
+                         ["0", "1", "2", "3"])
+
+    def test_connection_pool_size(self):
+        with mock.patch.object(requests.adapters, 'HTTPAdapter') as adapter:
+            logshipper.elasticsearch.prepare_elasticsearch_http({})
+            adapter.assert_called_once_with(
+                pool_connections=1,
+                pool_maxsize=requests.adapters.DEFAULT_POOLSIZE)
+
+        with mock.patch.object(requests.adapters, 'HTTPAdapter') as adapter:
+            logshipper.elasticsearch.prepare_elasticsearch_http({
+                'bulk': {'concurrency': 4}})
+            adapter.assert_called_once_with(
+                pool_connections=1, pool_maxsize=4)
+
+    def test_node_pool_least_outstanding(self):
+        pool = logshipper.elasticsearch.NodePool(["http://a", "http://b/"],
+                                                 'least_outstanding')
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertNotEqual(first, second)
+        self.assertEqual(second.url[-1], "/")
+
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+
+    def test_adaptive_limits(self):
+        limits = logshipper.elasticsearch.AdaptiveLimits(
+            documents=100, concurrency=2, min_documents=50,
+            max_documents=200, max_concurrency=4, target_latency=1.0)
+
+        limits.success(0.1)
+        limits.success(0.1)
+        self.assertEqual((limits.documents, limits.concurrency), (200, 2))
+        limits.success(0.1)
+        self.assertEqual((limits.documents, limits.concurrency), (200, 3))
+
+        limits.success(2.0)
+        self.assertEqual(limits.documents, 160)
+
+        limits.rejected()
+        self.assertEqual((limits.documents, limits.concurrency), (80, 1))
+        limits.rejected()
+        self.assertEqual((limits.documents, limits.concurrency), (50, 1))
+
+    def test_elasticsearch_throttled(self):
+        responses = [(429, {})]
+
+        def respond(documents):
+            if responses:
+                return responses.pop()
+            return 200, {"errors": False, "items": [
+                {"index": {"status": 201}} for _ in documents]}
+
+        server = StandInServer(respond)
+        self.addCleanup(server.stop)
+
+        handler = logshipper.elasticsearch.prepare_elasticsearch_http({
+            'url': server.url,
+            'bulk': {'adaptive': True},
+        })
+
+        message = {
+            "message": "throttled",
+            "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+        }
+        handler(message, logshipper.context.Context(message, None))
+        handler.flush()
+
+        # Retried after the 429, and not lost
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(server.requests[1][1][0]['message'], "throttled")
+
+    def test_elasticsearch_compression(self):
+        server = StandInServer()
+        self.addCleanup(server.stop)
+
+        handler = logshipper.elasticsearch.prepare_elasticsearch_http({
+            'url': server.url,
+            'bulk': True,
+            'compression': 'gzip',
+        })
+
+        message = {
+            "message": "compressed",
+            "timestamp": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+        }
+        handler(message, logshipper.context.Context(message, None))
+        handler.flush()
+
+        self.assertEqual(server.encodings, ['gzip'])
+        self.assertEqual(server.requests[0][1][0]['message'], "compressed")
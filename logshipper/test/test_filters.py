@@ -44,6 +44,18 @@ class Tests(unittest.TestCase):
         self.assertEqual(context.match_field, None)
         self.assertEqual(context.backreferences, [])
 
+    def test_match_batch(self):
+        handler = logshipper.filters.prepare_match("t(?P<x>.)st")
+        contexts = [logshipper.context.Context({"message": text}, None)
+                    for text in ("This is a test.", "No match")]
+
+        results = handler.handle_batch(contexts)
+
+        self.assertEqual(results, [None, logshipper.filters.SKIP_STEP])
+        self.assertEqual(contexts[0].backreferences, ['test', 'e'])
+        self.assertEqual(contexts[0].message['x'], 'e')
+        self.assertEqual(contexts[1].backreferences, [])
+
     def test_match_n(self):
         handler = logshipper.filters.prepare_match({"message": "(t.st)",
                                                     "foo": "(?P<boo>b.r)"})
@@ -193,6 +205,38 @@ class Tests(unittest.TestCase):
         date = datetime.datetime(2014, 11, 13, 1, 22, 22, 0)
         self.assertEqual(message, {"foo": date})
 
+    def test_strptime_batch(self):
+        handler = logshipper.filters.prepare_strptime({
+            "field": "foo",
+            "format": "%Y-%m-%d %H:%M:%S",
+        })
+        contexts = [logshipper.context.Context({"foo": value}, None)
+                    for value in ("2014-11-13 01:22:22",
+                                  "2014-11-13 01:22:22",
+                                  "2014-11-13 01:22:23")]
+
+        handler.handle_batch(contexts)
+
+        self.assertEqual([context.message['foo'] for context in contexts],
+                         [datetime.datetime(2014, 11, 13, 1, 22, 22),
+                          datetime.datetime(2014, 11, 13, 1, 22, 22),
+                          datetime.datetime(2014, 11, 13, 1, 22, 23)])
+
+    def test_strptime_batch_error(self):
+        handler = logshipper.filters.prepare_strptime({
+            "field": "foo",
+            "format": "%Y",
+        })
+        contexts = [logshipper.context.Context({"foo": value}, None)
+                    for value in ("2014", "bad", "2015")]
+
+        with self.assertRaises(ValueError):
+            handler.handle_batch(contexts)
+
+        # The batch can be retried per message
+        self.assertEqual([context.message['foo'] for context in contexts],
+                         ["2014", "bad", "2015"])
+
     def test_parse_timedelta(self):
         self.assertEqual(logshipper.filters.parse_timedelta('1d2h  5m '),
                          datetime.timedelta(days=1, hours=2, minutes=5))
@@ -0,0 +1,142 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import eventlet
+import pyinotify
+
+import logshipper.inotify
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.hub = logshipper.inotify.Hub()
+
+    def tearDown(self):
+        if self.hub.thread:
+            self.hub.thread.kill()
+        self.hub.notifier.stop()
+        shutil.rmtree(self.path)
+
+    def touch(self, name):
+        with open(os.path.join(self.path, name), 'w'):
+            pass
+        eventlet.sleep(0.01)
+
+    def watch(self, mask=pyinotify.IN_CREATE):
+        events = []
+        watcher = logshipper.inotify.Watcher(self.hub)
+        subscription = watcher.add_watch(
+            self.path, mask, lambda event: events.append(event.name))
+        thread = eventlet.spawn(watcher.loop)
+        self.addCleanup(thread.kill)
+        return watcher, subscription, events
+
+    def test_shared_watch(self):
+        watcher1, subscription1, events1 = self.watch()
+        watcher2, subscription2, events2 = self.watch(
+            pyinotify.IN_CLOSE_WRITE)
+        self.assertEqual(len(self.hub.watch_manager.watches), 1)
+
+        self.touch("a")
+        self.assertEqual(events1, ["a"])
+        self.assertEqual(events2, ["a"])
+
+        watcher1.rm_watch(subscription1)
+        self.touch("b")
+        self.assertEqual(events1, ["a"])
+        self.assertEqual(events2, ["a", "b"])
+
+        watcher2.close()
+        self.assertEqual(self.hub.subscriptions, {})
+
+    def test_coalesce(self):
+        watcher = logshipper.inotify.Watcher(self.hub)
+        events = []
+        watcher.add_watch(self.path, pyinotify.IN_MODIFY | pyinotify.IN_DELETE,
+                          lambda event: events.append((event.name,
+                                                       event.maskname)))
+
+        # Nothing is handled until the loop runs, like a blocked subscriber
+        with open(os.path.join(self.path, "a"), 'w') as f:
+            for i in range(100):
+                f.write("line\n")
+                f.flush()
+                eventlet.sleep(0)
+        eventlet.sleep(0.01)
+        self.assertEqual(len(watcher.events), 1)
+
+        os.unlink(os.path.join(self.path, "a"))
+        eventlet.sleep(0.01)
+        self.assertEqual(len(watcher.events), 2)
+
+        thread = eventlet.spawn(watcher.loop)
+        self.addCleanup(thread.kill)
+        eventlet.sleep(0.01)
+        self.assertEqual(events, [("a", "IN_MODIFY"), ("a", "IN_DELETE")])
+        watcher.close()
+
+    def test_rotated_path(self):
+        path = os.path.join(self.path, "app.log")
+        open(path, 'w').close()
+
+        watchers = []
+        for i in range(2):
+            events = []
+            watcher = logshipper.inotify.Watcher(self.hub)
+            subscription = watcher.add_watch(
+                path, pyinotify.IN_MODIFY,
+                lambda event, events=events: events.append(event.wd))
+            thread = eventlet.spawn(watcher.loop)
+            self.addCleanup(thread.kill)
+            watchers.append((watcher, subscription, events))
+        self.assertEqual(len(self.hub.subscriptions), 1)
+
+        # The second subscriber follows the rotation, the first doesn't
+        os.rename(path, path + ".1")
+        open(path, 'w').close()
+        watcher, subscription, events = watchers[1]
+        watcher.rm_watch(subscription)
+        new = watcher.add_watch(path, pyinotify.IN_MODIFY,
+                                lambda event: events.append(event.wd))
+        self.assertNotEqual(new.wd, subscription.wd)
+
+        for name in ("app.log", "app.log.1"):
+            with open(os.path.join(self.path, name), 'a') as f:
+                f.write("line\n")
+            eventlet.sleep(0.01)
+
+        self.assertEqual(watchers[0][2], [subscription.wd])
+        self.assertEqual(watchers[1][2], [new.wd])
+
+    def test_missing_path(self):
+        watcher = logshipper.inotify.Watcher(self.hub)
+        self.assertIsNone(watcher.add_watch(self.path + "/missing",
+                                            pyinotify.IN_CREATE, None))
+        self.assertEqual(watcher.subscriptions, set())
+
+    def test_deleted_path(self):
+        watcher, subscription, events = self.watch()
+        os.rmdir(self.path)
+        eventlet.sleep(0.01)
+        self.assertEqual(self.hub.subscriptions, {})
+
+        watcher.close()  # removing the subscription is harmless
+        os.mkdir(self.path)
@@ -61,3 +61,39 @@ class Test(unittest.TestCase):
         input_handler.stop()
         eventlet.sleep()
         self.assertEqual(status[0], "stopped")
+
+    def test_emit_many(self):
+        input_handler = logshipper.input.BaseInput()
+        single = []
+        batches = []
+
+        input_handler.set_handler(single.append)
+        input_handler.emit_many([{'message': u'1'}, {'message': u'2'}])
+        self.assertEqual([m['message'] for m in single], [u'1', u'2'])
+        self.assertIn('timestamp', single[0])
+        self.assertIn('hostname', single[0])
+
+        input_handler.set_handler(single.append, batches.append)
+        input_handler.emit_many([{'message': u'3'}, {'message': u'4'}])
+        self.assertEqual(len(single), 2)
+        self.assertEqual([[m['message'] for m in batch] for batch in batches],
+                         [[u'3', u'4']])
+
+    def test_multiline(self):
+        input_handler = logshipper.input.BaseInput()
+        messages = []
+        input_handler.set_handler(messages.append)
+        input_handler.set_multiline({'indent': True})
+
+        input_handler.emit_many([{'message': u'Traceback:'},
+                                 {'message': u'  File "x.py"'}], 'a')
+        input_handler.emit({'message': u'unrelated'}, 'b')
+        input_handler.emit({'message': u'  ValueError'}, 'a')
+        input_handler.emit({'message': u'next'}, 'a')
+        self.assertEqual([m['message'] for m in messages],
+                         [u'Traceback:\n  File "x.py"\n  ValueError'])
+        self.assertIn('timestamp', messages[0])
+
+        input_handler.stop()
+        self.assertEqual(sorted(m['message'] for m in messages[1:]),
+                         [u'next', u'unrelated'])
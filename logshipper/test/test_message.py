@@ -0,0 +1,147 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import pickle
+import unittest
+
+import logshipper.context
+import logshipper.message
+import logshipper.serialize
+
+
+class Tests(unittest.TestCase):
+    def test_mapping(self):
+        message = logshipper.message.Message({"a": 1})
+        message["b"] = 2
+        message.update(c=3)
+        del message["a"]
+
+        self.assertEqual(message, {"b": 2, "c": 3})
+        self.assertEqual({"b": 2, "c": 3}, message)
+        self.assertEqual(sorted(message), ["b", "c"])
+        self.assertEqual(len(message), 2)
+        self.assertNotIn("a", message)
+        self.assertEqual(message.get("a", 4), 4)
+        self.assertEqual(message.pop("b"), 2)
+        self.assertRaises(KeyError, message.__getitem__, "a")
+        self.assertRaises(KeyError, message.__delitem__, "a")
+
+    def test_fork(self):
+        message = logshipper.message.Message({"a": 1, "b": 2})
+        fork = message.fork()
+
+        message["a"] = 10
+        fork["c"] = 3
+        del fork["b"]
+
+        self.assertEqual(message, {"a": 10, "b": 2})
+        self.assertEqual(fork, {"a": 1, "c": 3})
+
+        fork2 = fork.fork()
+        del fork2["a"]
+        fork["a"] = 5
+        self.assertEqual(fork, {"a": 5, "c": 3})
+        self.assertEqual(fork2, {"c": 3})
+        self.assertEqual(message, {"a": 10, "b": 2})
+
+    def test_deep_fork(self):
+        message = logshipper.message.Message()
+        for i in range(logshipper.message.MAX_DEPTH * 3):
+            message[i] = i
+            message.fork()[i] = -1
+        self.assertLessEqual(len(message._layers),
+                             logshipper.message.MAX_DEPTH)
+        self.assertEqual(message, dict((i, i) for i in range(i + 1)))
+
+    def test_fork_dict(self):
+        message = {"a": 1}
+        fork = logshipper.message.fork(message)
+        fork["a"] = 2
+        self.assertEqual(message, {"a": 1})
+
+    def test_pickle(self):
+        message = logshipper.message.Message({"a": 1}).fork()
+        message["b"] = 2
+        result = pickle.loads(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+        self.assertIsInstance(result, logshipper.message.Message)
+        self.assertEqual(result, {"a": 1, "b": 2})
+
+    def test_serialize(self):
+        message = logshipper.message.Message({
+            "timestamp": datetime.datetime(2016, 1, 1)}).fork()
+        message["a"] = 1
+        context = logshipper.context.Context(message, None)
+        self.assertEqual(
+            logshipper.serialize.serialize_message(context, sort_keys=True),
+            logshipper.serialize.dumps(
+                {"a": 1, "timestamp": datetime.datetime(2016, 1, 1)},
+                sort_keys=True))
+
+    def test_record(self):
+        timestamp = datetime.datetime(2016, 1, 2, 3, 4, 5, 6)
+        record = logshipper.message.Record({
+            "message": u"hello", "hostname": "host", "timestamp": timestamp,
+            "severity": "info"})
+
+        self.assertIsInstance(record._timestamp, int)
+        self.assertIn("timestamp", record)
+        self.assertNotIn("pid", record)
+        self.assertIsInstance(record._timestamp, int)
+        self.assertEqual(record["timestamp"], timestamp)
+        self.assertEqual(record, {"message": u"hello", "hostname": "host",
+                                  "timestamp": timestamp,
+                                  "severity": "info"})
+
+        record["pid"] = 123
+        del record["hostname"]
+        self.assertNotIn("hostname", record)
+        self.assertEqual(len(record), 4)
+        self.assertEqual(record.get("hostname", "x"), "x")
+        self.assertRaises(KeyError, record.__delitem__, "hostname")
+
+        record["timestamp"] = 12345
+        self.assertEqual(record["timestamp"], 12345)
+        self.assertIn("timestamp", record)
+        record["timestamp"] = "yesterday"
+        self.assertEqual(record["timestamp"], "yesterday")
+        self.assertEqual(len(record), 4)
+
+    def test_record_interning(self):
+        record1 = logshipper.message.Record({"hostname": "".join("ab")})
+        record2 = logshipper.message.Record()
+        record2["hostname"] = "".join("ab")
+        self.assertIs(record1["hostname"], record2["hostname"])
+
+    def test_record_fork(self):
+        record = logshipper.message.Record({"message": u"a", "field": 1})
+        fork = logshipper.message.fork(record)
+        fork["field"] = 2
+        fork["message"] = u"b"
+        self.assertEqual(record, {"message": u"a", "field": 1})
+        self.assertEqual(fork, {"message": u"b", "field": 2})
+
+        result = pickle.loads(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+        self.assertIsInstance(result, logshipper.message.Record)
+        self.assertEqual(result, record)
+
+    def test_record_template(self):
+        record = logshipper.message.Record({
+            "message": u"hello", "timestamp": datetime.datetime(2016, 1, 2),
+            "field": u"value"})
+        context = logshipper.context.Context(record, None)
+        template = logshipper.context.prepare_template(
+            "{message} {field} {timestamp:%Y}")
+        self.assertEqual(template.interpolate(context), u"hello value 2016")
@@ -0,0 +1,93 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import eventlet
+
+import logshipper.multiline
+
+
+def lines(*texts):
+    return [{'message': text} for text in texts]
+
+
+class Tests(unittest.TestCase):
+    def assemble(self, parameters, *batches):
+        emitted = []
+        assembler = logshipper.multiline.prepare_multiline(emitted.extend,
+                                                           parameters)
+        for batch in batches:
+            assembler.feed(batch)
+        assembler.flush_all()
+        return [m['message'] for m in emitted]
+
+    def test_start(self):
+        self.assertEqual(
+            self.assemble({'start': r'^\d{4}-'},
+                          lines("2014-11-13 error", "Traceback", "  File"),
+                          lines("ValueError", "2014-11-13 ok")),
+            ["2014-11-13 error\nTraceback\n  File\nValueError",
+             "2014-11-13 ok"])
+
+    def test_continuation(self):
+        self.assertEqual(
+            self.assemble({'continuation': r'^(\s|Caused by)'},
+                          lines("Exception", "\tat x", "Caused by: y",
+                                "\tat z", "next")),
+            ["Exception\n\tat x\nCaused by: y\n\tat z", "next"])
+
+    def test_indent(self):
+        self.assertEqual(
+            self.assemble({'indent': True},
+                          lines("a", " b", "\tc", "d")),
+            ["a\n b\n\tc", "d"])
+
+    def test_limits(self):
+        self.assertEqual(
+            self.assemble({'indent': True, 'max_lines': 2},
+                          lines("a", " b", " c", " d", " e")),
+            ["a\n b", " c\n d", " e"])
+        self.assertEqual(
+            self.assemble({'indent': True, 'max_length': 6},
+                          lines("a", " b", " c", " d")),
+            ["a\n b", " c\n d"])
+
+    def test_fields(self):
+        emitted = []
+        assembler = logshipper.multiline.prepare_multiline(
+            emitted.extend, {'indent': True})
+        assembler.feed([{'message': "a", 'level': 'error'},
+                        {'message': " b", 'level': 'debug'}])
+        assembler.flush()
+        self.assertEqual(emitted, [{'message': "a\n b", 'level': 'error'}])
+
+    def test_timeout(self):
+        emitted = []
+        assembler = logshipper.multiline.prepare_multiline(
+            emitted.extend, {'indent': True, 'timeout': 0.01})
+        assembler.feed(lines("a", " b"))
+        self.assertEqual(emitted, [])
+
+        eventlet.sleep(0.05)
+        self.assertEqual([m['message'] for m in emitted], ["a\n b"])
+        self.assertEqual(assembler.pending, {})
+
+    def test_bad_rules(self):
+        with self.assertRaises(ValueError):
+            logshipper.multiline.prepare_multiline(None, {})
+        with self.assertRaises(ValueError):
+            logshipper.multiline.prepare_multiline(
+                None, {'start': 'x', 'indent': True})
@@ -0,0 +1,98 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import unittest
+
+import eventlet
+
+import logshipper.context
+import logshipper.outputqueue
+
+
+def prepare_slow_output(delivered):
+    def handle_slow(message, context):
+        eventlet.sleep(0.01)
+        delivered.append((message, context.backreferences))
+    handle_slow.phase = 30
+    return handle_slow
+
+
+class Tests(unittest.TestCase):
+    def test_snapshot(self):
+        delivered = []
+        handler = logshipper.outputqueue.prepare_queue(
+            prepare_slow_output(delivered), True)
+
+        message = {"message": "1"}
+        context = logshipper.context.Context(message, None)
+        context.backreferences = ["1"]
+        handler(message, context)
+
+        message["message"] = "2"
+        context.next_step()
+        self.assertEqual(delivered, [])
+
+        handler.flush()
+        self.assertEqual(delivered, [({"message": "1"}, ["1"])])
+
+    def test_block(self):
+        delivered = []
+        handler = logshipper.outputqueue.prepare_queue(
+            prepare_slow_output(delivered), {"size": 2, "workers": 2})
+
+        for i in range(6):
+            message = {"message": i}
+            handler(message, logshipper.context.Context(message, None))
+
+        handler.flush()
+        self.assertEqual(sorted(m['message'] for (m, _) in delivered),
+                         list(range(6)))
+        self.assertEqual(handler.workers, 0)
+
+    def test_drop(self):
+        delivered = []
+        handler = logshipper.outputqueue.prepare_queue(
+            prepare_slow_output(delivered), {"size": 2, "policy": "drop"})
+
+        for i in range(6):
+            message = {"message": i}
+            handler(message, logshipper.context.Context(message, None))
+
+        handler.flush()
+        self.assertEqual(len(delivered), 2)
+        self.assertEqual(handler.dropped, 4)
+
+    def test_spill(self):
+        delivered = []
+        spilled = []
+        output = prepare_slow_output(delivered)
+        output.spill = lambda context: spilled.append(context.message)
+        handler = logshipper.outputqueue.prepare_queue(
+            output, {"size": 2, "policy": "drop"})
+
+        for i in range(6):
+            message = {"message": i}
+            handler(message, logshipper.context.Context(message, None))
+
+        handler.flush()
+        self.assertEqual(len(delivered), 2)
+        self.assertEqual(spilled, [{"message": i} for i in range(2, 6)])
+        self.assertEqual(handler.dropped, 0)
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            logshipper.outputqueue.prepare_queue(
+                prepare_slow_output([]), {"policy": "panic"})
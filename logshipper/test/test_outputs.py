@@ -18,10 +18,12 @@ import datetime
 import sys
 import unittest
 
+from eventlet.green import socket
 import mock
 import statsd
 
 import logshipper.context
+import logshipper.metrics
 import logshipper.outputs
 
 
@@ -91,3 +93,92 @@ class Tests(unittest.TestCase):
 
             self.assertEqual(mock_method.call_args[0][1],
                              {"FOO": '100.00000000|ms'})
+
+    def test_statsd_aggregated(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(1)
+        port = listener.getsockname()[1]
+
+        counter = logshipper.outputs.prepare_statsd({
+            'name': "hits", "port": port, "prefix": "web",
+            "flush_interval": 60})
+        gauge = logshipper.outputs.prepare_statsd({
+            'name': "size", "type": "gauge", "delta": True,
+            "value": "{length}", "port": port, "flush_interval": 60})
+        timer = logshipper.outputs.prepare_statsd({
+            'name': "latency", "type": "timer", "value": "{length}",
+            "port": port, "flush_interval": 60, "multiplier": 0.5})
+
+        for length in range(1, 11):
+            message = {"length": length}
+            context = logshipper.context.Context(message, None)
+            counter(message, context)
+            gauge(message, context)
+            timer(message, context)
+
+        counter.flush()
+        lines = set(listener.recv(65536).decode('utf8').split("\n"))
+        listener.close()
+
+        self.assertEqual(lines, set([
+            "web.hits:10|c",
+            "size:+55|g",
+            "latency.count:10|c",
+            "latency.min:0.5|g",
+            "latency.max:5|g",
+            "latency.mean:2.75|g",
+            "latency.p50:2.5|g",
+            "latency.p90:4.5|g",
+            "latency.p99:5|g",
+        ]))
+
+    def test_statsd_aggregator_mtu(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(1)
+
+        aggregator = logshipper.metrics.Aggregator(
+            '127.0.0.1', listener.getsockname()[1], 60, mtu=100)
+        for i in range(20):
+            aggregator.count("counter.%02i" % i, 1)
+        aggregator.flush()
+
+        lines = []
+        while len(lines) < 20:
+            packet = listener.recv(65536)
+            self.assertLessEqual(len(packet), 100)
+            lines.extend(packet.decode('utf8').split("\n"))
+        listener.close()
+
+        self.assertEqual(sorted(lines),
+                         ["counter.%02i:1|c" % i for i in range(20)])
+        self.assertEqual(aggregator.counters, {})
+
+    def test_statsd_aggregator_negative_gauge(self):
+        aggregator = logshipper.metrics.Aggregator('127.0.0.1', 8125, 60)
+        aggregator.gauge("absolute", -5)
+        aggregator.gauge("delta", -5, True)
+
+        self.assertEqual(list(aggregator.lines()),
+                         ["absolute:0|g", "absolute:-5|g", "delta:-5|g"])
+        if aggregator.thread:
+            aggregator.thread.cancel()
+
+    def test_statsd_aggregator_timer_memory(self):
+        aggregator = logshipper.metrics.Aggregator('127.0.0.1', 8125, 60)
+        count = logshipper.metrics.RESERVOIR_SIZE * 10
+        for i in range(count):
+            aggregator.timing("latency", i + 1)
+
+        stats = aggregator.timers["latency"]
+        self.assertEqual(len(stats.reservoir),
+                         logshipper.metrics.RESERVOIR_SIZE)
+
+        lines = dict(line.split(":") for line in aggregator.lines())
+        self.assertEqual(lines["latency.count"], "%i|c" % count)
+        self.assertEqual(lines["latency.min"], "1|g")
+        self.assertEqual(lines["latency.max"], "%i|g" % count)
+        self.assertEqual(lines["latency.mean"], "%s|g" % ((count + 1) / 2.0))
+        if aggregator.thread:
+            aggregator.thread.cancel()
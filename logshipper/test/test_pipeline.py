@@ -17,8 +17,14 @@ import datetime
 import unittest
 
 import eventlet
+import mock
+import pkg_resources
 
+import logshipper.context
 import logshipper.input
+import logshipper.message
+import logshipper.outputqueue
+import logshipper.outputs
 import logshipper.pipeline
 
 
@@ -60,6 +66,20 @@ def prepare_drop(params):
     return x
 
 
+def prepare_fail(params):
+    def handle_fail(message, context):
+        if message.get('fail'):
+            raise ValueError("Failing on purpose")
+    handle_fail.phase = logshipper.filters.PHASE_MANIPULATE
+    return handle_fail
+
+
+def prepare_slow(params):
+    x = lambda m, c: eventlet.sleep(0.01)
+    x.phase = logshipper.filters.PHASE_MANIPULATE
+    return x
+
+
 class Tests(unittest.TestCase):
 
     def test_prepare_input(self):
@@ -79,6 +99,90 @@ class Tests(unittest.TestCase):
         self.assertEqual(result, [1])
         input_.stop()
 
+    def test_prepare_input_compact(self):
+        result = []
+        input_ = logshipper.pipeline.prepare_input(
+            __name__ + ":TestInput", {"compact": True}, result.append)
+
+        input_.start()
+        eventlet.sleep(.01)
+        input_.stop()
+
+        self.assertIsInstance(result[0], logshipper.message.Record)
+        self.assertEqual(result, [TestInput.testmessage])
+
+    def test_shared_input(self):
+        results = [], [], []
+        klass = __name__ + ":TestInput"
+
+        subscriptions = [
+            logshipper.pipeline.prepare_shared_input(klass, {}, result.append)
+            for result in results[:2]]
+        subscriptions.append(logshipper.pipeline.prepare_shared_input(
+            klass, {"multiline": {"indent": True}}, results[2].append))
+
+        for subscription in subscriptions:
+            subscription.start()
+        self.assertIs(subscriptions[0].input, subscriptions[1].input)
+        self.assertIsNot(subscriptions[0].input, subscriptions[2].input)
+
+        eventlet.sleep(.01)
+        for result in results[:2]:
+            self.assertEqual(result, [TestInput.testmessage])
+        self.assertIsNot(results[0][0], results[1][0])
+
+        shared = subscriptions[0].input
+        subscriptions[0].stop()
+        self.assertIsNotNone(shared.thread)
+        subscriptions[1].stop()
+        self.assertIsNone(shared.thread)
+        subscriptions[2].stop()  # flushes the multiline message
+        self.assertEqual(results[2], [TestInput.testmessage])
+        self.assertEqual(logshipper.pipeline.SHARED_INPUTS, {})
+
+    def test_shared_input_unsubscribe_while_emitting(self):
+        shared = logshipper.pipeline.SharedInput(None, __name__ + ":TestInput",
+                                                 {})
+        results = [], [], []
+
+        def unsubscribe(batch):
+            # e.g. while blocked on backpressure
+            results[0].extend(batch)
+            shared.subscriptions.remove(subscriptions[0])
+
+        subscriptions = [
+            logshipper.pipeline.InputSubscription(shared, None, unsubscribe),
+            logshipper.pipeline.InputSubscription(shared, results[1].append),
+            logshipper.pipeline.InputSubscription(shared, results[2].append,
+                                                  results[2].extend),
+        ]
+        shared.subscriptions.extend(subscriptions)
+
+        messages = [{'message': u'1'}, {'message': u'2'}]
+        shared.emit_many(messages)
+        for result in results:
+            self.assertEqual(result, messages)
+        self.assertIsNot(results[1][0], results[2][0])
+
+        shared.emit({'message': u'3'})
+        self.assertEqual([len(result) for result in results], [2, 3, 3])
+
+    @mock.patch.dict(logshipper.pipeline.FILTER_FACTORIES, {
+        "set": pkg_resources.EntryPoint.parse(
+            "set = logshipper.filters:prepare_set")})
+    @mock.patch.dict(logshipper.pipeline.OUTPUT_FACTORIES, {
+        "stdout": pkg_resources.EntryPoint.parse(
+            "stdout = logshipper.outputs:prepare_stdout")})
+    def test_prepare_action_queue(self):
+        handler = logshipper.pipeline.prepare_action("set", {"queue": True,
+                                                             "spool": "x"})
+        message = {}
+        handler(message, logshipper.context.Context(message, None))
+        self.assertEqual(message, {"queue": True, "spool": "x"})
+
+        handler = logshipper.pipeline.prepare_action("stdout", {"queue": True})
+        self.assertIsInstance(handler, logshipper.outputqueue.QueuedOutput)
+
     def test_prepare_filter(self):
         handler = logshipper.pipeline.prepare_step({
             __name__ + ":prepare_handler1": {},
@@ -172,3 +276,133 @@ class Tests(unittest.TestCase):
 
         self.assertNotIn('handler1', m)
         self.assertIn('handler2', m)
+
+    def test_prepare_pipeline(self):
+        steps = [
+            [prepare_skip(None), prepare_handler1(None)],
+            [],
+            [prepare_handler2(None)],
+        ]
+        process = logshipper.pipeline.prepare_pipeline(steps, None)
+
+        m = process({'message': u''})
+        self.assertNotIn('handler1', m)
+        self.assertIn('handler2', m)
+
+        process = logshipper.pipeline.prepare_pipeline(
+            steps + [[prepare_drop(None)]], None)
+        self.assertIsNone(process({'message': u''}))
+
+        process = logshipper.pipeline.prepare_pipeline([], None)
+        self.assertEqual(process({'message': u''}), {'message': u''})
+
+    def test_prepare_pipeline_reuses_contexts(self):
+        contexts = []
+
+        def handler(message, context):
+            self.assertIs(context.message, message)
+            self.assertEqual(context.backreferences, [])
+            contexts.append(context)
+
+        process = logshipper.pipeline.prepare_pipeline([[handler]], None)
+        process({'message': u'1'})
+        process({'message': u'2'})
+        self.assertIs(contexts[0], contexts[1])
+        self.assertIsNone(contexts[0].message)
+
+    def test_prepare_pipeline_fork(self):
+        forked = []
+
+        class Manager(object):
+            def process_in_eventlet(self, message, pipeline_name):
+                forked.append(message)
+
+        steps = [[logshipper.outputs.prepare_fork("other")],
+                 [prepare_handler2(None)]]
+        process = logshipper.pipeline.prepare_pipeline(steps, Manager())
+
+        m = process({'message': u''})
+        self.assertIsInstance(m, logshipper.message.Message)
+        self.assertEqual(m, {'message': u'', 'handler2': True})
+        self.assertEqual(forked, [{'message': u''}])
+
+    def test_process_batch(self):
+        pipeline = logshipper.pipeline.Pipeline(None)
+
+        pipeline.update(
+            "steps:\n"
+            "- 'logshipper.filters:prepare_match': '^keep'\n"
+            "  'test_pipeline:prepare_handler2': None\n"
+            "- 'logshipper.filters:prepare_match': 'drop'\n"
+            "  'test_pipeline:prepare_drop': None\n"
+            "- 'logshipper.filters:prepare_set': {'seen': '{message}'}\n"
+        )
+
+        result = pipeline.process_batch([{'message': u'keep'},
+                                         {'message': u'skip'},
+                                         {'message': u'keep, drop'}])
+
+        self.assertEqual(result, [
+            {'message': u'keep', 'handler2': True, 'seen': u'keep'},
+            {'message': u'skip', 'seen': u'skip'},
+        ])
+
+        # The contexts are recycled, also by the per-message path
+        self.assertEqual(len(pipeline.free_contexts), 3)
+        self.assertTrue(all(context.message is None
+                            for context in pipeline.free_contexts))
+        pipeline.process({'message': u'keep'})
+        self.assertEqual(len(pipeline.free_contexts), 3)
+
+    def test_process_batch_error(self):
+        pipeline = logshipper.pipeline.Pipeline(None)
+
+        pipeline.update(
+            "steps:\n"
+            "- 'logshipper.filters:prepare_strptime': {'field': 'ts',"
+            " 'format': '%Y'}\n"
+            "- 'test_pipeline:prepare_fail': None\n"
+        )
+
+        result = pipeline.process_batch([{'ts': '2014'},
+                                         {'ts': 'bad'},
+                                         {'ts': '2015'},
+                                         {'ts': '2016', 'fail': True}])
+
+        self.assertEqual(result, [{'ts': datetime.datetime(2014, 1, 1)},
+                                  {'ts': datetime.datetime(2015, 1, 1)}])
+        self.assertEqual(len(pipeline.free_contexts), 4)
+        self.assertTrue(all(context.message is None
+                            for context in pipeline.free_contexts))
+
+    def test_backpressure(self):
+        pipeline = logshipper.pipeline.Pipeline(None)
+        pipeline.update(
+            "concurrency: 2\n"
+            "high_watermark: 4\n"
+            "low_watermark: 1\n"
+            "steps:\n"
+            "- 'test_pipeline:prepare_slow': None\n"
+        )
+        message = {'timestamp': None, 'hostname': None, 'message': u''}
+        emitted = []
+
+        def produce():
+            for i in range(10):
+                pipeline.process_in_eventlet(dict(message))
+                emitted.append(pipeline.pending)
+
+        producer = eventlet.spawn(produce)
+        eventlet.sleep(0.001)
+
+        # The producer is blocked at the high watermark
+        self.assertEqual(pipeline.pending, 4)
+        self.assertEqual(pipeline.workers, 2)
+        self.assertEqual(len(emitted), 4)
+
+        producer.wait()
+        self.assertTrue(max(emitted) <= 4)
+
+        while pipeline.pending:
+            eventlet.sleep(0.01)
+        self.assertEqual(pipeline.workers, 0)
@@ -0,0 +1,190 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import eventlet
+import mock
+import pika.adapters.blocking_connection
+import pika.channel
+
+import logshipper.rabbitmq
+
+
+class FakeTransport(object):
+    def __init__(self, fail_publish=0, nack=()):
+        self.connects = 0
+        self.fail_publish = fail_publish
+        self.nack = set(nack)
+        self.batches = []
+        self.delivered = []
+        self.in_flight = []
+        self.max_in_flight = 0
+        self.hold = False
+        self.closes = 0
+
+    def connect(self):
+        self.connects += 1
+        self.in_flight = []
+        self.tag = 0
+
+    def publish(self, bodies):
+        if self.fail_publish:
+            self.fail_publish -= 1
+            raise IOError("Connection lost")
+
+        self.batches.append(list(bodies))
+        for body in bodies:
+            self.tag += 1
+            self.in_flight.append((self.tag, body))
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+
+    def poll(self, timeout):
+        if self.hold or not self.in_flight:
+            return []
+
+        confirms = []
+        for tag, body in self.in_flight:
+            if body in self.nack:
+                self.nack.remove(body)
+                confirms.append((tag, False, False))
+            else:
+                self.delivered.append(body)
+                confirms.append((tag, False, True))
+        self.in_flight = []
+        return confirms
+
+    def close(self):
+        self.closes += 1
+
+
+class Tests(unittest.TestCase):
+    def publish(self, publisher, count):
+        for i in range(count):
+            publisher.publish(i)
+        publisher.flush(timeout=5)
+        self.assertEqual(publisher.pending(), 0)
+
+    def test_batches(self):
+        transport = FakeTransport()
+        publisher = logshipper.rabbitmq.RabbitPublisher(transport,
+                                                        batch_size=100)
+        self.publish(publisher, 250)
+
+        self.assertEqual(transport.delivered, list(range(250)))
+        self.assertEqual(transport.connects, 1)
+        self.assertTrue(all(len(batch) <= 100
+                            for batch in transport.batches))
+        self.assertLess(len(transport.batches), 250)
+
+    def test_window(self):
+        transport = FakeTransport()
+        transport.hold = True
+        publisher = logshipper.rabbitmq.RabbitPublisher(transport,
+                                                        batch_size=4,
+                                                        window=10)
+        for i in range(50):
+            publisher.publish(i)
+        eventlet.sleep(0.1)
+
+        self.assertEqual(transport.max_in_flight, 10)
+        self.assertEqual(len(publisher.unacked), 10)
+
+        transport.hold = False
+        publisher.flush(timeout=5)
+        self.assertEqual(transport.delivered, list(range(50)))
+        self.assertEqual(transport.max_in_flight, 10)
+
+    def test_reconnect(self):
+        transport = FakeTransport(fail_publish=2)
+        publisher = logshipper.rabbitmq.RabbitPublisher(transport,
+                                                        retry_delay=0.01)
+        self.publish(publisher, 10)
+
+        self.assertEqual(transport.delivered, list(range(10)))
+        self.assertEqual(transport.connects, 3)
+
+    def test_nack(self):
+        transport = FakeTransport(nack=[3])
+        publisher = logshipper.rabbitmq.RabbitPublisher(transport)
+        self.publish(publisher, 5)
+
+        self.assertEqual(sorted(transport.delivered), list(range(5)))
+
+    def test_overflow(self):
+        transport = FakeTransport(fail_publish=1)
+        publisher = logshipper.rabbitmq.RabbitPublisher(transport,
+                                                        retry_delay=0.1)
+        spooled = []
+        publisher.set_overflow(spooled.append)
+
+        for i in range(5):
+            publisher.publish(i)
+        eventlet.sleep(0.05)
+
+        # While reconnecting, everything goes to the overflow
+        self.assertTrue(publisher.saturated())
+        publisher.publish(5)
+        self.assertEqual(sorted(spooled), list(range(6)))
+        self.assertEqual(publisher.pending(), 0)
+
+        eventlet.sleep(0.1)
+        self.assertFalse(publisher.saturated())
+        for body in spooled:
+            publisher.replay(body)
+        publisher.flush(timeout=5)
+        self.assertEqual(sorted(transport.delivered), list(range(6)))
+
+    def test_flush_closes(self):
+        transport = FakeTransport()
+        publisher = logshipper.rabbitmq.RabbitPublisher(transport)
+        self.publish(publisher, 5)
+
+        self.assertIsNone(publisher.thread)
+        self.assertFalse(publisher.connected)
+        self.assertEqual(transport.closes, 1)
+
+        # Publishing again reconnects
+        self.publish(publisher, 5)
+        self.assertEqual(transport.delivered, list(range(5)) * 2)
+        self.assertEqual(transport.connects, 2)
+
+    def test_close_while_retrying(self):
+        transport = FakeTransport(fail_publish=1)
+        publisher = logshipper.rabbitmq.RabbitPublisher(transport,
+                                                        retry_delay=10)
+        publisher.publish(0)
+        eventlet.sleep(0.05)
+        self.assertTrue(publisher.failing)
+
+        with eventlet.Timeout(1):
+            publisher.close()
+        self.assertIsNone(publisher.thread)
+        self.assertEqual(publisher.pending(), 1)
+
+        # The message is published once the publisher is started again
+        self.publish(publisher, 0)
+        self.assertEqual(transport.delivered, [0])
+
+    def test_pika_channel_impl(self):
+        # PikaTransport relies on these pika internals, see its docstring
+        impl = mock.Mock()
+        channel = pika.adapters.blocking_connection.BlockingChannel(
+            impl, mock.Mock())
+        self.assertIs(channel._impl, impl)
+
+        confirm_delivery = pika.channel.Channel.confirm_delivery
+        self.assertIn('ack_nack_callback',
+                      confirm_delivery.__code__.co_varnames)
@@ -0,0 +1,77 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import logshipper.registry
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, "test.log")
+        with open(self.filename, 'wb') as f:
+            f.write(b"first line\nsecond line\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_roundtrip(self):
+        registry_path = os.path.join(self.path, "registry")
+        registry = logshipper.registry.OffsetRegistry(registry_path)
+        file_stat = os.stat(self.filename)
+        registry.update([(file_stat, b"first line\n", 11, self.filename)])
+        registry.save()
+        self.assertFalse(registry.dirty)
+        self.assertFalse(os.path.exists(registry_path + ".tmp"))
+
+        registry = logshipper.registry.OffsetRegistry(registry_path)
+        self.assertEqual(registry.lookup(file_stat, b"first line\nsecond"),
+                         11)
+
+    def test_fingerprint_mismatch(self):
+        registry = logshipper.registry.OffsetRegistry(
+            os.path.join(self.path, "registry"))
+        file_stat = os.stat(self.filename)
+        registry.update([(file_stat, b"first line\n", 11, self.filename)])
+
+        # The inode was reused by another file
+        self.assertIsNone(registry.lookup(file_stat, b"other line\n"))
+        # The file was truncated
+        self.assertIsNone(registry.lookup(file_stat, b"first"))
+
+    def test_lookup_fingerprint(self):
+        registry = logshipper.registry.OffsetRegistry(
+            os.path.join(self.path, "registry"))
+        self.assertIsNone(registry.saved_at)
+
+        file_stat = os.stat(self.filename)
+        registry.update([(file_stat, b"first line\n", 11, self.filename)])
+
+        # E.g. a compressed copy
+        self.assertEqual(registry.lookup_fingerprint(b"first line\nsecond"),
+                         11)
+        self.assertIsNone(registry.lookup_fingerprint(b"other line\n"))
+
+    def test_corrupt(self):
+        registry_path = os.path.join(self.path, "registry")
+        with open(registry_path, 'w') as f:
+            f.write("{")
+
+        registry = logshipper.registry.OffsetRegistry(registry_path)
+        self.assertEqual(registry.entries, {})
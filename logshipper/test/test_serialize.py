@@ -0,0 +1,63 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import datetime
+import json
+import unittest
+
+import logshipper.context
+import logshipper.serialize
+
+
+class Tests(unittest.TestCase):
+    def test_dumps(self):
+        class Foo(object):
+            def __str__(self):
+                return "foo"
+
+        value = {
+            "b": datetime.datetime(2008, 10, 19, 14, 40, 0, 9),
+            "a": Foo(),
+        }
+
+        for dumps in (logshipper.serialize.dumps,
+                      logshipper.serialize.dumps_stdlib):
+            self.assertEqual(json.loads(dumps(value).decode('utf8')),
+                             {"b": "2008-10-19T14:40:00.000009", "a": "foo"})
+
+        self.assertEqual(logshipper.serialize.dumps_stdlib(value, True),
+                         b'{"a": "foo", "b": "2008-10-19T14:40:00.000009"}')
+
+    def test_serialize_message_cache(self):
+        message = {"message": "foo", "timestamp": 1}
+        context = logshipper.context.Context(message, None)
+
+        result = logshipper.serialize.serialize_message(context)
+        self.assertEqual(json.loads(result.decode('utf8')), message)
+
+        message['message'] = 'bar'
+        self.assertIs(logshipper.serialize.serialize_message(context),
+                      result)
+
+        renamed = logshipper.serialize.serialize_message(
+            context, timestamp_field='@timestamp')
+        self.assertEqual(json.loads(renamed.decode('utf8')),
+                         {"message": "bar", "@timestamp": 1})
+        self.assertIn('timestamp', message)
+
+        context.next_step()
+        result = logshipper.serialize.serialize_message(context)
+        self.assertEqual(json.loads(result.decode('utf8'))['message'], 'bar')
@@ -0,0 +1,245 @@
+# Copyright 2014 Koert van der Veer
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import eventlet
+from six.moves import cPickle as pickle
+
+import logshipper.context
+import logshipper.spool
+
+
+def prepare_flaky_output(delivered, failures):
+    def handle_flaky(message, context):
+        if failures:
+            failures.pop()
+            raise IOError("Downstream unavailable")
+        delivered.append((message, context.backreferences))
+    handle_flaky.phase = 30
+    return handle_flaky
+
+
+class BufferedOutput(object):
+    """Stands in for an output which spools what it couldn't deliver"""
+
+    phase = 30
+
+    def __init__(self):
+        self.delivered = []
+        self.busy = False
+        self.overflow = None
+
+    def __call__(self, message, context):
+        self.overflow(message['message'])
+
+    def set_overflow(self, overflow):
+        self.overflow = overflow
+
+    def saturated(self):
+        return self.busy
+
+    def replay(self, item):
+        self.delivered.append(item)
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def segments(self):
+        return [name for name in os.listdir(self.path)
+                if name.endswith(logshipper.spool.SEGMENT_SUFFIX)]
+
+    def test_spool(self):
+        spool = logshipper.spool.Spool(self.path, segment_size=100)
+        for i in range(50):
+            self.assertTrue(spool.append(b"record %i" % i))
+        self.assertGreater(len(self.segments()), 1)
+
+        records = []
+        while True:
+            record = spool.read()
+            if record is None:
+                break
+            records.append(record)
+            spool.pop()
+
+        self.assertEqual(records, [b"record %i" % i for i in range(50)])
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(len(self.segments()), 1)
+
+        spool.append(b"more")
+        self.assertEqual(spool.read(), b"more")
+        spool.close()
+
+    def test_reopen(self):
+        spool = logshipper.spool.Spool(self.path, segment_size=100)
+        for i in range(10):
+            spool.append(b"record %i" % i)
+        for i in range(3):
+            spool.read()
+            spool.pop()
+        spool.close()
+
+        spool = logshipper.spool.Spool(self.path, segment_size=100)
+        self.assertEqual(spool.read(), b"record 3")
+        spool.close()
+
+    def test_corrupt(self):
+        spool = logshipper.spool.Spool(self.path, segment_size=30)
+        for i in range(4):
+            spool.append(b"record %i" % i)
+        spool.close()
+
+        # Damage the payload of the first record
+        path = os.path.join(self.path, sorted(self.segments())[0])
+        with open(path, 'r+b') as f:
+            f.seek(logshipper.spool.HEADER.size)
+            f.write(b"X")
+
+        spool = logshipper.spool.Spool(self.path, segment_size=30)
+        self.assertEqual(spool.read(), b"record 2")
+        spool.close()
+
+    def test_max_size(self):
+        spool = logshipper.spool.Spool(self.path, max_size=50)
+        self.assertTrue(spool.append(b"x" * 30))
+        self.assertFalse(spool.append(b"x" * 30))
+        spool.close()
+
+    def test_replay(self):
+        delivered = []
+        failures = [1, 2, 3]
+        handler = logshipper.spool.prepare_spool(
+            prepare_flaky_output(delivered, failures),
+            {"directory": self.path, "retry_delay": 0.01})
+
+        for i in range(10):
+            message = {"message": i}
+            context = logshipper.context.Context(message, None)
+            context.backreferences = [str(i)]
+            handler(message, context)
+
+        self.assertEqual(delivered, [])
+        while handler.replaying is not None:
+            eventlet.sleep(0.01)
+
+        self.assertEqual(delivered, [({"message": i}, [str(i)])
+                                     for i in range(10)])
+
+        # The position is saved once replayed, without waiting for a sync
+        self.assertIsNone(handler.spool.sync_timer)
+        spool = logshipper.spool.Spool(self.path)
+        self.assertEqual(len(spool), 0)
+        spool.close()
+
+        message = {"message": 10}
+        handler(message, logshipper.context.Context(message, None))
+        self.assertEqual(len(delivered), 11)
+        handler.flush()
+
+    def test_replay_pipeline_manager(self):
+        managers = []
+
+        def handle(message, context):
+            managers.append(context.pipeline_manager)
+        handle.phase = 30
+
+        manager = object()
+        handler = logshipper.spool.prepare_spool(
+            prepare_flaky_output([], [1]), {"directory": self.path}, manager)
+        message = {"message": 1}
+        handler(message, logshipper.context.Context(message, manager))
+        handler.flush()
+
+        handler = logshipper.spool.prepare_spool(
+            handle, {"directory": self.path}, manager)
+        while handler.replaying is not None:
+            eventlet.sleep(0.01)
+
+        self.assertEqual(managers, [manager])
+        handler.flush()
+
+    def test_overflow(self):
+        output = BufferedOutput()
+        output.busy = True
+        handler = logshipper.spool.prepare_spool(
+            output, {"directory": self.path, "retry_delay": 0.01})
+
+        for i in range(3):
+            message = {"message": i}
+            handler(message, logshipper.context.Context(message, None))
+        eventlet.sleep(0.05)
+        self.assertEqual(output.delivered, [])
+
+        output.busy = False
+        while handler.replaying is not None:
+            eventlet.sleep(0.01)
+        self.assertEqual(output.delivered, [0, 1, 2])
+        handler.flush()
+
+    def test_reject(self):
+        delivered = []
+
+        def handle(message, context):
+            if message["message"] == "bad":
+                raise ValueError("Never deliverable")
+            delivered.append(message["message"])
+        handle.phase = 30
+
+        handler = logshipper.spool.prepare_spool(
+            handle, {"directory": self.path, "retry_delay": 0.001,
+                     "max_attempts": 3})
+        for text in ("bad", "good"):
+            message = {"message": text}
+            handler(message, logshipper.context.Context(message, None))
+
+        while handler.replaying is not None:
+            eventlet.sleep(0.01)
+        self.assertEqual(delivered, ["good"])
+
+        rejected = handler.rejected
+        handler.flush()
+        rejected = logshipper.spool.Spool(rejected.directory)
+        self.assertEqual(
+            pickle.loads(rejected.read()),
+            (logshipper.spool.MESSAGE, ({"message": "bad"}, [])))
+        rejected.close()
+
+    def test_replay_on_start(self):
+        failures = [1] * 100
+        handler = logshipper.spool.prepare_spool(
+            prepare_flaky_output([], failures), {"directory": self.path})
+        for i in range(5):
+            message = {"message": i}
+            handler(message, logshipper.context.Context(message, None))
+        handler.flush()
+
+        delivered = []
+        handler = logshipper.spool.prepare_spool(
+            prepare_flaky_output(delivered, []), {"directory": self.path})
+        while handler.replaying is not None:
+            eventlet.sleep(0.01)
+
+        self.assertEqual([m['message'] for (m, _) in delivered],
+                         list(range(5)))
+        handler.flush()
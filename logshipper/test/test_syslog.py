@@ -141,3 +141,34 @@ class Syslog(unittest.TestCase):
 
         self.assertEqual(len(msg), 1)
         self.assertEqual(msg[0]['message'], 'Hello')
+
+    def test_socket_multiline(self):
+        msg = []
+
+        port = random.randint(32768, 65536)
+        syslog = logshipper.input.Syslog(port=port)
+        syslog.set_handler(msg.append)
+        syslog.set_multiline({'indent': True})
+
+        syslog.start()
+        eventlet.sleep(0.01)
+
+        c1 = socket.socket()
+        c1.connect(('127.0.0.1', port))
+        c2 = socket.socket()
+        c2.connect(('127.0.0.1', port))
+        eventlet.sleep(0.01)
+
+        # Lines from different connections are never joined
+        c1.sendall(b'<73>Traceback:\n')
+        eventlet.sleep(0.01)
+        c2.sendall(b'<73> unrelated\n')
+        eventlet.sleep(0.01)
+        c1.sendall(b'<73> File "x.py"\n')
+        c1.close()
+        c2.close()
+        eventlet.sleep(0.01)
+
+        self.assertEqual(sorted(m['message'] for m in msg),
+                         [' unrelated', 'Traceback:\n File "x.py"'])
+        syslog.stop()
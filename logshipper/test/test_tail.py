@@ -14,12 +14,17 @@
 #    under the License.
 
 
+import bz2
+import gzip
 import logging
+import os
 import shutil
 import tempfile
+import time
 import unittest
 
 import eventlet
+import eventlet.event
 
 import logshipper.tail
 
@@ -51,7 +56,371 @@ class Tail(unittest.TestCase):
             tail.stop()
             eventlet.sleep(0.01)  # give thread a chance to close the line
 
-        self.assertEqual(messages, [{"message": "second line"}])
+        self.assertEqual([m['message'] for m in messages], ["second line"])
+
+    def test_partial_lines(self):
+        messages = []
+
+        def message_handler(m):
+            messages.append(m)
+
+        with tempfile.NamedTemporaryFile() as f:
+            tail = logshipper.tail.Tail(f.name)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the file
+
+            # Split a line, and a multi-byte character, over several writes
+            for chunk in [b"first par", b"tial caf\xc3", b"\xa9\nsecond\n",
+                          b"third"]:
+                f.write(chunk)
+                f.flush()
+                eventlet.sleep(0.01)  # give thread a chance to read
+
+            self.assertEqual([m['message'] for m in messages],
+                             [u"first partial caf\xe9", u"second"])
+
+            tail.stop()
+            eventlet.sleep(0.01)  # give thread a chance to close the file
+
+        self.assertEqual([m['message'] for m in messages],
+                         [u"first partial caf\xe9", u"second", u"third"])
+
+    def test_registry(self):
+        messages = []
+
+        def message_handler(m):
+            messages.append(m['message'])
+
+        try:
+            path = tempfile.mkdtemp()
+            registry = path + "/registry"
+            with open(path + "/test.log", 'w') as f:
+                f.write("before\n")
+
+            tail = logshipper.tail.Tail(path + "/test.log",
+                                        registry=registry)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the file
+
+            with open(path + "/test.log", 'a') as f:
+                f.write("line 1\npartial")
+            eventlet.sleep(0.01)  # give thread a chance to read the line
+
+            tail.stop()
+            eventlet.sleep(0.01)  # give thread a chance to checkpoint
+            self.assertEqual(messages, ["line 1"])
+
+            # Written while not running
+            with open(path + "/test.log", 'a') as f:
+                f.write(" line 2\nline 3\n")
+
+            tail = logshipper.tail.Tail(path + "/test.log",
+                                        registry=registry)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the file
+            tail.stop()
+            eventlet.sleep(0.01)
+
+            self.assertEqual(messages,
+                             ["line 1", "partial line 2", "line 3"])
+        finally:
+            shutil.rmtree(path)
+
+    def test_registry_new_file(self):
+        messages = []
+
+        def message_handler(m):
+            messages.append(m['message'])
+
+        try:
+            path = tempfile.mkdtemp()
+            registry = path + "/registry"
+            with open(path + "/old.log", 'w') as f:
+                f.write("old\n")
+
+            tail = logshipper.tail.Tail(path + "/*.log", registry=registry)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the file
+            tail.stop()
+            eventlet.sleep(0.01)  # give thread a chance to checkpoint
+
+            # Created while not running
+            time.sleep(0.01)
+            with open(path + "/new.log", 'w') as f:
+                f.write("new\n")
+
+            tail = logshipper.tail.Tail(path + "/*.log", registry=registry)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the file
+            tail.stop()
+            eventlet.sleep(0.01)
+
+            self.assertEqual(messages, ["new"])
+        finally:
+            shutil.rmtree(path)
+
+    def test_max_open_files(self):
+        messages = []
+
+        def message_handler(m):
+            messages.append(m['message'])
+
+        try:
+            path = tempfile.mkdtemp()
+            for i in range(5):
+                with open("%s/%i.log" % (path, i), 'w') as f:
+                    f.write("old\n")
+
+            tail = logshipper.tail.Tail(path + "/*.log", max_open_files=2)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the files
+            self.assertEqual(len(tail.open_tails), 2)
+
+            for line in range(2):
+                for i in range(5):
+                    with open("%s/%i.log" % (path, i), 'a') as f:
+                        f.write("%i.%i\n" % (i, line))
+                    eventlet.sleep(0.01)  # give thread a chance to read
+
+            self.assertEqual(sorted(messages),
+                             ["%i.%i" % (i, line)
+                              for i in range(5) for line in range(2)])
+            self.assertEqual(len(tail.open_tails), 2)
+
+            tail.stop()
+            eventlet.sleep(0.01)
+        finally:
+            shutil.rmtree(path)
+
+    def test_polling(self):
+        messages = []
+
+        def message_handler(m):
+            messages.append(m['message'])
+
+        try:
+            path = tempfile.mkdtemp()
+            tail = logshipper.tail.Tail(path + "/*.log")
+            tail.set_handler(message_handler)
+
+            # As if inotify watches were exhausted
+            tail.watcher.add_watch = lambda *args: None
+
+            tail.start()
+            eventlet.sleep(0.01)
+            self.assertIsNotNone(tail.poller)
+
+            with open(path + "/test.log", 'w') as f:
+                f.write("line 1\n")
+            eventlet.sleep(0.3)  # give the poller a chance to find the file
+
+            with open(path + "/test.log", 'a') as f:
+                f.write("line 2\n")
+            eventlet.sleep(0.3)  # give the poller a chance to read the line
+
+            self.assertEqual(messages, ["line 1", "line 2"])
+
+            tail.stop()
+            eventlet.sleep(0.01)
+            self.assertIsNone(tail.poller)
+        finally:
+            shutil.rmtree(path)
+
+    def test_glob_matcher(self):
+        matcher = logshipper.tail.GlobMatcher([
+            "/var/log/syslog", "/var/log/app/*.log", "/srv/*/logs/[ab]?.log"])
+
+        self.assertTrue(matcher.match("/var/log/syslog"))
+        self.assertTrue(matcher.match("/var/log/app/web.log"))
+        self.assertTrue(matcher.match("/srv/site/logs/a1.log"))
+
+        self.assertFalse(matcher.match("/var/log/syslog.1"))
+        self.assertFalse(matcher.match("/var/log/app/.hidden.log"))
+        self.assertFalse(matcher.match("/var/log/app/sub/web.log"))
+        self.assertFalse(matcher.match("/srv/site/logs/c1.log"))
+        self.assertFalse(matcher.match("/srv/a/b/logs/a1.log"))
+
+    def test_rotation(self):
+        messages = []
+
+        def message_handler(m):
+            messages.append(m['message'])
+
+        try:
+            path = tempfile.mkdtemp()
+            tail = logshipper.tail.Tail(path + "/*.log")
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to start
+
+            with open(path + "/test.log", 'w') as f:
+                f.write("line 1\n")
+            eventlet.sleep(0.01)  # give thread a chance to read the line
+
+            with open(path + "/test.log", 'a') as f:
+                f.write("line 2\n")
+            os.rename(path + "/test.log", path + "/test.log.1")
+            with open(path + "/test.log", 'w') as f:
+                f.write("line 3\n")
+            eventlet.sleep(0.01)  # give thread a chance to read the lines
+
+            self.assertEqual(messages, ["line 1", "line 2", "line 3"])
+            self.assertEqual(list(tail.tails), [path + "/test.log"])
+
+            tail.stop()
+            eventlet.sleep(0.01)
+        finally:
+            shutil.rmtree(path)
+
+    def test_fairness(self):
+        messages = []
+
+        def message_handler(m):
+            messages.append(m['message'])
+
+        try:
+            path = tempfile.mkdtemp()
+            for name in ("hot", "quiet"):
+                open("%s/%s.log" % (path, name), 'w').close()
+
+            tail = logshipper.tail.Tail(path + "/*.log", read_budget=4096)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the files
+
+            with open(path + "/hot.log", 'a') as f:
+                f.write("hot\n" * 100000)
+            with open(path + "/quiet.log", 'a') as f:
+                f.write("quiet\n")
+
+            deadline = time.time() + 5
+            while len(messages) < 100001 and time.time() < deadline:
+                eventlet.sleep(0.01)
+
+            self.assertEqual(len(messages), 100001)
+            self.assertLess(messages.index("quiet"), 10000)
+
+            tail.stop()
+            eventlet.sleep(0.01)
+        finally:
+            shutil.rmtree(path)
+
+    def test_coalesce(self):
+        batches = []
+
+        with tempfile.NamedTemporaryFile() as f:
+            tail = logshipper.tail.Tail(f.name, coalesce=0.05)
+            tail.set_handler(None, batches.append)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the file
+
+            for i in range(5):
+                f.write(b"line %i\n" % i)
+                f.flush()
+                eventlet.sleep(0.001)  # give thread a chance to be notified
+            self.assertEqual(batches, [])
+
+            eventlet.sleep(0.1)  # give thread a chance to read the lines
+            self.assertEqual([[m['message'] for m in batch]
+                              for batch in batches],
+                             [["line %i" % i for i in range(5)]])
+
+            tail.stop()
+            eventlet.sleep(0.01)
+
+    def test_single_reader(self):
+        batches = []
+        blocked = eventlet.event.Event()
+
+        def batch_handler(messages):
+            batches.append([m['message'] for m in messages])
+            if len(batches) == 1:
+                blocked.wait()  # e.g. backpressure
+
+        with tempfile.NamedTemporaryFile() as f:
+            tail = logshipper.tail.Tail(f.name)
+            tail.set_handler(None, batch_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the file
+
+            f.write(b"line 1\n")
+            f.flush()
+            eventlet.sleep(0.01)  # the reader blocks in the handler
+            self.assertEqual(batches, [["line 1"]])
+
+            # Another caller (e.g. the poller) leaves it to the reader
+            f.write(b"line 2\n")
+            f.flush()
+            file_tail = tail.tails[f.name]
+            tail.read_tail(file_tail)
+            self.assertEqual(batches, [["line 1"]])
+
+            blocked.send()
+            eventlet.sleep(0.01)
+            self.assertEqual(batches, [["line 1"], ["line 2"]])
+            self.assertIsNone(file_tail.reading)
+
+            tail.stop()
+            eventlet.sleep(0.01)
+
+    def test_catch_up(self):
+        messages = []
+
+        def message_handler(m):
+            messages.append(m['message'])
+
+        try:
+            path = tempfile.mkdtemp()
+            registry = path + "/registry"
+            filename = path + "/app.log"
+            with open(filename, 'w') as f:
+                f.write("old\n")
+
+            tail = logshipper.tail.Tail(filename, registry=registry,
+                                        catch_up=True)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to open the file
+            with open(filename, 'a') as f:
+                f.write("a\n")
+            eventlet.sleep(0.01)  # give thread a chance to read the line
+            tail.stop()
+            eventlet.sleep(0.01)  # give thread a chance to checkpoint
+            self.assertEqual(messages, ["a"])
+
+            # While not running, the file is written, rotated and compressed
+            time.sleep(0.01)
+            with open(filename, 'a') as f:
+                f.write("b\n")
+            with open(filename, 'rb') as source:
+                with gzip.open(filename + ".1.gz", 'wb') as target:
+                    target.write(source.read())
+            os.unlink(filename)
+            with open(filename, 'w') as f:
+                f.write("c\n")
+
+            # Shipped long ago
+            with bz2.BZ2File(filename + ".2.bz2", 'wb') as f:
+                f.write(b"ancient\n")
+            os.utime(filename + ".2.bz2", (0, 0))
+
+            tail = logshipper.tail.Tail(filename, registry=registry,
+                                        catch_up=True)
+            tail.set_handler(message_handler)
+            tail.start()
+            eventlet.sleep(0.01)  # give thread a chance to catch up
+            tail.stop()
+            eventlet.sleep(0.01)
+
+            self.assertEqual(messages, ["a", "b", "c"])
+        finally:
+            shutil.rmtree(path)
 
     def test_wildcard(self):
         messages = []
@@ -72,15 +441,15 @@ class Tail(unittest.TestCase):
                 f.write("line 1\n")
 
             eventlet.sleep(0.01)  # give thread a chance to read the line
-            self.assertEqual(messages, [{"message": "line 1"}])
+            self.assertEqual([m['message'] for m in messages], ["line 1"])
 
             LOG.debug("about to write line 2")
             with open(path + "/test.log", 'a') as f:
                 f.write("line 2\n")
 
             eventlet.sleep(0.01)  # give thread a chance to read the line
-            self.assertEqual(messages, [{"message": "line 1"},
-                                        {"message": "line 2"}])
+            self.assertEqual([m['message'] for m in messages],
+                             ["line 1", "line 2"])
 
             tail.stop()
             eventlet.sleep(0.1)  # give thread a chance to close the line
@@ -125,7 +494,7 @@ class Tail(unittest.TestCase):
                 f.flush()
             eventlet.sleep(0.01)
 
-            self.assertEqual(messages, [{"message": "line 2"}])
+            self.assertEqual([m['message'] for m in messages], ["line 2"])
 
             # Remove file
             tail.remove_file(filename=path + "/test.log")
@@ -139,7 +508,7 @@ class Tail(unittest.TestCase):
             eventlet.sleep(0.01)
 
             # Assert no new messages have been added
-            self.assertEqual(messages, [{"message": "line 2"}])
+            self.assertEqual([m['message'] for m in messages], ["line 2"])
 
             tail.stop()
             eventlet.sleep(0.1)
@@ -68,3 +68,14 @@ def build(docs=False):
     run("python setup.py build")
     if docs:
         build_docs()
+
+
+@task
+def benchmark(name=''):
+    import glob
+
+    for path in sorted(glob.glob("benchmarks/%s*.py" % name)):
+        if path.endswith("util.py"):
+            continue
+        print("== %s" % path)
+        run("python %s" % path)